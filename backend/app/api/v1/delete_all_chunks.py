@@ -1,11 +1,11 @@
 """Endpoint for deleting all rows from the database."""
 from logging import getLogger
 
-from app.db.models import Chunk
-from app.db.session import get_db_session
+from app.db.models import Chunk, Document
+from app.db.session import bump_corpus_version, get_db_session
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
-from sqlalchemy import delete
+from sqlalchemy import func, select, sql
 from sqlalchemy.ext.asyncio import AsyncSession
 
 logger = getLogger(__name__)
@@ -23,17 +23,24 @@ class DeleteAllChunksResponse(BaseModel):
     "/v1/delete_all_chunks", status_code=200, response_model=DeleteAllChunksResponse
 )
 async def delete_all_chunks(db: AsyncSession = Depends(get_db_session)):  # noqa: B008
-    """Delete all rows from the chunks table."""
+    """Delete all rows from the chunks table (and the documents table)."""
     logger.info("Deleting all rows from the Chunk table...")
     try:
-        # Delete all records from the Chunk table
-        result = await db.execute(delete(Chunk))
-        num_deleted = result.rowcount if result.rowcount is not None else 0
+        # Lock the table first, so that no rows are written between counting and truncating
+        # (TRUNCATE needs this lock anyway), so that n_deleted is exact
+        await db.execute(sql.text(f"LOCK TABLE {Chunk.__tablename__} IN ACCESS EXCLUSIVE MODE"))
+        num_deleted = await db.scalar(select(func.count()).select_from(Chunk))
+        # Unlike DELETE, TRUNCATE does not scan the table (nor leave dead rows to vacuum)
+        await db.execute(
+            sql.text(f"TRUNCATE TABLE {Chunk.__tablename__}, {Document.__tablename__}")
+        )
         await db.commit()
     except Exception as e:
         await db.rollback()
         logger.error(f"Error deleting all rows from the Chunk table: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+    # Invalidate the answers cached for the previous version of the corpus
+    await bump_corpus_version(db)
     logger.info("Successfully deleted all rows from the Chunk table.")
     return DeleteAllChunksResponse(status="success", n_deleted=num_deleted)
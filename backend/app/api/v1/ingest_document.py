@@ -1,101 +1,95 @@
 """Endpoint for ingesting a document in the database."""
 import asyncio
+import functools
+import os
 from logging import getLogger
+from typing import Optional, Tuple
 
-from app.db.models import Chunk
-from app.db.session import get_db_session
-from app.utils.ai_utils import embed_text
-from app.utils.docling_utils import parse_and_chunk_pdf
-from docling.chunking import HybridChunker
-from fastapi import APIRouter, Depends, File, HTTPException, UploadFile
-from sqlalchemy import delete, select
-from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.config import app_config
+from app.core.middleware import job_id_contextvar
+from app.utils.ingestion_pipeline import ingest_pdf
+from app.utils.ingestion_utils import UploadTooLargeError, ingestion_queue, spool_upload
+from app.utils.jobs import Job
+from fastapi import APIRouter, File, HTTPException, UploadFile
 
 logger = getLogger(__name__)
 
 ingest_document_router = APIRouter()
 
+QUEUE_FULL_DETAIL = "Too many documents waiting to be ingested, retry later."
 
-@ingest_document_router.post("/v1/ingest_document")
+
+async def receive_upload(file: UploadFile) -> Tuple[str, str]:
+    """Copy an uploaded PDF file to disk (never holding it in memory), and hash it.
+
+    Returns
+    -------
+    Tuple[str, str]
+        The path of the spooled file (see `spool_upload`), and its SHA-256 hash.
+    """
+    max_bytes = app_config.INGEST_MAX_UPLOAD_BYTES
+    too_large_detail = f"Uploaded file is larger than the maximum of {max_bytes} bytes."
+    if file.size is not None and file.size > max_bytes:
+        raise HTTPException(status_code=413, detail=too_large_detail)
+    try:
+        pdf_path, n_bytes, content_hash = await asyncio.to_thread(
+            spool_upload, file.file, max_bytes
+        )
+    except UploadTooLargeError:
+        raise HTTPException(status_code=413, detail=too_large_detail)
+    finally:
+        await file.close()
+    if n_bytes == 0:
+        os.remove(pdf_path)
+        raise HTTPException(status_code=400, detail="Uploaded file is empty or invalid.")
+
+    return pdf_path, content_hash
+
+
+def check_ingestion_capacity(n_jobs: int) -> None:
+    """Raise a 503 error unless n_jobs ingestion jobs can be queued right now.
+
+    Jobs queued without awaiting anything after this check are guaranteed to fit.
+    """
+    if ingestion_queue.free_slots() < n_jobs:
+        raise HTTPException(status_code=503, detail=QUEUE_FULL_DETAIL)
+
+
+def queue_ingestion(
+    job: Job, pdf_path: str, content_hash: Optional[str] = None, incremental: bool = True
+) -> None:
+    """Queue the ingestion job of a spooled PDF file (deleted if it cannot be queued)."""
+    try:
+        ingestion_queue.submit(
+            job,
+            functools.partial(
+                ingest_pdf, pdf_path=pdf_path, incremental=incremental, content_hash=content_hash
+            ),
+        )
+    except asyncio.QueueFull:
+        os.remove(pdf_path)
+        raise HTTPException(status_code=503, detail=QUEUE_FULL_DETAIL)
+    logger.info(f"Queued ingestion job {job.job_id} for doc_name: {job.doc_name}")
+
+
+@ingest_document_router.post("/v1/ingest_document", status_code=202, response_model=Job)
 async def ingest_document(
     file: UploadFile = File(...),  # noqa: B008
-    db: AsyncSession = Depends(get_db_session),  # noqa: B008
+    incremental: bool = True,
 ):
-    """Ingest a document into the database.
+    """Queue a document for ingestion into the database.
 
     Breakdown:
-    1) Receive PDF file
-    2) Parse/Chunk document
-    3) Embed each chunk
-    4) Replace existing doc_name data or inserts new
-    5) Return success
+    1) Receive PDF file, and copy it to disk block by block (never holding it in memory)
+    2) Queue an ingestion job (parse/chunk, embed, write) for a background worker
+    3) Return the job, whose progress can be followed at /v1/jobs/{job_id}
     """
-    pdf_bytes = await file.read()
     doc_name = file.filename
     logger.info(f"Ingesting document with doc_name: {doc_name}")
-    if not pdf_bytes:
-        raise HTTPException(status_code=400, detail="Uploaded file is empty or invalid.")
-    await file.close()
-
-    # Parse & chunk
-    logger.info("Parsing and chunking the document...")
-    chunker = HybridChunker()
-    # Run parsing in a separate thread, because it's slow (CPU-bound)
-    chunk_objects = await asyncio.to_thread(
-        parse_and_chunk_pdf,
-        pdf_filename=file.filename,
-        pdf_bytes=pdf_bytes,
-        chunker=chunker,
-        logger=logger,
-    )
-    logger.info("Successfully parsed and chunked the document.")
-
-    # Single transaction
-    logger.info("Start transaction: Inserting new rows into Chunk table...")
-    try:
-        # Check if doc_name already exists
-        select_query = select(Chunk).filter(Chunk.doc_name == doc_name)
-        existing = (await db.execute(select_query)).scalars().first()
-        if existing:
-            # Delete old rows with this doc_name
-            delete_query = delete(Chunk).filter(Chunk.doc_name == doc_name)
-            await db.execute(delete_query)
-
-        # Insert new chunk rows with their embeddings
-        # 1. Create embedding tasks to run asynchronously
-        async_tasks = []
-        serialized_chunks = []
-        for chunk_obj in chunk_objects:
-            serialized_chunk = chunker.serialize(chunk=chunk_obj)
-            serialized_chunks.append(serialized_chunk)
-            async_tasks.append(embed_text(serialized_chunk))
-        # 2. Run tasks concurrently
-        logger.info(f"Started embedding {len(async_tasks)} chunks...")
-        embeddings = await asyncio.gather(*async_tasks)
-        logger.info(f"Successfully embedded all {len(embeddings)} chunks.")
-        # 3. Create and add new rows to the database
-        for chunk_obj, serialized_chunk, embedding_vector in zip(
-            chunk_objects, serialized_chunks, embeddings
-        ):
-            pages = sorted(
-                {prov.page_no for item in chunk_obj.meta.doc_items for prov in item.prov}
-            )
-            new_row = Chunk(
-                doc_name=doc_name,
-                section_headers=list(chunk_obj.meta.headings or []),
-                pages=pages,
-                serialized_chunk=serialized_chunk,
-                embedding=embedding_vector,
-            )
-            logger.info(f"Adding new row: {new_row}")
-            db.add(new_row)
-
-        await db.commit()
-    except Exception as e:
-        logger.error(f"Error inserting new rows into Chunk table: {str(e)}")
-        await db.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-
-    logger.info(f"Successfully inserted {len(chunk_objects)} new rows into Chunk table.")
-
-    return {"status": "success", "doc_name": doc_name}
+    pdf_path, content_hash = await receive_upload(file)
+
+    # Re-use the request's job ID, so that the logs of the job are tied to this request
+    job = Job(job_id=job_id_contextvar.get(), doc_name=doc_name)
+    queue_ingestion(job, pdf_path, content_hash=content_hash, incremental=incremental)
+
+    return job
@@ -0,0 +1,65 @@
+"""Endpoint for ingesting several documents in the database."""
+import os
+from logging import getLogger
+from typing import List
+
+from app.api.v1.ingest_document import (
+    check_ingestion_capacity,
+    queue_ingestion,
+    receive_upload,
+)
+from app.core.middleware import job_id_contextvar
+from app.utils.jobs import Job
+from fastapi import APIRouter, File, HTTPException, UploadFile
+
+logger = getLogger(__name__)
+
+ingest_documents_router = APIRouter()
+
+
+@ingest_documents_router.post("/v1/ingest_documents", status_code=202, response_model=List[Job])
+async def ingest_documents(
+    files: List[UploadFile] = File(...),  # noqa: B008
+    incremental: bool = True,
+):
+    """Queue several documents for ingestion into the database.
+
+    The documents go through the ingestion pipeline together: the parsing of a document
+    overlaps with the embedding and writing of the others.
+
+    Breakdown:
+    1) Receive all PDF files, and copy them to disk block by block
+    2) Queue an ingestion job for each of them
+    3) Return the jobs, whose progress can be followed at /v1/jobs/{job_id}
+    """
+    doc_names = [file.filename for file in files]
+    if len(set(doc_names)) < len(doc_names):
+        raise HTTPException(status_code=400, detail="Uploaded files must have distinct names.")
+    logger.info(f"Ingesting {len(files)} documents: {doc_names}")
+
+    # 1. Receive all files first, not to queue some documents and reject others
+    spooled = []
+    try:
+        for file in files:
+            pdf_path, content_hash = await receive_upload(file)
+            spooled.append((file.filename, pdf_path, content_hash))
+    except BaseException:
+        for _, pdf_path, _ in spooled:
+            os.remove(pdf_path)
+        raise
+
+    # 2. Queue the ingestion of the documents, with job IDs tied to this request (all or
+    # none of them: nothing is awaited between the capacity check and the queueing)
+    try:
+        check_ingestion_capacity(len(spooled))
+    except HTTPException:
+        for _, pdf_path, _ in spooled:
+            os.remove(pdf_path)
+        raise
+    jobs = []
+    for i, (doc_name, pdf_path, content_hash) in enumerate(spooled):
+        job = Job(job_id=f"{job_id_contextvar.get()}-{i}", doc_name=doc_name)
+        queue_ingestion(job, pdf_path, content_hash=content_hash, incremental=incremental)
+        jobs.append(job)
+
+    return jobs
@@ -0,0 +1,18 @@
+"""Endpoint for checking the status of background jobs."""
+from logging import getLogger
+
+from app.utils.ingestion_utils import ingestion_queue
+from app.utils.jobs import Job
+from fastapi import APIRouter, HTTPException
+
+logger = getLogger(__name__)
+jobs_router = APIRouter()
+
+
+@jobs_router.get("/v1/jobs/{job_id}", status_code=200, response_model=Job)
+async def get_job(job_id: str):
+    """Return the stage, chunk counts and timings of an ingestion job."""
+    job = ingestion_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job
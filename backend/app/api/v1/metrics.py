@@ -0,0 +1,17 @@
+"""Endpoint exposing the Prometheus metrics of the application."""
+from fastapi import APIRouter, Request, Response
+from prometheus_client import REGISTRY
+from prometheus_client.exposition import choose_encoder
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    """Return the metrics, in the Prometheus text format.
+
+    Exemplars (the job IDs of the requests behind latency observations) are only part of
+    the OpenMetrics format, returned when asked for in the Accept header.
+    """
+    encoder, content_type = choose_encoder(request.headers.get("accept"))
+    return Response(content=encoder(REGISTRY), media_type=content_type)
@@ -1,27 +1,114 @@
-"""Endpoint for querying the database."""
+"""Endpoints for querying the database."""
 import json
+import re
 from logging import getLogger
-from typing import List, Optional
+from typing import AsyncIterator, List, Literal, NamedTuple, Optional, Tuple
 
 import app.utils.ai_prompts as ai_prompts
-from app.db.models import Chunk
-from app.db.session import get_db_session
-from app.utils.ai_utils import embed_text, get_answer_from_llm
+import numpy as np
+from app.core.config import app_config
+from app.core.metrics import stage_timer
+from app.db.retrieval import ChunkFilters, RetrievedChunk, search_chunks
+from app.db.session import get_corpus_version, get_db_session
+from app.utils.ai_utils import get_answer_from_llm, stream_answer_from_llm
+from app.utils.cache import LRUCache, SemanticCache
+from app.utils.context_utils import assemble_contexts, format_context, get_fetch_size
+from app.utils.embedding_cache import get_embedding
 from fastapi import APIRouter, Depends, HTTPException
-from pydantic import BaseModel
-from sqlalchemy import select
+from fastapi.responses import StreamingResponse
+from jiter import from_json
+from pydantic import BaseModel, Field, PositiveInt, field_validator
 from sqlalchemy.ext.asyncio import AsyncSession
 
 logger = getLogger(__name__)
 
 query_router = APIRouter()
 
+# Normalized user question -> query generated for the retriever
+_retriever_query_cache = LRUCache(
+    maxsize=app_config.QUERY_REWRITE_CACHE_SIZE, ttl=app_config.QUERY_REWRITE_CACHE_TTL
+)
+# Embedding of a user question -> response, for the current version of the corpus.
+# Lookups embed the question itself: with query rewriting, that is one more embeddings
+# request per cache miss (the embedding is re-used for retrieval without rewriting)
+_answer_cache = SemanticCache(
+    maxsize=app_config.ANSWER_CACHE_SIZE,
+    dim=app_config.EMBEDDING_DIM,
+    threshold=app_config.ANSWER_CACHE_SIMILARITY_THRESHOLD,
+)
 
-class QueryRequest(BaseModel):
-    """Model for the request to the query endpoint."""
+# Maximum number of pages covered by the page ranges of a query
+MAX_FILTER_PAGES = 10_000
+# Maximum number of contexts of a query
+MAX_TOP_K = 100
+
+
+class QueryOptions(BaseModel):
+    """Model for the retrieval options of the requests to the query endpoints."""
+
+    top_k: int = Field(default=10, ge=1, le=MAX_TOP_K)
+    # Recall knobs of the vector index (HNSW / IVFFlat), defaults are taken from config
+    ef_search: Optional[int] = Field(default=None, ge=1, le=1_000)
+    probes: Optional[int] = Field(default=None, ge=1)
+    # Whether to rewrite the question with the LLM before retrieval (default from config),
+    # rather than embedding the question as is
+    rewrite_query: Optional[bool] = None
+    # Vector search alone, or fused with full-text search (default from config)
+    retrieval_mode: Optional[Literal["vector", "hybrid"]] = None
+    # Filters on the searched chunks (a chunk must pass each of the given filters):
+    # its doc_name is one of doc_names, one of its pages is in one of the (first, last)
+    # page ranges, one of its section headers is one of section_headers
+    doc_names: Optional[List[str]] = None
+    page_ranges: Optional[List[Tuple[PositiveInt, PositiveInt]]] = None
+    section_headers: Optional[List[str]] = None
+    # Diversification of the contexts by maximal marginal relevance, among
+    # top_k * mmr_fetch_factor candidates (at most MMR_MAX_CANDIDATES): trade-off between
+    # relevance (1.0: no diversification) and diversity (0.0). Defaults are taken from config
+    mmr_lambda: Optional[float] = Field(default=None, ge=0.0, le=1.0)
+    mmr_fetch_factor: Optional[int] = Field(default=None, ge=1, le=10)
+    # Maximum number of tokens of the contexts in the answer prompt (default from config)
+    context_token_budget: Optional[PositiveInt] = None
+
+    @field_validator("page_ranges")
+    def validate_page_ranges(cls, value):
+        """Validate the page ranges value."""
+        if value is None:
+            return value
+        if any(first > last for first, last in value):
+            raise ValueError("Invalid page range: first page must not be after last page.")
+        if sum(last - first + 1 for first, last in value) > MAX_FILTER_PAGES:
+            raise ValueError(f"Page ranges must not cover more than {MAX_FILTER_PAGES} pages.")
+        return value
+
+    def get_filters(self) -> ChunkFilters:
+        """Return the filters on the searched chunks."""
+        return ChunkFilters(
+            doc_names=self.doc_names or [],
+            page_ranges=self.page_ranges or [],
+            section_headers=self.section_headers or [],
+        )
+
+    def get_mmr_lambda(self) -> float:
+        """Return the MMR trade-off between relevance and diversity of the contexts."""
+        return app_config.MMR_LAMBDA if self.mmr_lambda is None else self.mmr_lambda
+
+    def get_fetch_size(self) -> int:
+        """Return the number of candidates to retrieve, to select top_k contexts from."""
+        return get_fetch_size(
+            self.top_k,
+            self.get_mmr_lambda(),
+            self.mmr_fetch_factor or app_config.MMR_FETCH_FACTOR,
+        )
+
+    def get_context_token_budget(self) -> Optional[int]:
+        """Return the maximum number of tokens of the contexts (None for no limit)."""
+        return self.context_token_budget or app_config.CONTEXT_TOKEN_BUDGET
+
+
+class QueryRequest(QueryOptions):
+    """Model for the request to the query endpoints."""
 
     query: str
-    top_k: Optional[int] = 10
 
 
 class QueryResponse(BaseModel):
@@ -39,21 +126,33 @@ class LLMResponseModel(BaseModel):
     answer_sources: List[str]
 
 
-@query_router.post("/v1/query", response_model=QueryResponse)
-async def query_documents(
-    req: QueryRequest, db: AsyncSession = Depends(get_db_session)  # noqa: B008
-):
-    """Query a vector database and return an answer based on retrieved contexts.
+class RetrievedSource(BaseModel):
+    """Model for a retrieved context, as sent first by the streaming query endpoint."""
 
-    Breakdown:
-    1. Context Retrieval
-    2. Answer Generation
-    """
-    logger.info(f"Received query: {req.query}")
+    doc_name: str
+    chunk_id: int
+    section_headers: List[str]
+    pages: List[int]
+    cosine_similarity: float
+
+
+def normalize_question(question: str) -> str:
+    """Normalize a question for caching, so that trivially different questions share entries."""
+    return re.sub(r"\s+", " ", question).strip().casefold()
+
+
+async def generate_retriever_query(user_question: str) -> str:
+    """Rewrite the user question into a query for the retriever, consulting the cache."""
+    cache_key = (normalize_question(user_question), app_config.OPENAI_TEXT_GENERATION_MODEL)
+    retriever_query = _retriever_query_cache.get(cache_key)
+    logger.info(
+        f"Retriever query cache {'hit' if retriever_query is not None else 'miss'} "
+        f"(hit rate: {_retriever_query_cache.hit_rate:.1%})."
+    )
+    if retriever_query is not None:
+        logger.info(f"Cached query for retriever: {retriever_query}")
+        return retriever_query
 
-    # 1. Context Retrieval
-    # 1.1 Generate query
-    user_question = req.query
     conversation = [
         {
             "role": "user",
@@ -65,81 +164,341 @@ async def query_documents(
         conversation=json.dumps(conversation, indent=2)
     )
     try:
-        retriever_query = await get_answer_from_llm(
-            system_prompt, user_prompt, llm_response_model=None
-        )
+        with stage_timer("query", "rewrite"):
+            retriever_query = await get_answer_from_llm(
+                system_prompt, user_prompt, llm_response_model=None
+            )
         logger.info(f"Generated query for retriever: {retriever_query}")
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error calling GPT model: {str(e)}")
+    _retriever_query_cache.put(cache_key, retriever_query)
 
-    # 1.2 Embed the query
-    try:
-        retriever_query_embedding = await embed_text(retriever_query)
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error embedding query: {str(e)}")
+    return retriever_query
 
-    # 2.2 Search vector database using the query embedding
-    # We'll use .l2_distance(query_embedding) and order_by ascending
-    distance = Chunk.embedding.l2_distance(retriever_query_embedding)
-    select_query = (
-        select(Chunk, distance.label("l2_distance")).order_by(distance.asc()).limit(req.top_k)
-    )
-    result = await db.execute(select_query)
-    top_distance_contexts = result.all()
+
+async def get_retriever_query(req: QueryRequest) -> str:
+    """Return the query for the retriever: the rewritten question, or the question itself."""
+    rewrite_query = req.rewrite_query
+    if rewrite_query is None:
+        rewrite_query = app_config.QUERY_REWRITE_ENABLED
+    if not rewrite_query:
+        logger.info("Skipping query rewriting, the question is used as query for retriever.")
+        return req.query
+
+    return await generate_retriever_query(req.query)
+
+
+def get_full_text_query(question: str, retriever_query: str) -> str:
+    """Return the text of the full-text search of a question (used in hybrid retrieval mode).
+
+    It has the words of both the question and the retriever query, as rewriting the
+    question may drop its exact identifiers (e.g. part numbers or error codes).
+    """
+    return question if retriever_query == question else f"{question} {retriever_query}"
+
+
+async def retrieve_contexts(
+    db: AsyncSession,
+    retriever_query: str,
+    req: QueryRequest,
+    question_embedding: Optional[np.ndarray] = None,
+) -> List[RetrievedChunk]:
+    """Return the contexts to answer from: up to top-k chunks closest to the retriever query.
+
+    Candidates are diversified and packed in the token budget (see `assemble_contexts`).
+    The embedding of the question, if already known, is re-used when the question is the
+    retriever query. The transaction of the session is ended before returning.
+    """
+    # Embed the query
+    if question_embedding is not None and retriever_query == req.query:
+        retriever_query_embedding = question_embedding
+    else:
+        try:
+            with stage_timer("query", "query_embed"):
+                retriever_query_embedding = await get_embedding(retriever_query)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Error embedding query: {str(e)}")
+
+    # Search the database using the query embedding (and the query text in hybrid mode)
+    with stage_timer("query", "vector_search"):
+        candidates = await search_chunks(
+            db,
+            query_embedding=retriever_query_embedding,
+            query_text=get_full_text_query(req.query, retriever_query),
+            top_k=req.get_fetch_size(),
+            retrieval_mode=req.retrieval_mode,
+            filters=req.get_filters(),
+            ef_search=req.ef_search,
+            probes=req.probes,
+        )
+    with stage_timer("query", "context_assembly"):
+        top_distance_contexts = await assemble_contexts(
+            db,
+            candidates,
+            top_k=req.top_k,
+            mmr_lambda=req.get_mmr_lambda(),
+            token_budget=req.get_context_token_budget(),
+        )
+    # End the (read-only) transaction, not to keep it open while the answer is generated
+    await db.commit()
 
     if not top_distance_contexts:
         logger.warning(f"No contexts found for query: {req.query}")
-        logger.warning(f"result: {vars(result)}")
-        return QueryResponse(
-            answer_text="UNANSWERABLE [No contexts found by Retriever]",
-            answer_sources=[],
-            top_k_retrieved=0,
-        )
 
-    # 2. Answer Generation
-    # 2.1 Format context
+    return top_distance_contexts
+
+
+def build_answer_prompts(
+    question: str, top_distance_contexts: List[RetrievedChunk]
+) -> Tuple[str, str]:
+    """Format the retrieved contexts into the (system, user) prompts for answering the question."""
     contexts = []
-    for i, (chunk, l2_dist) in enumerate(top_distance_contexts, start=1):
-        # Convert L2 distance to cosine similarity
-        # || a - b ||^2 = || a ||^2 + || b ||^2 - 2 * <a, b>
-        # And since we have normalized embeddings, || a || = || b || = 1, so:
-        # || a - b ||^2 = 2 - 2 * <a, b>
-        # And finally, notice that <a, b> = cosine similarity if a and b are normalized!
-        cosine_sim = 1 - l2_dist**2 / 2
-        snippet = (
-            f"Doc Name: {chunk.doc_name}, ChunkID: {chunk.chunk_id}, "
-            f"Headers: {chunk.section_headers}, Pages: {chunk.pages}\n"
-            f"{chunk.serialized_chunk}"
-        )
+    for i, chunk in enumerate(top_distance_contexts, start=1):
+        snippet = format_context(chunk)
         logger.info(
             f"Retrieved top-{i} context "
-            f"[L2-dist={l2_dist:.2f}; Cosine-sim={cosine_sim:.2f}]:\n{snippet}"
+            f"[L2-dist={chunk.l2_distance:.2f}; Cosine-sim={chunk.cosine_similarity:.2f}]:\n"
+            f"{snippet}",
+            extra={"payload": True},
         )
         contexts.append(snippet)
 
     logger.info(f"Done retrieving top-k (k={len(contexts)}) contexts")
 
-    # 2.2 Create prompt for LLM
     system_prompt = ai_prompts.QUESTION_ANSWERING_SYSTEM_PROMPT
     user_prompt = ai_prompts.QUESTION_ANSWERING_USER_PROMPT_TEMPLATE.format(
-        question=req.query, context="\n---------------------------------\n".join(contexts)
+        question=question, context="\n---------------------------------\n".join(contexts)
     )
 
-    # 2.3 Send request to LLM
+    return system_prompt, user_prompt
+
+
+class AnswerCacheKey(NamedTuple):
+    """Key of a response in the answer cache."""
+
+    embedding: np.ndarray
+    scope: str
+    version: int
+
+
+async def get_cached_answer(
+    db: AsyncSession, req: QueryRequest
+) -> Tuple[Optional[QueryResponse], Optional[AnswerCacheKey]]:
+    """Look up the response to a similar question in the answer cache.
+
+    Returns
+    -------
+    Tuple[Optional[QueryResponse], Optional[AnswerCacheKey]]
+        The cached response (None if not found), and the key to cache the response under
+        (None if the answer cache is disabled).
+    """
+    if _answer_cache.maxsize <= 0:
+        return None, None
+
+    # The corpus version is read before retrieval, so that a response is never cached
+    # under a version more recent than the chunks it was generated from
+    version = await get_corpus_version(db)
+    # End the (read-only) transaction, not to keep it open while the question is rewritten
+    await db.commit()
     try:
-        answer = await get_answer_from_llm(
-            system_prompt, user_prompt, llm_response_model=LLMResponseModel
-        )
+        question_embedding = await get_embedding(req.query)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error embedding question: {str(e)}")
+    # Responses also depend on the search parameters of the request
+    scope = json.dumps(req.model_dump(exclude={"query"}), sort_keys=True)
+    key = AnswerCacheKey(embedding=question_embedding, scope=scope, version=version)
+
+    response = _answer_cache.get(*key)
+    logger.info(
+        f"Answer cache {'hit' if response is not None else 'miss'} "
+        f"(corpus version: {version}, hit rate: {_answer_cache.hit_rate:.1%})."
+    )
+    return response, key
+
+
+def cache_answer(key: Optional[AnswerCacheKey], response: QueryResponse) -> None:
+    """Put a response in the answer cache (if enabled)."""
+    if key is not None:
+        _answer_cache.put(*key, response)
+
+
+def format_answer_text(retriever_query: str, answer_text: str) -> str:
+    """Return the answer text shown to the user."""
+    return f"[RAG QUERY] {retriever_query}\n[ANSWER] {answer_text}"
+
+
+NO_CONTEXTS_RESPONSE = QueryResponse(
+    answer_text="UNANSWERABLE [No contexts found by Retriever]",
+    answer_sources=[],
+    top_k_retrieved=0,
+)
+
+
+async def generate_answer(
+    question: str, retriever_query: str, top_distance_contexts: List[RetrievedChunk]
+) -> QueryResponse:
+    """Generate the answer to a question from the retrieved contexts."""
+    if not top_distance_contexts:
+        return NO_CONTEXTS_RESPONSE
+
+    system_prompt, user_prompt = build_answer_prompts(question, top_distance_contexts)
+    try:
+        with stage_timer("query", "generation"):
+            answer = await get_answer_from_llm(
+                system_prompt, user_prompt, llm_response_model=LLMResponseModel
+            )
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error calling GPT model: {str(e)}")
 
-    logger.info(f"Raw answer from LLM: {answer}")
+    logger.info(f"Raw answer from LLM: {answer}", extra={"payload": True})
 
     llm_answer = LLMResponseModel(**json.loads(answer))
-    answer_text = f"[RAG QUERY] {retriever_query}\n[ANSWER] {llm_answer.answer_text}"
 
     return QueryResponse(
-        answer_text=answer_text,
+        answer_text=format_answer_text(retriever_query, llm_answer.answer_text),
+        answer_sources=llm_answer.answer_sources,
+        top_k_retrieved=len(top_distance_contexts),
+    )
+
+
+@query_router.post("/v1/query", response_model=QueryResponse)
+async def query_documents(
+    req: QueryRequest, db: AsyncSession = Depends(get_db_session)  # noqa: B008
+):
+    """Query a vector database and return an answer based on retrieved contexts.
+
+    Breakdown:
+    0. Answer Cache lookup (answer of a similar question, on the same corpus)
+    1. Context Retrieval
+    2. Answer Generation
+    """
+    logger.info(f"Received query: {req.query}", extra={"payload": True})
+
+    # 0. Answer Cache lookup
+    cached_response, cache_key = await get_cached_answer(db, req)
+    if cached_response is not None:
+        return cached_response
+
+    # 1. Context Retrieval
+    retriever_query = await get_retriever_query(req)
+    top_distance_contexts = await retrieve_contexts(
+        db, retriever_query, req, question_embedding=cache_key and cache_key.embedding
+    )
+
+    # 2. Answer Generation
+    response = await generate_answer(req.query, retriever_query, top_distance_contexts)
+    cache_answer(cache_key, response)
+
+    return response
+
+
+# Headers of server-sent events responses (asking proxies not to buffer the events)
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def format_sse_event(event: str, data: dict) -> str:
+    """Format a server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def stream_cached_answer_events(response: QueryResponse) -> AsyncIterator[str]:
+    """Yield the server-sent event of a cached answer (see `query_documents_stream`)."""
+    yield format_sse_event("answer", response.model_dump())
+
+
+async def stream_answer_events(
+    question: str,
+    retriever_query: str,
+    top_distance_contexts: List[RetrievedChunk],
+    cache_key: Optional[AnswerCacheKey],
+) -> AsyncIterator[str]:
+    """Yield the server-sent events of a streamed answer (see `query_documents_stream`)."""
+    sources = [
+        RetrievedSource(
+            doc_name=chunk.doc_name,
+            chunk_id=chunk.chunk_id,
+            section_headers=chunk.section_headers,
+            pages=chunk.pages,
+            cosine_similarity=chunk.cosine_similarity,
+        ).model_dump()
+        for chunk in top_distance_contexts
+    ]
+    yield format_sse_event("sources", {"retriever_query": retriever_query, "sources": sources})
+    if not top_distance_contexts:
+        cache_answer(cache_key, NO_CONTEXTS_RESPONSE)
+        yield format_sse_event("answer", NO_CONTEXTS_RESPONSE.model_dump())
+        return
+
+    system_prompt, user_prompt = build_answer_prompts(question, top_distance_contexts)
+
+    # The LLM streams a JSON document: parse its partial content as it arrives, and send
+    # the new characters of the answer text (which comes first) as soon as they are known
+    answer = ""
+    n_sent = 0
+    try:
+        # Timed until the whole answer is streamed, i.e. including the time the client takes
+        # to read it, as the generation is paced by the reads of the response body
+        with stage_timer("query", "generation"):
+            async for content_delta in stream_answer_from_llm(
+                system_prompt, user_prompt, llm_response_model=LLMResponseModel
+            ):
+                if not content_delta:
+                    continue
+                answer += content_delta
+                partial_answer = from_json(answer.encode("utf-8"), partial_mode="trailing-strings")
+                answer_text = partial_answer.get("answer_text", "")
+                if len(answer_text) > n_sent:
+                    yield format_sse_event("token", {"text": answer_text[n_sent:]})
+                    n_sent = len(answer_text)
+        logger.info(f"Raw answer from LLM: {answer}", extra={"payload": True})
+        llm_answer = LLMResponseModel(**json.loads(answer))
+    except Exception as e:
+        # The response has already started: errors can only be reported as an event
+        logger.exception("Error streaming the answer from GPT model.")
+        yield format_sse_event("error", {"detail": f"Error calling GPT model: {str(e)}"})
+        return
+
+    response = QueryResponse(
+        answer_text=format_answer_text(retriever_query, llm_answer.answer_text),
         answer_sources=llm_answer.answer_sources,
         top_k_retrieved=len(top_distance_contexts),
     )
+    cache_answer(cache_key, response)
+    yield format_sse_event("answer", response.model_dump())
+
+
+@query_router.post("/v1/query_stream")
+async def query_documents_stream(
+    req: QueryRequest, db: AsyncSession = Depends(get_db_session)  # noqa: B008
+):
+    """Query a vector database and stream an answer based on retrieved contexts.
+
+    The response is a stream of server-sent events:
+    1. "sources": the retriever query and the retrieved contexts (doc name, pages, ...)
+    2. "token" (repeated): the next piece of the answer text, as generated by the LLM
+    3. "answer": the complete response, as returned by /v1/query
+       (or "error", if generating the answer failed)
+    If the answer is found in the answer cache, only the "answer" event is sent.
+    """
+    logger.info(f"Received streaming query: {req.query}", extra={"payload": True})
+
+    cached_response, cache_key = await get_cached_answer(db, req)
+    if cached_response is not None:
+        return StreamingResponse(
+            stream_cached_answer_events(cached_response),
+            media_type="text/event-stream",
+            headers=SSE_HEADERS,
+        )
+
+    # Retrieval is done before streaming, as the database session is closed once the
+    # response starts (and so that retrieval errors are still returned as HTTP errors)
+    retriever_query = await get_retriever_query(req)
+    top_distance_contexts = await retrieve_contexts(
+        db, retriever_query, req, question_embedding=cache_key and cache_key.embedding
+    )
+
+    return StreamingResponse(
+        stream_answer_events(req.query, retriever_query, top_distance_contexts, cache_key),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
@@ -0,0 +1,142 @@
+"""Endpoint for querying the database with many questions at once."""
+import asyncio
+from logging import getLogger
+from typing import List, Optional
+
+from app.api.v1.query import (
+    QueryOptions,
+    QueryRequest,
+    QueryResponse,
+    generate_answer,
+    get_full_text_query,
+    get_retriever_query,
+)
+from app.core.config import app_config
+from app.core.metrics import stage_timer
+from app.db.retrieval import search_chunks_batch
+from app.db.session import get_db_session
+from app.utils.context_utils import assemble_contexts_batch
+from app.utils.embedding_cache import get_embeddings
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel, Field
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = getLogger(__name__)
+
+query_batch_router = APIRouter()
+
+
+class QueryBatchRequest(QueryOptions):
+    """Model for the request to the batch query endpoint (options apply to all queries)."""
+
+    queries: List[str] = Field(min_length=1, max_length=app_config.QUERY_BATCH_MAX_QUERIES)
+
+
+class QueryBatchResult(BaseModel):
+    """Model for the result of one of the queries of a batch."""
+
+    query: str
+    response: Optional[QueryResponse] = None
+    error: Optional[str] = None
+
+
+class QueryBatchResponse(BaseModel):
+    """Model for the response from the batch query endpoint."""
+
+    results: List[QueryBatchResult]
+
+
+@query_batch_router.post("/v1/query_batch", response_model=QueryBatchResponse)
+async def query_documents_batch(
+    req: QueryBatchRequest, db: AsyncSession = Depends(get_db_session)  # noqa: B008
+):
+    """Query a vector database with many questions, and return their answers in order.
+
+    Breakdown:
+    1. Query Generation, for up to `QUERY_BATCH_CONCURRENCY` questions at a time
+    2. Embedding of all retriever queries, in as few embedding requests as possible
+    3. Context Retrieval for all queries, in a single SQL query (in "vector" mode), then
+       Context Assembly (diversification and token budget) for each of them
+    4. Answer Generation, for up to `QUERY_BATCH_CONCURRENCY` questions at a time
+
+    A question failing at some step gets an error in its result, without failing the
+    others. Unlike /v1/query, answers are not looked up in (nor added to) the answer cache.
+    """
+    logger.info(f"Received batch of {len(req.queries)} queries.")
+    options = req.model_dump(exclude={"queries"})
+    requests = [QueryRequest(query=query, **options) for query in req.queries]
+    errors: List[Optional[str]] = [None] * len(requests)
+    semaphore = asyncio.Semaphore(app_config.QUERY_BATCH_CONCURRENCY)
+
+    # 1. Query Generation
+    async def generate_query(i: int) -> Optional[str]:
+        async with semaphore:
+            try:
+                return await get_retriever_query(requests[i])
+            except HTTPException as e:
+                errors[i] = e.detail
+            except Exception as e:
+                errors[i] = str(e)
+
+    retriever_queries = await asyncio.gather(*(generate_query(i) for i in range(len(requests))))
+    indices = [i for i, error in enumerate(errors) if error is None]
+
+    # 2. Embedding (errors affect all queries, as they are embedded together)
+    try:
+        with stage_timer("query", "query_embed"):
+            embeddings, _ = await get_embeddings([retriever_queries[i] for i in indices])
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error embedding queries: {str(e)}")
+
+    # 3. Context Retrieval
+    with stage_timer("query", "vector_search"):
+        all_candidates = await search_chunks_batch(
+            db,
+            query_embeddings=embeddings,
+            query_texts=[
+                get_full_text_query(req.queries[i], retriever_queries[i]) for i in indices
+            ],
+            top_k=req.get_fetch_size(),
+            retrieval_mode=req.retrieval_mode,
+            filters=req.get_filters(),
+            ef_search=req.ef_search,
+            probes=req.probes,
+        )
+    with stage_timer("query", "context_assembly"):
+        all_top_distance_contexts = await assemble_contexts_batch(
+            db,
+            all_candidates,
+            top_k=req.top_k,
+            mmr_lambda=req.get_mmr_lambda(),
+            token_budget=req.get_context_token_budget(),
+        )
+    logger.info(f"Retrieved contexts for {len(indices)} queries.")
+    # End the (read-only) transaction, not to keep it open while answers are generated
+    await db.commit()
+
+    # 4. Answer Generation
+    async def answer(i: int, top_distance_contexts) -> Optional[QueryResponse]:
+        async with semaphore:
+            try:
+                return await generate_answer(
+                    req.queries[i], retriever_queries[i], top_distance_contexts
+                )
+            except HTTPException as e:
+                errors[i] = e.detail
+            except Exception as e:
+                errors[i] = str(e)
+
+    responses: List[Optional[QueryResponse]] = [None] * len(requests)
+    answers = await asyncio.gather(
+        *(answer(i, contexts) for i, contexts in zip(indices, all_top_distance_contexts))
+    )
+    for i, response in zip(indices, answers):
+        responses[i] = response
+    logger.info(f"Answered {sum(error is None for error in errors)}/{len(requests)} queries.")
+
+    return QueryBatchResponse(
+        results=[
+            QueryBatchResult(query=query, response=response, error=error)
+            for query, response, error in zip(req.queries, responses, errors)
+        ]
+    )
@@ -0,0 +1,37 @@
+"""Endpoint for rebuilding the vector index of the database."""
+from logging import getLogger
+
+from app.db.session import rebuild_vector_index as rebuild_index
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+
+logger = getLogger(__name__)
+rebuild_vector_index_router = APIRouter()
+
+
+class RebuildVectorIndexResponse(BaseModel):
+    """Model for the response from the rebuild_vector_index endpoint."""
+
+    status: str
+    index_name: str
+
+
+@rebuild_vector_index_router.post(
+    "/v1/rebuild_vector_index", status_code=200, response_model=RebuildVectorIndexResponse
+)
+async def rebuild_vector_index():
+    """Rebuild the vector index concurrently, without blocking ingestion or queries.
+
+    Useful after changing the index build parameters (e.g. `HNSW_M`), or after bulk
+    ingestion with IVFFlat, whose lists are computed from the rows present at build time.
+    """
+    logger.info("Rebuilding the vector index...")
+    try:
+        index_name = await rebuild_index()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error rebuilding the vector index: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return RebuildVectorIndexResponse(status="success", index_name=index_name)
@@ -0,0 +1,153 @@
+"""Endpoint for syncing the documents in the database with a manifest of documents."""
+import os
+from logging import getLogger
+from typing import Dict, List
+
+from app.api.v1.ingest_document import (
+    check_ingestion_capacity,
+    queue_ingestion,
+    receive_upload,
+)
+from app.core.middleware import job_id_contextvar
+from app.db.models import Document
+from app.db.session import get_db_session
+from app.utils.ingestion_utils import delete_documents
+from app.utils.jobs import Job
+from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = getLogger(__name__)
+
+sync_documents_router = APIRouter()
+
+
+class ManifestEntry(BaseModel):
+    """Model of a document of the manifest: its name and the SHA-256 hash of its file."""
+
+    doc_name: str
+    content_hash: str = Field(pattern=r"^[0-9a-f]{64}$")
+
+
+class SyncDocumentsResponse(BaseModel):
+    """Model for the response from the sync_documents endpoint."""
+
+    # Documents already ingested with the same content hash
+    unchanged: List[str]
+    # Documents not in the manifest, deleted from the database
+    deleted: List[str]
+    # Ingestion jobs of the uploaded new or changed documents
+    jobs: List[Job]
+    # New or changed documents whose file was not uploaded, or could not be queued (to
+    # upload in another request)
+    missing: List[str]
+
+
+def parse_manifest(manifest: str) -> Dict[str, str]:
+    """Parse the JSON manifest of documents into a {doc_name: content_hash} dict."""
+    try:
+        entries = TypeAdapter(List[ManifestEntry]).validate_json(manifest)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid manifest: {str(e)}")
+    hashes = {entry.doc_name: entry.content_hash for entry in entries}
+    if len(hashes) < len(entries):
+        raise HTTPException(status_code=400, detail="Invalid manifest: duplicate doc_name.")
+    return hashes
+
+
+@sync_documents_router.post(
+    "/v1/sync_documents", status_code=200, response_model=SyncDocumentsResponse
+)
+async def sync_documents(
+    manifest: str = Form(...),  # noqa: B008
+    files: List[UploadFile] = File(default=[]),  # noqa: B008
+    db: AsyncSession = Depends(get_db_session),  # noqa: B008
+):
+    """Make the documents in the database match a manifest, only ingesting what changed.
+
+    The manifest is a JSON list of {"doc_name", "content_hash"} objects, the hash being
+    the hex SHA-256 digest of the PDF file. Clients first send the manifest alone, then
+    upload the files of the `missing` documents along with the same manifest.
+
+    Breakdown:
+    1) Compare the manifest with the documents in the database
+    2) Receive the uploaded files of new or changed documents, checking their hashes
+    3) Delete the documents (and their chunks) which are not in the manifest
+    4) Queue an ingestion job for each uploaded document
+    """
+    manifest_hashes = parse_manifest(manifest)
+    uploads = {file.filename: file for file in files}
+    unexpected = sorted(set(uploads) - set(manifest_hashes))
+    if unexpected:
+        raise HTTPException(
+            status_code=400, detail=f"Uploaded files not in the manifest: {unexpected}."
+        )
+
+    # 1. Compare the manifest with the documents in the database
+    stored_hashes = dict((await db.execute(select(Document.doc_name, Document.content_hash))).all())
+    # End the (read-only) transaction, not to keep it open while files are uploaded
+    await db.commit()
+    unchanged, changed = [], []
+    for doc_name, content_hash in manifest_hashes.items():
+        if stored_hashes.get(doc_name) == content_hash:
+            unchanged.append(doc_name)
+        else:
+            changed.append(doc_name)
+    removed = sorted(set(stored_hashes) - set(manifest_hashes))
+    logger.info(
+        f"Syncing documents: {len(unchanged)} unchanged, {len(changed)} new or changed "
+        f"({len(uploads)} uploaded), {len(removed)} removed."
+    )
+
+    # 2. Receive the uploaded files
+    spooled = []
+    try:
+        for doc_name in changed:
+            if doc_name in uploads:
+                pdf_path, content_hash = await receive_upload(uploads[doc_name])
+                spooled.append((doc_name, pdf_path))
+                if content_hash != manifest_hashes[doc_name]:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Hash of uploaded file {doc_name} does not match the manifest.",
+                    )
+    except BaseException:
+        for _, pdf_path in spooled:
+            os.remove(pdf_path)
+        raise
+
+    # 3. Delete the removed documents, only if all the uploaded documents can be queued
+    try:
+        check_ingestion_capacity(len(spooled))
+        await delete_documents(removed)
+    except HTTPException:
+        for _, pdf_path in spooled:
+            os.remove(pdf_path)
+        raise
+    except Exception as e:
+        for _, pdf_path in spooled:
+            os.remove(pdf_path)
+        raise HTTPException(status_code=500, detail=f"Error deleting documents: {str(e)}")
+
+    # 4. Queue the ingestion of the uploaded documents, with job IDs tied to this request.
+    # Other requests may have filled the queue during the deletion: documents which cannot
+    # be queued anymore are reported as missing, to be uploaded again
+    jobs, rejected = [], []
+    for i, (doc_name, pdf_path) in enumerate(spooled):
+        job = Job(job_id=f"{job_id_contextvar.get()}-{i}", doc_name=doc_name)
+        try:
+            queue_ingestion(job, pdf_path, content_hash=manifest_hashes[doc_name])
+        except HTTPException:
+            rejected.append(doc_name)
+            continue
+        jobs.append(job)
+    if rejected:
+        logger.warning(f"Ingestion queue full, documents left to upload again: {rejected}")
+
+    return SyncDocumentsResponse(
+        unchanged=unchanged,
+        deleted=removed,
+        jobs=jobs,
+        missing=[doc_name for doc_name in changed if doc_name not in uploads] + rejected,
+    )
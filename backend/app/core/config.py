@@ -1,4 +1,6 @@
 """Set up app configuration from env variables."""
+from typing import Optional
+
 from pydantic import field_validator
 from pydantic_settings import BaseSettings
 
@@ -6,16 +8,84 @@ from pydantic_settings import BaseSettings
 class AppConfig(BaseSettings):
     """App configuration."""
 
+    # Routes served by the app: "all", "query" (query-only replicas, which never load the
+    # parsing models) or "ingest" (ingestion workers)
+    SERVING_MODE: str = "all"
     LOGGING_LEVEL: int = 1
+    LOGGING_FORMAT: str = "text"
+    LOGGING_QUEUE_ENABLED: bool = True
+    LOGGING_PAYLOAD_MAX_CHARS: Optional[int] = 2_000
+    LOGGING_PAYLOAD_SAMPLE_RATE: float = 1.0
     POSTGRES_HOST: str = "postgres"
     POSTGRES_PORT: int = 5432
     POSTGRES_DB: str
     POSTGRES_USER: str
     POSTGRES_PASSWORD: str
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1_800
+    DB_POOL_PRE_PING: bool = True
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    DB_COMMAND_TIMEOUT: Optional[float] = None
     OPENAI_API_KEY: str
+    # Base URL of an OpenAI-compatible API (e.g. the fake server of the benchmarks)
+    OPENAI_BASE_URL: Optional[str] = None
+    OPENAI_MAX_CONNECTIONS: int = 100
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    OPENAI_KEEPALIVE_EXPIRY: float = 30.0
+    OPENAI_CONNECT_TIMEOUT: float = 5.0
+    OPENAI_EMBEDDING_TIMEOUT: float = 30.0
+    OPENAI_CHAT_TIMEOUT: float = 120.0
+    OPENAI_MAX_RETRIES: int = 2
     OPENAI_TEXT_GENERATION_MODEL: str = "gpt-4o-mini"
     OPENAI_EMBEDDING_MODEL: str = "text-embedding-3-small"
     EMBEDDING_DIM: int = 1_536
+    EMBEDDING_BATCH_MAX_INPUTS: int = 256
+    EMBEDDING_BATCH_MAX_TOKENS: int = 250_000
+    EMBEDDING_INITIAL_CONCURRENCY: int = 4
+    EMBEDDING_MAX_CONCURRENCY: int = 16
+    EMBEDDING_MAX_RETRIES: int = 6
+    EMBEDDING_CACHE_LRU_SIZE: int = 4_096
+    QUERY_REWRITE_ENABLED: bool = True
+    QUERY_REWRITE_CACHE_SIZE: int = 1_024
+    QUERY_REWRITE_CACHE_TTL: Optional[float] = 3_600.0
+    ANSWER_CACHE_SIZE: int = 1_024
+    ANSWER_CACHE_SIMILARITY_THRESHOLD: float = 0.95
+    QUERY_BATCH_MAX_QUERIES: int = 1_000
+    QUERY_BATCH_CONCURRENCY: int = 8
+    DOCLING_POOL_SIZE: int = 2
+    DOCLING_PROCESS_POOL_SIZE: int = 2
+    DOCLING_SHARD_PAGES: int = 16
+    INGEST_MAX_WORKERS: int = 4
+    INGEST_PARSE_WORKERS: int = 2
+    INGEST_EMBED_WORKERS: int = 4
+    INGEST_PIPELINE_BATCH_SIZE: int = 64
+    INGEST_PIPELINE_QUEUE_SIZE: int = 16
+    INGEST_MAX_UPLOAD_BYTES: int = 256 * 1024**2
+    INGEST_MAX_INFLIGHT_BYTES: int = 1024**3
+    UPLOAD_SPOOL_DIR: Optional[str] = None
+    CHUNK_WRITER: str = "copy"
+    INGEST_QUEUE_MAX_SIZE: int = 100
+    INGEST_JOBS_RETENTION: int = 1_000
+    VECTOR_INDEX_TYPE: str = "hnsw"
+    HNSW_M: int = 16
+    HNSW_EF_CONSTRUCTION: int = 64
+    HNSW_EF_SEARCH: int = 40
+    IVFFLAT_LISTS: int = 100
+    IVFFLAT_PROBES: int = 1
+    VECTOR_ITERATIVE_SCAN: str = "relaxed_order"
+    VECTOR_STORAGE: str = "vector"
+    VECTOR_QUANTIZATION: str = "none"
+    BINARY_RERANK_FACTOR: int = 10
+    RETRIEVAL_MODE: str = "vector"
+    TEXT_SEARCH_CONFIG: str = "english"
+    HYBRID_CANDIDATES: int = 50
+    RRF_K: int = 60
+    MMR_LAMBDA: float = 0.7
+    MMR_FETCH_FACTOR: int = 3
+    MMR_MAX_CANDIDATES: int = 200
+    CONTEXT_TOKEN_BUDGET: Optional[int] = 8_000
 
     @property
     def POSTGRES_DATABASE_URL(self) -> str:
@@ -26,6 +96,25 @@ class AppConfig(BaseSettings):
             f"@{self.POSTGRES_HOST}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}"
         )
 
+    @property
+    def SERVES_QUERIES(self) -> bool:
+        """Whether the query endpoints are served."""
+        return self.SERVING_MODE in ("all", "query")
+
+    @property
+    def SERVES_INGESTION(self) -> bool:
+        """Whether the ingestion endpoints are served (and documents parsed)."""
+        return self.SERVING_MODE in ("all", "ingest")
+
+    @field_validator("SERVING_MODE")
+    def validate_serving_mode(cls, value):
+        """Validate the serving mode value."""
+        if value not in ["all", "query", "ingest"]:
+            raise ValueError(
+                f"Invalid serving mode {value}. Must be one of ['all', 'query', 'ingest']."
+            )
+        return value
+
     @field_validator("LOGGING_LEVEL")
     def validate_logging_level(cls, value):
         """Validate the logging level value."""
@@ -33,5 +122,80 @@ class AppConfig(BaseSettings):
             raise ValueError(f"Invalid log level {value}. Must be one of [0, 1, 2].")
         return value
 
+    @field_validator("LOGGING_FORMAT")
+    def validate_logging_format(cls, value):
+        """Validate the logging format value."""
+        if value not in ["text", "json"]:
+            raise ValueError(f"Invalid log format {value}. Must be one of ['text', 'json'].")
+        return value
+
+    @field_validator("LOGGING_PAYLOAD_SAMPLE_RATE")
+    def validate_logging_payload_sample_rate(cls, value):
+        """Validate the logging payload sample rate value."""
+        if not 0.0 <= value <= 1.0:
+            raise ValueError(f"Invalid payload sample rate {value}. Must be between 0 and 1.")
+        return value
+
+    @field_validator("CHUNK_WRITER")
+    def validate_chunk_writer(cls, value):
+        """Validate the chunk writer value."""
+        if value not in ["copy", "executemany"]:
+            raise ValueError(
+                f"Invalid chunk writer {value}. Must be one of ['copy', 'executemany']."
+            )
+        return value
+
+    @field_validator("VECTOR_INDEX_TYPE")
+    def validate_vector_index_type(cls, value):
+        """Validate the vector index type value."""
+        if value not in ["hnsw", "ivfflat", "none"]:
+            raise ValueError(
+                f"Invalid vector index type {value}. Must be one of ['hnsw', 'ivfflat', 'none']."
+            )
+        return value
+
+    @field_validator("VECTOR_ITERATIVE_SCAN")
+    def validate_vector_iterative_scan(cls, value):
+        """Validate the vector iterative scan value."""
+        if value not in ["off", "relaxed_order"]:
+            raise ValueError(
+                f"Invalid vector iterative scan {value}. Must be one of ['off', 'relaxed_order']."
+            )
+        return value
+
+    @field_validator("VECTOR_STORAGE")
+    def validate_vector_storage(cls, value):
+        """Validate the vector storage value."""
+        if value not in ["vector", "halfvec"]:
+            raise ValueError(
+                f"Invalid vector storage {value}. Must be one of ['vector', 'halfvec']."
+            )
+        return value
+
+    @field_validator("VECTOR_QUANTIZATION")
+    def validate_vector_quantization(cls, value):
+        """Validate the vector quantization value."""
+        if value not in ["none", "binary"]:
+            raise ValueError(
+                f"Invalid vector quantization {value}. Must be one of ['none', 'binary']."
+            )
+        return value
+
+    @field_validator("RETRIEVAL_MODE")
+    def validate_retrieval_mode(cls, value):
+        """Validate the retrieval mode value."""
+        if value not in ["vector", "hybrid"]:
+            raise ValueError(
+                f"Invalid retrieval mode {value}. Must be one of ['vector', 'hybrid']."
+            )
+        return value
+
+    @field_validator("MMR_LAMBDA")
+    def validate_mmr_lambda(cls, value):
+        """Validate the MMR lambda value."""
+        if not 0.0 <= value <= 1.0:
+            raise ValueError(f"Invalid MMR lambda {value}. Must be between 0 and 1.")
+        return value
+
 
 app_config = AppConfig()
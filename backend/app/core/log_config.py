@@ -1,9 +1,17 @@
 """Logging configuration."""
+import json
 import logging
+import logging.handlers
+import queue
 import sys
+import zlib
+from typing import Optional
 
 from app.core.middleware import job_id_contextvar
 
+# Listener writing the records of the queue handler, when logging through a queue
+_queue_listener: Optional[logging.handlers.QueueListener] = None
+
 
 class JobIDLogFilter(logging.Filter):
     """Logging filter to add the job ID to log records."""
@@ -15,17 +23,98 @@ class JobIDLogFilter(logging.Filter):
         return True
 
 
-def set_logging_options(level: int) -> None:
+class PayloadLogFilter(logging.Filter):
+    """Logging filter to sample and truncate the records of bulky payloads.
+
+    Payload records are the ones logged with `extra={"payload": True}` (retrieved
+    contexts, raw LLM answers, ...). They are kept for a `sample_rate` fraction of the
+    jobs (all payloads of a job are either kept or dropped), and their message is cut
+    to `max_chars` characters. Must run after `JobIDLogFilter`.
+
+    Parameters
+    ----------
+    max_chars : Optional[int]
+        Maximum number of characters of a payload message (None for no limit).
+    sample_rate : float
+        Fraction of the jobs whose payloads are logged, between 0 and 1.
+    """
+
+    def __init__(self, max_chars: Optional[int], sample_rate: float):
+        super().__init__()
+        self.max_chars = max_chars
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """Run log record filtering logic."""
+        if not getattr(record, "payload", False):
+            return True
+        if self.sample_rate < 1.0:
+            # Deterministic in the job ID, so that the payloads of a job are logged together
+            bucket = zlib.crc32(record.job_id.encode("utf-8")) % 10_000
+            if bucket >= self.sample_rate * 10_000:
+                return False
+        if self.max_chars is not None:
+            message = record.getMessage()
+            if len(message) > self.max_chars:
+                record.msg = (
+                    f"{message[: self.max_chars]}... "
+                    f"[{len(message) - self.max_chars} characters truncated]"
+                )
+                record.args = ()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Logging formatter writing each record as a JSON object on a single line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Format a log record as JSON."""
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "line": record.lineno,
+            "function": record.funcName,
+            "job_id": getattr(record, "job_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def set_logging_options(
+    level: int,
+    log_format: str = "text",
+    use_queue: bool = False,
+    payload_max_chars: Optional[int] = None,
+    payload_sample_rate: float = 1.0,
+) -> None:
     """Set the logging options based on the level parameter.
 
     Parameters
     ----------
     level : int
         Logging level. 0: WARNING, 1: INFO, 2: DEBUG
+    log_format : str
+        Format of the log lines: "text" (human-readable) or "json" (one object per line).
+    use_queue : bool
+        Whether records are put in a queue and written by a background thread, so that
+        logging never blocks the caller on a slow output (see `stop_logging`).
+    payload_max_chars : Optional[int]
+        Maximum number of characters of the bulky payload logs (see `PayloadLogFilter`).
+    payload_sample_rate : float
+        Fraction of the jobs whose bulky payloads are logged.
     """
+    global _queue_listener
+
     # Validate the level input
     if level not in [0, 1, 2]:
         raise ValueError(f"Invalid log level {level}. Must be one of [0, 1, 2].")
+    if log_format not in ["text", "json"]:
+        raise ValueError(f"Invalid log format {log_format}. Must be one of ['text', 'json'].")
 
     # Map the input level to logging constants
     level_mapping = {
@@ -36,23 +125,55 @@ def set_logging_options(level: int) -> None:
     log_level = level_mapping[level]
 
     # Remove all existing handlers from the root logger
+    stop_logging()
     for handler in logging.root.handlers[:]:
         logging.root.removeHandler(handler)
 
     # Formatting options
-    job_id_filter = JobIDLogFilter()
-    log_format = (
-        "%(asctime)s [%(levelname)s] %(name)s:%(lineno)d:%(funcName)s(): "
-        "[job_id=%(job_id)s] %(message)s"
-    )
     date_format = "%Y-%m-%d %H:%M:%S"
+    if log_format == "json":
+        formatter = JsonFormatter(datefmt=date_format)
+    else:
+        text_format = (
+            "%(asctime)s [%(levelname)s] %(name)s:%(lineno)d:%(funcName)s(): "
+            "[job_id=%(job_id)s] %(message)s"
+        )
+        formatter = logging.Formatter(fmt=text_format, datefmt=date_format)
 
     # Set the handlers
-    handlers = [logging.StreamHandler(sys.stdout)]
-    for handler in handlers:
-        handler.setFormatter(logging.Formatter(fmt=log_format, datefmt=date_format))
-        handler.addFilter(job_id_filter)
-        logging.root.addHandler(handler)
+    output_handler = logging.StreamHandler(sys.stdout)
+    output_handler.setFormatter(formatter)
+    if use_queue:
+        # Filters run in the logging thread (the job ID is read from its context), while
+        # the output handler runs in the listener thread
+        handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+        _queue_listener = logging.handlers.QueueListener(handler.queue, output_handler)
+        _queue_listener.start()
+    else:
+        handler = output_handler
+    handler.addFilter(JobIDLogFilter())
+    handler.addFilter(PayloadLogFilter(payload_max_chars, payload_sample_rate))
+    logging.root.addHandler(handler)
 
     # Set the logging level for the root logger to the mapped level
     logging.root.setLevel(log_level)
+
+
+def stop_logging() -> None:
+    """Write the records left in the logging queue, and stop its listener (if any).
+
+    Records logged afterwards are written directly, by the output handler of the listener.
+    """
+    global _queue_listener
+
+    if _queue_listener is None:
+        return
+    _queue_listener.stop()
+    (output_handler,) = _queue_listener.handlers
+    for handler in logging.root.handlers[:]:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            for log_filter in handler.filters:
+                output_handler.addFilter(log_filter)
+            logging.root.removeHandler(handler)
+            logging.root.addHandler(output_handler)
+    _queue_listener = None
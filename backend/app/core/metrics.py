@@ -0,0 +1,155 @@
+"""Prometheus metrics of the application, and per-request timings (Server-Timing header)."""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Dict, Iterator, Optional
+
+from app.core.middleware import job_id_contextvar
+from prometheus_client import Counter, Gauge, Histogram
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.routing import Match
+
+# Endpoint (route path template) of the current request, "background" outside of requests
+endpoint_contextvar: ContextVar[str] = ContextVar("endpoint", default="background")
+# Seconds spent in each stage by the current request, sent in its Server-Timing header
+request_timings_contextvar: ContextVar[Optional[Dict[str, float]]] = ContextVar(
+    "request_timings", default=None
+)
+
+# Buckets from 5ms (cache hits, index scans) to 2min (parsing of large documents)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUEST_DURATION = Histogram(
+    "rag_request_duration_seconds",
+    "Duration of HTTP requests, until the end of their response body.",
+    ["endpoint", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "rag_requests_in_flight", "Number of HTTP requests being processed.", ["endpoint"]
+)
+STAGE_DURATION = Histogram(
+    "rag_stage_duration_seconds",
+    "Duration of the stages of ingestion (parse, chunk, embed, write) and querying "
+    "(rewrite, query_embed, vector_search, generation).",
+    ["pipeline", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+OPENAI_TOKENS = Counter(
+    "rag_openai_tokens_total",
+    "Tokens used by OpenAI API requests.",
+    ["endpoint", "model", "kind"],
+)
+DB_POOL_WAIT = Histogram(
+    "rag_db_pool_wait_seconds",
+    "Time waited to check out a connection from the database pool.",
+    ["endpoint"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30),
+)
+
+
+def _exemplar() -> Optional[Dict[str, str]]:
+    """Return the exemplar labels tying an observation to its request or job, if any."""
+    job_id = job_id_contextvar.get()
+    return {"job_id": job_id} if job_id else None
+
+
+def observe_stage(pipeline: str, stage: str, seconds: float) -> None:
+    """Record the duration of a stage, in its histogram and in the current request timings."""
+    STAGE_DURATION.labels(pipeline, stage).observe(seconds, exemplar=_exemplar())
+    timings = request_timings_contextvar.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def stage_timer(pipeline: str, stage: str) -> Iterator[None]:
+    """Time the enclosed block as a stage of a pipeline (see `observe_stage`)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(pipeline, stage, time.perf_counter() - start)
+
+
+def record_openai_usage(model: str, usage) -> None:
+    """Count the tokens of an OpenAI API response (its `usage`, if reported)."""
+    if usage is None:
+        return
+    endpoint = endpoint_contextvar.get()
+    OPENAI_TOKENS.labels(endpoint, model, "prompt").inc(usage.prompt_tokens)
+    # Embedding responses have no completion tokens
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    if completion_tokens:
+        OPENAI_TOKENS.labels(endpoint, model, "completion").inc(completion_tokens)
+
+
+def observe_pool_wait(seconds: float) -> None:
+    """Record the time waited for a database connection."""
+    DB_POOL_WAIT.labels(endpoint_contextvar.get()).observe(seconds, exemplar=_exemplar())
+
+
+def format_server_timing(timings: Dict[str, float]) -> str:
+    """Format stage durations (in seconds) as a Server-Timing header value (in ms)."""
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+def get_route_path(request: Request) -> str:
+    """Return the path template of the route matching a request (bounded label values)."""
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+class MetricsMiddleware(BaseHTTPMiddleware):
+    """Middleware class recording the metrics of each request, and its Server-Timing header.
+
+    The header has the stages completed before the response starts: the stages of a
+    streamed response body are only recorded in the metrics.
+    """
+
+    async def dispatch(self, request: Request, call_next: Callable):
+        """Run middleware logic."""
+        endpoint = get_route_path(request)
+        if endpoint == "/metrics":
+            return await call_next(request)
+
+        endpoint_contextvar.set(endpoint)
+        timings = {}
+        request_timings_contextvar.set(timings)
+        in_flight = REQUESTS_IN_FLIGHT.labels(endpoint)
+        in_flight.inc()
+        start = time.perf_counter()
+        # The body may be sent after the job ID of the request is reset
+        exemplar = _exemplar()
+
+        def finish(status: int) -> None:
+            in_flight.dec()
+            REQUEST_DURATION.labels(endpoint, request.method, str(status)).observe(
+                time.perf_counter() - start, exemplar=exemplar
+            )
+
+        try:
+            response = await call_next(request)
+        except BaseException:
+            finish(500)
+            raise
+
+        if timings:
+            response.headers["Server-Timing"] = format_server_timing(timings)
+
+        # The request is in flight until its (possibly streamed) body is sent
+        body_iterator = response.body_iterator
+
+        async def body_with_metrics() -> AsyncIterator[bytes]:
+            try:
+                async for chunk in body_iterator:
+                    yield chunk
+            finally:
+                finish(response.status_code)
+
+        response.body_iterator = body_with_metrics()
+        return response
@@ -0,0 +1,63 @@
+"""Bulk writer of chunk rows."""
+from logging import getLogger
+from typing import List
+
+from app.core.config import app_config
+from app.db.models import Chunk
+from sqlalchemy import insert, sql
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = getLogger(__name__)
+
+# Columns written by the bulk writer (chunk_id is generated by the database)
+CHUNK_COLUMNS = (
+    "doc_name",
+    "section_headers",
+    "pages",
+    "serialized_chunk",
+    "content_hash",
+    "embedding",
+)
+
+
+async def _copy_chunks(db: AsyncSession, rows: List[dict]) -> None:
+    """Stream chunk rows into the chunks table with a binary COPY on the asyncpg connection."""
+    connection = await db.connection()
+    raw_connection = await connection.get_raw_connection()
+    asyncpg_connection = raw_connection.driver_connection
+
+    # The driver only opens the session's transaction on the first statement: make sure
+    # that the COPY runs inside it, rather than in autocommit mode
+    if not asyncpg_connection.is_in_transaction():
+        await db.execute(sql.text("SELECT 1"))
+
+    # Binary COPY needs the binary codecs of the vector types, set on each new connection
+    # (see `app.db.session`)
+    await asyncpg_connection.copy_records_to_table(
+        Chunk.__tablename__,
+        records=[tuple(row[column] for column in CHUNK_COLUMNS) for row in rows],
+        columns=CHUNK_COLUMNS,
+    )
+
+
+async def insert_chunks(db: AsyncSession, rows: List[dict]) -> None:
+    """Insert chunk rows in bulk, within the current transaction of the session.
+
+    Depending on `CHUNK_WRITER`, rows are streamed with a binary COPY ("copy") or sent as
+    a batched multi-row INSERT ("executemany"). Either way, nothing is committed: the rows
+    become visible together with the other changes of the transaction.
+
+    Parameters
+    ----------
+    db : AsyncSession
+        Database session, whose transaction the rows are written in.
+    rows : List[dict]
+        Chunk rows, each with one key for each of `CHUNK_COLUMNS`.
+    """
+    if not rows:
+        return
+    if app_config.CHUNK_WRITER == "copy":
+        await _copy_chunks(db, rows)
+    else:
+        await db.execute(insert(Chunk), [{c: row[c] for c in CHUNK_COLUMNS} for row in rows])
+    logger.debug(f"Wrote {len(rows)} rows into Chunk table with {app_config.CHUNK_WRITER}.")
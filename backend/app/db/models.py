@@ -1,19 +1,74 @@
 """ORM models for the database."""
 from app.core.config import app_config
 from app.db.base import Base
-from pgvector.sqlalchemy import Vector
-from sqlalchemy import Column, Integer, Text
+from pgvector.sqlalchemy import HALFVEC, Vector
+from sqlalchemy import Column, Computed, DateTime, Index, Integer, Sequence, Text, func
 from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import deferred
+
+# Type of the stored chunk embeddings: single-precision (vector) or half-precision (halfvec)
+EMBEDDING_TYPE = {"vector": Vector, "halfvec": HALFVEC}[app_config.VECTOR_STORAGE](
+    app_config.EMBEDDING_DIM
+)
+
+# Full-text search document of a chunk: its section headers (weighted higher) and its text.
+# array_to_string() is only STABLE, so generated columns call an IMMUTABLE wrapper of it
+# (created by init_db)
+SEARCH_TSV_EXPRESSION = (
+    f"setweight(to_tsvector('{app_config.TEXT_SEARCH_CONFIG}', "
+    "immutable_array_to_string(section_headers, ' ')), 'A') || "
+    f"setweight(to_tsvector('{app_config.TEXT_SEARCH_CONFIG}', "
+    "coalesce(serialized_chunk, '')), 'B')"
+)
 
 
 class Chunk(Base):
     """ORM model of a document chunk, including metadata and vector embedding."""
 
     __tablename__ = "chunks"
+    __table_args__ = (
+        Index("ix_chunks_doc_name_content_hash", "doc_name", "content_hash"),
+        Index("ix_chunks_search_tsv", "search_tsv", postgresql_using="gin"),
+        # Serve the filters on pages and section headers of retrieval queries
+        Index("ix_chunks_pages", "pages", postgresql_using="gin"),
+        Index("ix_chunks_section_headers", "section_headers", postgresql_using="gin"),
+    )
 
     chunk_id = Column(Integer, primary_key=True, index=True)
     doc_name = Column(Text, nullable=False, index=True)
     section_headers = Column(postgresql.ARRAY(Text), nullable=True)
     pages = Column(postgresql.ARRAY(Integer), nullable=True)
     serialized_chunk = Column(Text, nullable=True)
-    embedding = Column(Vector(app_config.EMBEDDING_DIM))
+    # Not loaded unless accessed: retrieval only needs distances, computed by the database
+    embedding = deferred(Column(EMBEDDING_TYPE))
+    # Hash of the chunk content and metadata, used to diff re-ingested documents
+    content_hash = Column(Text, nullable=True)
+    # Generated by the database, for full-text search (not loaded unless accessed)
+    search_tsv = deferred(Column(postgresql.TSVECTOR, Computed(SEARCH_TSV_EXPRESSION)))
+
+
+class Document(Base):
+    """ORM model of an ingested document, identified by the hash of its file."""
+
+    __tablename__ = "documents"
+
+    doc_name = Column(Text, primary_key=True)
+    # SHA-256 of the file, to tell whether a document changed since it was ingested
+    content_hash = Column(Text, nullable=False)
+    ingested_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class EmbeddingCache(Base):
+    """ORM model of a cached embedding, keyed by a hash of the embedding model and text."""
+
+    __tablename__ = "embedding_cache"
+
+    content_hash = Column(Text, primary_key=True)
+    model = Column(Text, nullable=False)
+    # Any dimension, as the cache keys already depend on EMBEDDING_DIM
+    embedding = Column(Vector(), nullable=False)
+
+
+# Version of the corpus (the set of chunks), incremented whenever chunks are written or
+# deleted, so that caches of query results can tell whether they are still valid
+corpus_version_seq = Sequence("corpus_version_seq", metadata=Base.metadata)
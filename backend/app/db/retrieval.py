@@ -0,0 +1,448 @@
+"""Retrieval of the chunks closest to a query, by vector search or hybrid search.
+
+Searches only select the columns needed to answer from the chunks (never their embeddings),
+and compute the similarity of the chunks to the query in the database.
+"""
+from dataclasses import dataclass, field
+from logging import getLogger
+from typing import List, Optional, Tuple
+
+import numpy as np
+from app.core.config import app_config
+from app.db.models import Chunk
+from app.db.session import set_vector_search_options
+from pgvector.sqlalchemy import BIT
+from pgvector.utils import Vector as VectorValue
+from sqlalchemy import (
+    Integer,
+    Text,
+    any_,
+    bindparam,
+    cast,
+    column,
+    func,
+    literal,
+    select,
+    true,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import ClauseElement, Select
+
+logger = getLogger(__name__)
+
+# Normalization of ts_rank_cd(): divide the rank by 1 + log(document length), so that long
+# chunks don't rank higher only because they contain more words
+TEXT_RANK_NORMALIZATION = 1
+
+
+@dataclass
+class ChunkFilters:
+    """Filters on the metadata of the chunks searched by a retrieval query.
+
+    A chunk passes the filters if it passes each of the (non-empty) filters:
+    its document is one of `doc_names`, one of its pages is within one of `page_ranges`,
+    and one of its section headers is one of `section_headers`.
+    """
+
+    doc_names: List[str] = field(default_factory=list)
+    # (first, last) pages, inclusive
+    page_ranges: List[Tuple[int, int]] = field(default_factory=list)
+    section_headers: List[str] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        """Return whether any filter is set."""
+        return bool(self.doc_names or self.page_ranges or self.section_headers)
+
+    def where_clauses(self) -> list:
+        """Return the WHERE clauses of the filters, served by the indexes of the chunks table."""
+        clauses = []
+        if self.doc_names:
+            doc_names = bindparam("doc_names", self.doc_names, type_=postgresql.ARRAY(Text))
+            clauses.append(Chunk.doc_name == any_(doc_names))
+        if self.page_ranges:
+            # The ranges are expanded into pages, so that the GIN index on pages can be used
+            pages = sorted({p for first, last in self.page_ranges for p in range(first, last + 1)})
+            pages = bindparam("pages", pages, type_=postgresql.ARRAY(Integer))
+            clauses.append(Chunk.pages.overlap(pages))
+        if self.section_headers:
+            section_headers = bindparam(
+                "section_headers", self.section_headers, type_=postgresql.ARRAY(Text)
+            )
+            clauses.append(Chunk.section_headers.overlap(section_headers))
+        return clauses
+
+
+@dataclass(slots=True)
+class RetrievedChunk:
+    """A chunk retrieved for a query, with its distance and similarity to the query."""
+
+    chunk_id: int
+    doc_name: str
+    section_headers: Optional[List[str]]
+    pages: Optional[List[int]]
+    serialized_chunk: Optional[str]
+    l2_distance: float
+    cosine_similarity: float
+    # Reciprocal rank fusion score (only in hybrid retrieval, see `hybrid_search`)
+    rrf_score: Optional[float] = None
+
+
+# Columns of the chunks table selected by searches (see `RetrievedChunk`)
+RETRIEVED_COLUMNS = (
+    Chunk.chunk_id,
+    Chunk.doc_name,
+    Chunk.section_headers,
+    Chunk.pages,
+    Chunk.serialized_chunk,
+)
+
+
+def _cosine_similarity(query_embedding):
+    """Return the cosine similarity between the chunk embeddings and a query embedding."""
+    return (1 - Chunk.embedding.cosine_distance(query_embedding)).label("cosine_similarity")
+
+
+def _query_embedding(query_embedding):
+    """Return a query embedding as a SQL expression of the type of the chunk embeddings."""
+    if isinstance(query_embedding, ClauseElement):
+        return query_embedding
+    return literal(query_embedding, type_=Chunk.embedding.type)
+
+
+def text_search_query(text: str):
+    """Return the full-text search query (tsquery) matching chunks containing any word of text.
+
+    Words are normalized as in `Chunk.search_tsv` (stemming, stop words, ...). Unlike
+    plainto_tsquery() and websearch_to_tsquery(), which require all words to match, any
+    word is enough (OR semantics): chunks matching more words rank higher.
+    """
+    config = cast(app_config.TEXT_SEARCH_CONFIG, postgresql.REGCONFIG)
+    all_words_query = cast(func.plainto_tsquery(config, text), Text)
+    return cast(func.replace(all_words_query, "&", "|"), postgresql.TSQUERY)
+
+
+def _binary_quantized(embedding):
+    """Return the binary quantization of an embedding, as indexed (see `app.db.session`)."""
+    return cast(func.binary_quantize(embedding), BIT(app_config.EMBEDDING_DIM))
+
+
+def index_candidates(n_chunks: int) -> int:
+    """Return the number of candidates the vector index must return for n_chunks results."""
+    if app_config.VECTOR_QUANTIZATION == "binary":
+        return n_chunks * app_config.BINARY_RERANK_FACTOR
+    return n_chunks
+
+
+def nearest_chunks(query_embedding, limit: int, filters: ChunkFilters) -> Select:
+    """Return the query selecting the (chunk_id, l2_distance) of the chunks nearest a query.
+
+    The query embedding is either an array, or a SQL expression (e.g. a column of another
+    table, for LATERAL subqueries). Rows are ordered by distance, ascending, so that the
+    approximate nearest-neighbour index can be used.
+
+    With binary quantization (`VECTOR_QUANTIZATION`), the index returns the
+    `limit * BINARY_RERANK_FACTOR` chunks nearest by Hamming distance between the
+    binary-quantized embeddings, which are then reranked by exact L2 distance.
+
+    The chunks table is never correlated, so that the query can be used as a subquery of
+    a query selecting from chunks too.
+    """
+    query_embedding = _query_embedding(query_embedding)
+    distance = Chunk.embedding.l2_distance(query_embedding)
+
+    if app_config.VECTOR_QUANTIZATION == "binary":
+        hamming_distance = _binary_quantized(Chunk.embedding).op("<~>")(
+            _binary_quantized(query_embedding)
+        )
+        shortlist = (
+            select(Chunk.chunk_id)
+            .filter(*filters.where_clauses())
+            .order_by(hamming_distance.asc())
+            .limit(index_candidates(limit))
+            .correlate_except(Chunk)
+        )
+        return (
+            select(Chunk.chunk_id, distance.label("l2_distance"))
+            .filter(Chunk.chunk_id.in_(shortlist))
+            .order_by(distance.asc())
+            .limit(limit)
+            .correlate_except(Chunk)
+        )
+
+    return (
+        select(Chunk.chunk_id, distance.label("l2_distance"))
+        .filter(*filters.where_clauses())
+        .order_by(distance.asc())
+        .limit(limit)
+        .correlate_except(Chunk)
+    )
+
+
+async def vector_search(
+    db: AsyncSession, query_embedding: np.ndarray, top_k: int, filters: ChunkFilters
+) -> List[RetrievedChunk]:
+    """Return the top_k chunks closest to the query embedding."""
+    query_embedding = _query_embedding(query_embedding)
+    nearest = nearest_chunks(query_embedding, top_k, filters).subquery("nearest")
+    select_query = select(
+        *RETRIEVED_COLUMNS, nearest.c.l2_distance, _cosine_similarity(query_embedding)
+    ).join(nearest, Chunk.chunk_id == nearest.c.chunk_id)
+    chunks = [RetrievedChunk(*row) for row in (await db.execute(select_query)).all()]
+
+    # Iterative index scans may return rows slightly out of order ("relaxed_order")
+    return sorted(chunks, key=lambda chunk: chunk.l2_distance)
+
+
+async def batch_vector_search(
+    db: AsyncSession, query_embeddings: List[np.ndarray], top_k: int, filters: ChunkFilters
+) -> List[List[RetrievedChunk]]:
+    """Return the top_k chunks closest to each of the query embeddings.
+
+    All the searches run in a single SQL query: the query embeddings are sent as one array,
+    unnested, and each of them is searched by a LATERAL subquery (served by the vector
+    index, as `vector_search` is).
+    """
+    # The embeddings are sent in text format, and cast to an array of the embeddings' type
+    embedding_type = Chunk.embedding.type
+    embeddings = bindparam(
+        "query_embeddings",
+        [VectorValue._to_db(embedding) for embedding in query_embeddings],
+        type_=postgresql.ARRAY(Text),
+    )
+    queries = (
+        func.unnest(cast(embeddings, postgresql.ARRAY(embedding_type)))
+        .table_valued(column("embedding", embedding_type), with_ordinality="i")
+        .render_derived(name="queries")
+    )
+    nearest = nearest_chunks(queries.c.embedding, top_k, filters).lateral("nearest")
+    select_query = (
+        select(
+            queries.c.i,
+            *RETRIEVED_COLUMNS,
+            nearest.c.l2_distance,
+            _cosine_similarity(queries.c.embedding),
+        )
+        .select_from(queries)
+        .join(nearest, true())
+        .join(Chunk, Chunk.chunk_id == nearest.c.chunk_id)
+    )
+
+    results = [[] for _ in query_embeddings]
+    for i, *columns in (await db.execute(select_query)).all():
+        # WITH ORDINALITY numbers rows from 1
+        results[i - 1].append(RetrievedChunk(*columns))
+    # Iterative index scans may return rows slightly out of order ("relaxed_order")
+    return [sorted(chunks, key=lambda chunk: chunk.l2_distance) for chunks in results]
+
+
+async def hybrid_search(
+    db: AsyncSession,
+    query_embedding: np.ndarray,
+    query_text: str,
+    top_k: int,
+    filters: ChunkFilters,
+) -> List[RetrievedChunk]:
+    """Return the top_k chunks best ranked by vector and full-text search.
+
+    Both searches return up to `HYBRID_CANDIDATES` chunks (served by the vector index and
+    the GIN index of `Chunk.search_tsv`), which are fused by reciprocal rank fusion (RRF):
+    a chunk scores sum(1 / (RRF_K + rank)) over the searches that returned it. Everything
+    runs in a single SQL query.
+    """
+    n_candidates = max(app_config.HYBRID_CANDIDATES, top_k)
+    rrf_k = app_config.RRF_K
+    query_embedding = _query_embedding(query_embedding)
+
+    # 1. Nearest neighbours of the query embedding
+    nearest = nearest_chunks(query_embedding, n_candidates, filters).subquery("nearest")
+    vector_ranks = select(
+        nearest.c.chunk_id,
+        func.row_number().over(order_by=nearest.c.l2_distance.asc()).label("rank"),
+    ).cte("vector_ranks")
+
+    # 2. Best full-text matches of the query text
+    tsquery = text_search_query(query_text)
+    text_rank = func.ts_rank_cd(Chunk.search_tsv, tsquery, TEXT_RANK_NORMALIZATION)
+    matching = (
+        select(Chunk.chunk_id, text_rank.label("text_rank"))
+        .filter(Chunk.search_tsv.op("@@")(tsquery), *filters.where_clauses())
+        .order_by(text_rank.desc())
+        .limit(n_candidates)
+        .subquery("matching")
+    )
+    text_ranks = select(
+        matching.c.chunk_id,
+        func.row_number().over(order_by=matching.c.text_rank.desc()).label("rank"),
+    ).cte("text_ranks")
+
+    # 3. Reciprocal rank fusion of both rankings
+    rrf_score = func.coalesce(1.0 / (rrf_k + vector_ranks.c.rank), 0.0) + func.coalesce(
+        1.0 / (rrf_k + text_ranks.c.rank), 0.0
+    )
+    fused = (
+        select(
+            func.coalesce(vector_ranks.c.chunk_id, text_ranks.c.chunk_id).label("chunk_id"),
+            rrf_score.label("rrf_score"),
+        )
+        .select_from(
+            vector_ranks.join(
+                text_ranks, vector_ranks.c.chunk_id == text_ranks.c.chunk_id, full=True
+            )
+        )
+        .cte("fused")
+    )
+    distance = Chunk.embedding.l2_distance(query_embedding)
+    select_query = (
+        select(
+            *RETRIEVED_COLUMNS,
+            distance.label("l2_distance"),
+            _cosine_similarity(query_embedding),
+            fused.c.rrf_score,
+        )
+        .join(fused, Chunk.chunk_id == fused.c.chunk_id)
+        .order_by(fused.c.rrf_score.desc(), distance.asc())
+        .limit(top_k)
+    )
+
+    return [RetrievedChunk(*row) for row in (await db.execute(select_query)).all()]
+
+
+async def search_chunks(
+    db: AsyncSession,
+    query_embedding: np.ndarray,
+    query_text: str,
+    top_k: int,
+    retrieval_mode: Optional[str] = None,
+    filters: Optional[ChunkFilters] = None,
+    ef_search: Optional[int] = None,
+    probes: Optional[int] = None,
+) -> List[RetrievedChunk]:
+    """Return the top_k chunks most relevant to a query.
+
+    Parameters
+    ----------
+    db : AsyncSession
+        Database session.
+    query_embedding : np.ndarray
+        Embedding of the query.
+    query_text : str
+        Text of the query, for full-text search (only used in "hybrid" mode).
+    top_k : int
+        Number of chunks to return.
+    retrieval_mode : Optional[str]
+        "vector" (nearest neighbours of the query embedding) or "hybrid" (fused with
+        full-text search results); defaults to `RETRIEVAL_MODE`.
+    filters : Optional[ChunkFilters]
+        Filters on the metadata of the chunks, applied within the search (not afterwards).
+    ef_search : Optional[int]
+        Size of the HNSW candidate list (see `set_vector_search_options`).
+    probes : Optional[int]
+        Number of IVFFlat lists to probe (see `set_vector_search_options`).
+
+    Returns
+    -------
+    List[RetrievedChunk]
+        The chunks, with their distance and similarity to the query, most relevant first.
+    """
+    retrieval_mode = retrieval_mode or app_config.RETRIEVAL_MODE
+    filters = filters or ChunkFilters()
+    if retrieval_mode == "vector":
+        n_candidates = top_k
+    elif retrieval_mode == "hybrid":
+        n_candidates = max(app_config.HYBRID_CANDIDATES, top_k)
+    else:
+        raise ValueError(f"Unsupported retrieval mode {retrieval_mode}.")
+
+    await set_vector_search_options(
+        db,
+        top_k=index_candidates(n_candidates),
+        ef_search=ef_search,
+        probes=probes,
+        filtered=bool(filters),
+    )
+    if retrieval_mode == "vector":
+        return await vector_search(db, query_embedding, top_k, filters)
+    return await hybrid_search(db, query_embedding, query_text, top_k, filters)
+
+
+async def search_chunks_batch(
+    db: AsyncSession,
+    query_embeddings: List[np.ndarray],
+    query_texts: List[str],
+    top_k: int,
+    retrieval_mode: Optional[str] = None,
+    filters: Optional[ChunkFilters] = None,
+    ef_search: Optional[int] = None,
+    probes: Optional[int] = None,
+) -> List[List[RetrievedChunk]]:
+    """Return the top_k chunks most relevant to each of several queries.
+
+    Same as `search_chunks` for each query, but in "vector" mode all queries are searched
+    in a single SQL query (see `batch_vector_search`). In "hybrid" mode, queries are
+    searched one after the other, in the same session.
+    """
+    retrieval_mode = retrieval_mode or app_config.RETRIEVAL_MODE
+    filters = filters or ChunkFilters()
+    if retrieval_mode != "vector":
+        return [
+            await search_chunks(
+                db, embedding, text, top_k, retrieval_mode, filters, ef_search, probes
+            )
+            for embedding, text in zip(query_embeddings, query_texts)
+        ]
+
+    await set_vector_search_options(
+        db,
+        top_k=index_candidates(top_k),
+        ef_search=ef_search,
+        probes=probes,
+        filtered=bool(filters),
+    )
+    return await batch_vector_search(db, query_embeddings, top_k, filters)
+
+
+async def chunk_similarities(db: AsyncSession, chunk_ids: List[List[int]]) -> List[np.ndarray]:
+    """Return the matrices of the pairwise cosine similarities between chunks, per group.
+
+    Similarities are computed by the database, in a single statement for all the groups
+    (e.g. the candidates of each query of a batch), so that embeddings are not sent back to
+    Python. Rows and columns of each matrix are in the order of the chunk_ids of its group.
+    """
+    groups, positions, flat_ids = [], [], []
+    for group, group_ids in enumerate(chunk_ids):
+        groups.extend([group] * len(group_ids))
+        positions.extend(range(1, len(group_ids) + 1))
+        flat_ids.extend(group_ids)
+    # unnest() of several arrays: a row of (group, position, chunk_id) per candidate
+    candidates = func.unnest(
+        bindparam("groups", groups, type_=postgresql.ARRAY(Integer)),
+        bindparam("positions", positions, type_=postgresql.ARRAY(Integer)),
+        bindparam("chunk_ids", flat_ids, type_=postgresql.ARRAY(Integer)),
+    ).table_valued(column("g", Integer), column("i", Integer), column("chunk_id", Integer))
+    left_ids = candidates.render_derived(name="left_ids")
+    right_ids = candidates.render_derived(name="right_ids")
+    left_chunk = aliased(Chunk, name="left_chunk")
+    right_chunk = aliased(Chunk, name="right_chunk")
+    similarity = 1 - left_chunk.embedding.cosine_distance(right_chunk.embedding)
+    select_query = (
+        select(
+            left_ids.c.g,
+            left_ids.c.i,
+            func.array_agg(aggregate_order_by(similarity, right_ids.c.i)),
+        )
+        .select_from(left_ids)
+        .join(left_chunk, left_chunk.chunk_id == left_ids.c.chunk_id)
+        .join(right_ids, right_ids.c.g == left_ids.c.g)
+        .join(right_chunk, right_chunk.chunk_id == right_ids.c.chunk_id)
+        .group_by(left_ids.c.g, left_ids.c.i)
+    )
+
+    similarities = [np.eye(len(group_ids)) for group_ids in chunk_ids]
+    for group, i, row in (await db.execute(select_query)).all():
+        # Chunks deleted since they were retrieved are missing: they are left dissimilar
+        if len(row) == len(chunk_ids[group]):
+            similarities[group][i - 1] = row
+    return similarities
@@ -1,25 +1,460 @@
 """Database session setup."""
+import re
+import time
+from logging import getLogger
+from typing import Callable, Optional
+
 from app.core.config import app_config
+from app.core.metrics import observe_pool_wait
 from app.db.base import Base
-from sqlalchemy import sql
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
-
-engine = create_async_engine(url=app_config.POSTGRES_DATABASE_URL, echo=False)
-AsyncSessionLocal = async_sessionmaker(
-    bind=engine, autocommit=False, autoflush=False, expire_on_commit=False
+from app.db.models import SEARCH_TSV_EXPRESSION, Chunk, corpus_version_seq
+from pgvector.utils import HalfVector, Vector
+from sqlalchemy import Text, cast, event, func, select, sql
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import (
+    AsyncConnection,
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
 )
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+logger = getLogger(__name__)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Connection pool recording how long each connection checkout waits (see metrics)."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            observe_pool_wait(time.perf_counter() - start)
+
+
+# Engine of the connection pool, created at startup in each worker process (see `init_engine`)
+engine: Optional[AsyncEngine] = None
+AsyncSessionLocal = async_sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False)
+
+
+def _binary_vector_encoder(vector_class: type) -> Callable:
+    """Return the binary encoder of a vector type, also accepting vectors in text format.
+
+    SQLAlchemy's vector types bind vectors in text format: they are parsed again here.
+    """
+
+    def encode(value):
+        if isinstance(value, str):
+            value = vector_class.from_text(value)
+        return vector_class._to_db_binary(value)
+
+    return encode
+
+
+async def _set_vector_codecs(asyncpg_connection) -> None:
+    """Exchange the vector types of pgvector in binary format on an asyncpg connection.
+
+    Binary COPY of chunks (see `app.db.chunk_writer`) needs it. Codecs are set once per
+    connection, as setting a codec clears the prepared statements cached on the connection.
+    """
+    for type_name, vector_class in (("vector", Vector), ("halfvec", HalfVector)):
+        try:
+            await asyncpg_connection.set_type_codec(
+                type_name,
+                schema="public",
+                encoder=_binary_vector_encoder(vector_class),
+                decoder=vector_class._from_db_binary,
+                format="binary",
+            )
+        except ValueError as e:
+            # The extension is not installed yet (see `init_db`, which re-opens connections)
+            if not str(e).startswith("unknown type"):
+                raise
+
+
+def _on_connect(dbapi_connection, connection_record) -> None:
+    """Set up a new connection of the pool."""
+    dbapi_connection.run_async(_set_vector_codecs)
+
+
+def init_engine() -> None:
+    """Create the engine and its connection pool, and bind the sessions to it.
+
+    The pool is created at startup rather than at import, so that each worker process
+    (e.g. `uvicorn --workers`) gets its own connections, and so that processes which
+    only import the app modules (e.g. the parsing workers) open no pool.
+    """
+    global engine
+
+    engine = create_async_engine(
+        url=app_config.POSTGRES_DATABASE_URL,
+        echo=False,
+        poolclass=TimedQueuePool,
+        pool_size=app_config.DB_POOL_SIZE,
+        max_overflow=app_config.DB_MAX_OVERFLOW,
+        pool_timeout=app_config.DB_POOL_TIMEOUT,
+        pool_recycle=app_config.DB_POOL_RECYCLE,
+        pool_pre_ping=app_config.DB_POOL_PRE_PING,
+        connect_args={
+            # Prepared statements cached per connection, by SQLAlchemy and by asyncpg
+            # (must be 0 behind a connection pooler in transaction mode, e.g. PgBouncer)
+            "prepared_statement_cache_size": app_config.DB_STATEMENT_CACHE_SIZE,
+            "statement_cache_size": app_config.DB_STATEMENT_CACHE_SIZE,
+            "command_timeout": app_config.DB_COMMAND_TIMEOUT,
+        },
+    )
+    event.listen(engine.sync_engine, "connect", _on_connect)
+    AsyncSessionLocal.configure(bind=engine)
+
+
+async def close_engine() -> None:
+    """Close the connections of the pool."""
+    global engine
+
+    if engine is not None:
+        await engine.dispose()
+        engine = None
+
+
+# Functions used by generated columns, which must exist before the tables are created
+SCHEMA_FUNCTIONS = [
+    "CREATE OR REPLACE FUNCTION immutable_array_to_string(arr text[], sep text) RETURNS text "
+    "LANGUAGE sql IMMUTABLE PARALLEL SAFE "
+    "AS $$ SELECT coalesce(array_to_string(arr, sep), '') $$",
+]
+
+# Schema changes for tables created by older versions of the app (create_all() only
+# creates missing tables, it doesn't add columns or indexes to existing ones)
+SCHEMA_MIGRATIONS = [
+    "ALTER TABLE chunks ADD COLUMN IF NOT EXISTS content_hash TEXT",
+    "CREATE INDEX IF NOT EXISTS ix_chunks_doc_name_content_hash ON chunks (doc_name, content_hash)",
+    "ALTER TABLE chunks ADD COLUMN IF NOT EXISTS search_tsv tsvector "
+    f"GENERATED ALWAYS AS ({SEARCH_TSV_EXPRESSION}) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_chunks_search_tsv ON chunks USING gin (search_tsv)",
+    "CREATE INDEX IF NOT EXISTS ix_chunks_pages ON chunks USING gin (pages)",
+    "CREATE INDEX IF NOT EXISTS ix_chunks_section_headers ON chunks USING gin (section_headers)",
+    # Documents ingested before the documents table existed, with an unknown file hash
+    "INSERT INTO documents (doc_name, content_hash) SELECT DISTINCT doc_name, '' FROM chunks "
+    "WHERE NOT EXISTS (SELECT 1 FROM documents) ON CONFLICT (doc_name) DO NOTHING",
+]
+
+# Name of the approximate nearest-neighbour index for each supported
+# (index type, vector quantization)
+VECTOR_INDEX_NAMES = {
+    ("hnsw", "none"): "chunks_embedding_hnsw_idx",
+    ("ivfflat", "none"): "chunks_embedding_ivfflat_idx",
+    ("hnsw", "binary"): "chunks_embedding_bq_hnsw_idx",
+    ("ivfflat", "binary"): "chunks_embedding_bq_ivfflat_idx",
+}
+
+
+def binary_quantized_embedding_sql() -> str:
+    """Return the SQL expression of the binary-quantized chunk embeddings.
+
+    Queries must use the exact same expression (see `app.db.retrieval`) for the index
+    on it to be used.
+    """
+    return f"(binary_quantize(embedding)::bit({app_config.EMBEDDING_DIM}))"
+
+
+def _vector_index_ddl(index_type: str, index_name: str, concurrently: bool = False) -> str:
+    """Return the CREATE INDEX statement for the approximate nearest-neighbour index.
+
+    The operator class must match the distance operator used in retrieval queries,
+    i.e. `vector_l2_ops` (or `halfvec_l2_ops`) for `Chunk.embedding.l2_distance(...)`,
+    otherwise Postgres silently falls back to a sequential scan. With binary
+    quantization, the index is on the binary-quantized embeddings, compared by Hamming
+    distance (`bit_hamming_ops`).
+    """
+    if index_type == "hnsw":
+        with_params = (
+            f"m = {app_config.HNSW_M}, ef_construction = {app_config.HNSW_EF_CONSTRUCTION}"
+        )
+    elif index_type == "ivfflat":
+        with_params = f"lists = {app_config.IVFFLAT_LISTS}"
+    else:
+        raise ValueError(f"Unsupported vector index type {index_type}.")
+
+    if app_config.VECTOR_QUANTIZATION == "binary":
+        indexed = f"{binary_quantized_embedding_sql()} bit_hamming_ops"
+    else:
+        indexed = f"embedding {app_config.VECTOR_STORAGE}_l2_ops"
+
+    return (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {index_name} "
+        f"ON {Chunk.__tablename__} USING {index_type} ({indexed}) "
+        f"WITH ({with_params})"
+    )
+
+
+async def _sync_vector_index(conn: AsyncConnection) -> None:
+    """Create the configured vector index, and drop the other ones."""
+    configured = (app_config.VECTOR_INDEX_TYPE, app_config.VECTOR_QUANTIZATION)
+    for (index_type, quantization), index_name in VECTOR_INDEX_NAMES.items():
+        if (index_type, quantization) == configured:
+            logger.info(f"Creating {index_type} vector index {index_name} (if not exists)...")
+            await conn.execute(sql.text(_vector_index_ddl(index_type, index_name)))
+        else:
+            await conn.execute(sql.text(f"DROP INDEX IF EXISTS {index_name}"))
+
+
+async def _get_column_type(conn: AsyncConnection, table_name: str, column_name: str) -> str:
+    """Return the type of a column, as formatted by Postgres (e.g. "vector(1536)")."""
+    result = await conn.execute(
+        sql.text(
+            "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+            "WHERE attrelid = to_regclass(:table_name) AND attname = :column_name "
+            "AND NOT attisdropped"
+        ),
+        {"table_name": table_name, "column_name": column_name},
+    )
+    return result.scalar_one()
+
+
+async def _migrate_search_tsv_column(conn: AsyncConnection) -> None:
+    """Drop the full-text search column if generated with another text search configuration.
+
+    The expression of a generated column cannot be altered (before Postgres 17): the column
+    (and its index) is dropped, to be added back by `SCHEMA_MIGRATIONS` with the current
+    expression, which recomputes it for all the chunks.
+    """
+    result = await conn.execute(
+        sql.text(
+            "SELECT pg_get_expr(adbin, adrelid) FROM pg_attrdef "
+            "JOIN pg_attribute ON attrelid = adrelid AND attnum = adnum "
+            "WHERE adrelid = to_regclass(:table_name) AND attname = 'search_tsv'"
+        ),
+        {"table_name": Chunk.__tablename__},
+    )
+    expression = result.scalar_one_or_none()
+    if expression is None:
+        return
+    # Configurations are formatted by Postgres in the expression, e.g. 'english'::regconfig
+    current_configs = set(re.findall(r"to_tsvector\('([^']*)'::regconfig", expression))
+    target_config = await conn.scalar(
+        select(cast(cast(app_config.TEXT_SEARCH_CONFIG, postgresql.REGCONFIG), Text))
+    )
+    if current_configs != {target_config}:
+        logger.info(
+            f"Recomputing the full-text search column from text search configuration "
+            f"{', '.join(sorted(current_configs))} to {target_config}..."
+        )
+        await conn.execute(sql.text(f"ALTER TABLE {Chunk.__tablename__} DROP COLUMN search_tsv"))
+
+
+async def _migrate_embedding_columns(conn: AsyncConnection) -> None:
+    """Convert the stored embeddings to the configured storage type and dimension.
+
+    Embeddings are converted in place: to half precision and back (`VECTOR_STORAGE`),
+    and to a lower dimension (`EMBEDDING_DIM`) by keeping their first components and
+    normalizing them, which is what the `dimensions` parameter of the text-embedding-3
+    models does. Embeddings cannot be converted to a higher dimension: documents must
+    then be deleted and ingested again.
+    """
+    target_type = f"{app_config.VECTOR_STORAGE}({app_config.EMBEDDING_DIM})"
+    current_type = await _get_column_type(conn, Chunk.__tablename__, "embedding")
+    if current_type != target_type:
+        current_dim = int(current_type.split("(")[1].rstrip(")"))
+        if current_dim < app_config.EMBEDDING_DIM:
+            raise ValueError(
+                f"Cannot convert stored embeddings of type {current_type} to {target_type}: "
+                "delete all chunks (or set EMBEDDING_DIM back) and ingest documents again."
+            )
+        using = "embedding::vector"
+        if current_dim > app_config.EMBEDDING_DIM:
+            using = f"l2_normalize(subvector({using}, 1, {app_config.EMBEDDING_DIM}))"
+        logger.info(f"Converting stored embeddings from {current_type} to {target_type}...")
+        # Vector indexes depend on the column type: they are re-created afterwards
+        for index_name in VECTOR_INDEX_NAMES.values():
+            await conn.execute(sql.text(f"DROP INDEX IF EXISTS {index_name}"))
+        await conn.execute(
+            sql.text(
+                f"ALTER TABLE {Chunk.__tablename__} ALTER COLUMN embedding "
+                f"TYPE {target_type} USING ({using})::{target_type}"
+            )
+        )
+
+    # The embedding cache accepts any dimension
+    if await _get_column_type(conn, "embedding_cache", "embedding") != "vector":
+        await conn.execute(
+            sql.text("ALTER TABLE embedding_cache ALTER COLUMN embedding TYPE vector")
+        )
+
+
+async def _check_schema(conn: AsyncConnection) -> None:
+    """Check that the database was initialized for the current configuration (see `init_db`)."""
+    for relation_name in [*Base.metadata.tables, corpus_version_seq.name]:
+        exists = await conn.scalar(select(func.to_regclass(relation_name).is_not(None)))
+        if not exists:
+            raise RuntimeError(
+                f"Relation {relation_name} does not exist: start a replica serving ingestion "
+                "first."
+            )
+    target_type = f"{app_config.VECTOR_STORAGE}({app_config.EMBEDDING_DIM})"
+    current_type = await _get_column_type(conn, Chunk.__tablename__, "embedding")
+    if current_type != target_type:
+        raise RuntimeError(
+            f"Stored embeddings are of type {current_type}, not {target_type}: start a "
+            "replica serving ingestion first, to migrate them."
+        )
 
 
 async def init_db():
-    """Initialize database with extensions and tables."""
+    """Initialize database with extensions and tables.
+
+    Workers and replicas starting together initialize the database one after the other
+    (the schema is then up to date for all but the first one). Query-only replicas
+    (`SERVING_MODE="query"`) run no DDL (which would take locks on each start): they only
+    check that the schema is up to date, and leave the initialization to the replicas
+    serving ingestion.
+    """
     async with engine.begin() as conn:
+        if not app_config.SERVES_INGESTION:
+            await _check_schema(conn)
+            return
+
+        # Serialize initializations (the lock is released at the end of the transaction)
+        await conn.execute(select(func.pg_advisory_xact_lock(func.hashtext("init_db"))))
+
         # 1. Install the pgvector extension
         await conn.execute(sql.text("CREATE EXTENSION IF NOT EXISTS vector"))
+        # Databases created with an older image may have an older version of the extension
+        # (iterative index scans need pgvector >= 0.8.0)
+        await conn.execute(sql.text("ALTER EXTENSION vector UPDATE"))
+        for statement in SCHEMA_FUNCTIONS:
+            await conn.execute(sql.text(statement))
 
         # 2. Create tables if they don't exist
         # Use run_sync() to run synchronous code in an async context!
         await conn.run_sync(Base.metadata.create_all)
 
+        # 3. Migrate existing tables to the current schema
+        await _migrate_search_tsv_column(conn)
+        for statement in SCHEMA_MIGRATIONS:
+            await conn.execute(sql.text(statement))
+
+        await _migrate_embedding_columns(conn)
+
+        # 4. Create the approximate nearest-neighbour index used for retrieval
+        await _sync_vector_index(conn)
+
+    # Re-open the connections opened before the extension was installed, without the
+    # codecs of its vector types (see `_set_vector_codecs`)
+    await engine.dispose()
+
+
+async def rebuild_vector_index() -> str:
+    """Rebuild the configured vector index without blocking reads and writes.
+
+    A new index is built with CREATE INDEX CONCURRENTLY (picking up the current
+    build parameters, e.g. `HNSW_M` or `IVFFLAT_LISTS`), and then swapped with the
+    existing one in a single transaction, so that the configured index name always
+    exists. Ingestion and queries keep running during the whole rebuild.
+
+    Returns
+    -------
+    str
+        Name of the rebuilt index.
+    """
+    index_type = app_config.VECTOR_INDEX_TYPE
+    if index_type == "none":
+        raise ValueError("No vector index is configured (VECTOR_INDEX_TYPE='none').")
+    index_name = VECTOR_INDEX_NAMES[(index_type, app_config.VECTOR_QUANTIZATION)]
+    new_index_name = f"{index_name}_new"
+    old_index_name = f"{index_name}_old"
+
+    # CONCURRENTLY statements cannot run inside a transaction block
+    autocommit_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
+    async with autocommit_engine.connect() as conn:
+        # Drop leftovers (i.e. invalid or swapped out indexes) of a previously failed rebuild
+        await conn.execute(sql.text(f"DROP INDEX CONCURRENTLY IF EXISTS {new_index_name}"))
+        await conn.execute(sql.text(f"DROP INDEX CONCURRENTLY IF EXISTS {old_index_name}"))
+        logger.info(f"Building {index_type} vector index {new_index_name} concurrently...")
+        await conn.execute(
+            sql.text(_vector_index_ddl(index_type, new_index_name, concurrently=True))
+        )
+    async with engine.begin() as conn:
+        await conn.execute(
+            sql.text(f"ALTER INDEX IF EXISTS {index_name} RENAME TO {old_index_name}")
+        )
+        await conn.execute(sql.text(f"ALTER INDEX {new_index_name} RENAME TO {index_name}"))
+    async with autocommit_engine.connect() as conn:
+        await conn.execute(sql.text(f"DROP INDEX CONCURRENTLY IF EXISTS {old_index_name}"))
+    logger.info(f"Successfully rebuilt {index_type} vector index {index_name}.")
+
+    return index_name
+
+
+async def set_vector_search_options(
+    db: AsyncSession,
+    top_k: int,
+    ef_search: int | None = None,
+    probes: int | None = None,
+    filtered: bool = False,
+) -> None:
+    """Set the recall/speed trade-off of the vector index for the current transaction.
+
+    Parameters
+    ----------
+    db : AsyncSession
+        Database session that will run the retrieval query.
+    top_k : int
+        Number of rows the retrieval query will fetch.
+    ef_search : int | None
+        Size of the HNSW candidate list; defaults to `HNSW_EF_SEARCH`.
+        Higher values give better recall at the cost of latency.
+    probes : int | None
+        Number of IVFFlat lists to probe; defaults to `IVFFLAT_PROBES`.
+        Higher values give better recall at the cost of latency.
+    filtered : bool
+        Whether the retrieval query filters rows. The index then keeps scanning until
+        enough rows pass the filters (see `VECTOR_ITERATIVE_SCAN`), instead of returning
+        fewer than top_k rows when most candidates are filtered out.
+    """
+    if app_config.VECTOR_INDEX_TYPE == "hnsw":
+        # HNSW can return at most ef_search rows (capped to 1000), so never go below top_k
+        options = {"hnsw.ef_search": min(max(ef_search or app_config.HNSW_EF_SEARCH, top_k), 1_000)}
+    elif app_config.VECTOR_INDEX_TYPE == "ivfflat":
+        # Probing more lists than the index has is equivalent to an exact search
+        options = {
+            "ivfflat.probes": min(probes or app_config.IVFFLAT_PROBES, app_config.IVFFLAT_LISTS)
+        }
+    else:
+        return
+    if filtered and app_config.VECTOR_ITERATIVE_SCAN != "off":
+        options[f"{app_config.VECTOR_INDEX_TYPE}.iterative_scan"] = app_config.VECTOR_ITERATIVE_SCAN
+
+    # SET LOCAL does not accept bind parameters, but set_config(..., is_local=true) does
+    # (all options are set in a single statement, i.e. a single round-trip)
+    set_configs = ", ".join(f"set_config(:name_{i}, :value_{i}, true)" for i in range(len(options)))
+    params = {}
+    for i, (name, value) in enumerate(options.items()):
+        params[f"name_{i}"] = name
+        params[f"value_{i}"] = str(value)
+    await db.execute(sql.text(f"SELECT {set_configs}"), params)
+
+
+async def get_corpus_version(db: AsyncSession) -> int:
+    """Return the current version of the corpus (0 if it was never bumped)."""
+    result = await db.execute(
+        sql.text(
+            f"SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM {corpus_version_seq.name}"
+        )
+    )
+    return result.scalar_one()
+
+
+async def bump_corpus_version(db: AsyncSession) -> int:
+    """Increment the version of the corpus, and return the new version.
+
+    Must be called after the transaction changing the chunks is committed: queries reading
+    the new version are then guaranteed to see the new chunks. Sequences are not
+    transactional, so the new version is visible immediately, even if not committed.
+    """
+    return (await db.execute(select(corpus_version_seq.next_value()))).scalar_one()
+
 
 async def get_db_session():
     """Async context manager for database session."""
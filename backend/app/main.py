@@ -1,38 +1,83 @@
 """Main FastAPI application."""
+import asyncio
 from contextlib import asynccontextmanager
 
 from app.api.v1.delete_all_chunks import delete_all_chunks_router
 from app.api.v1.ingest_document import ingest_document_router
+from app.api.v1.ingest_documents import ingest_documents_router
+from app.api.v1.jobs import jobs_router
+from app.api.v1.metrics import metrics_router
 from app.api.v1.query import query_router
+from app.api.v1.query_batch import query_batch_router
+from app.api.v1.rebuild_vector_index import rebuild_vector_index_router
+from app.api.v1.sync_documents import sync_documents_router
 from app.core.config import app_config
-from app.core.log_config import set_logging_options
+from app.core.log_config import set_logging_options, stop_logging
+from app.core.metrics import MetricsMiddleware
 from app.core.middleware import JobIdMiddleware
-from app.db.session import init_db
+from app.db.session import close_engine, init_db, init_engine
+from app.utils.ai_utils import close_openai_client, init_openai_client
+from app.utils.context_utils import get_encoding
+from app.utils.ingestion_pipeline import ingestion_pipeline
+from app.utils.ingestion_utils import ingestion_queue
 from fastapi import FastAPI
 
 # Set logging options and formatting
-set_logging_options(level=app_config.LOGGING_LEVEL)
+set_logging_options(
+    level=app_config.LOGGING_LEVEL,
+    log_format=app_config.LOGGING_FORMAT,
+    use_queue=app_config.LOGGING_QUEUE_ENABLED,
+    payload_max_chars=app_config.LOGGING_PAYLOAD_MAX_CHARS,
+    payload_sample_rate=app_config.LOGGING_PAYLOAD_SAMPLE_RATE,
+)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Context manager to handle application startup and shutdown."""
-    # 1. Startup (initialize db, etc.)
+    # 1. Startup (create connection pools, initialize db, load parsing models, etc.)
+    init_engine()
+    init_openai_client()
     await init_db()
+    if app_config.SERVES_INGESTION:
+        # Imported here, so that query-only replicas never import docling and its models
+        from app.utils.docling_utils import shutdown_parsers, warm_up_parsers
+
+        await warm_up_parsers()
+        ingestion_pipeline.start()
+        ingestion_queue.start()
+    if app_config.SERVES_QUERIES:
+        # Load the tokenizer of the context token budget (see `get_encoding`)
+        await asyncio.to_thread(get_encoding, app_config.OPENAI_TEXT_GENERATION_MODEL)
 
     # 2. Run the application
     yield
 
     # 3. Shutdown and cleanup (if needed)
-    pass
+    if app_config.SERVES_INGESTION:
+        await ingestion_queue.stop()
+        await ingestion_pipeline.stop()
+        shutdown_parsers()
+    await close_openai_client()
+    await close_engine()
+    stop_logging()
 
 
 app = FastAPI(lifespan=lifespan)
 
-# Include routers
-app.include_router(ingest_document_router)
-app.include_router(query_router)
-app.include_router(delete_all_chunks_router)
+# Include routers (of the serving mode: query and ingestion replicas can be scaled apart)
+if app_config.SERVES_INGESTION:
+    app.include_router(ingest_document_router)
+    app.include_router(ingest_documents_router)
+    app.include_router(sync_documents_router)
+    app.include_router(jobs_router)
+    app.include_router(delete_all_chunks_router)
+    app.include_router(rebuild_vector_index_router)
+if app_config.SERVES_QUERIES:
+    app.include_router(query_router)
+    app.include_router(query_batch_router)
+app.include_router(metrics_router)
 
-# Include middleware
+# Include middleware (the last one added runs first: metrics are recorded with the job ID set)
+app.add_middleware(MetricsMiddleware)
 app.add_middleware(JobIdMiddleware)
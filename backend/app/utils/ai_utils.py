@@ -1,19 +1,206 @@
 """Utility functions for Embedding and Text Generation with AI models and APIs."""
-from typing import Type
+import asyncio
+import math
+import random
+from logging import getLogger
+from typing import AsyncIterator, List, Optional, Type
 
+import httpx
 from app.core.config import app_config
-from openai import AsyncOpenAI
+from app.core.metrics import record_openai_usage
+from app.utils.concurrency import AdaptiveConcurrencyLimiter
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    InternalServerError,
+    RateLimitError,
+)
 from pydantic import BaseModel
 
-openai_client = AsyncOpenAI()
+logger = getLogger(__name__)
+
+# Clients of the OpenAI API, created at startup in each worker process (see `init_openai_client`)
+openai_client: Optional[AsyncOpenAI] = None
+# Batched embedding requests are retried by us (only the failed batches), not by the client
+_batch_openai_client: Optional[AsyncOpenAI] = None
+
+# Hard limits of the OpenAI Embeddings API for a single request
+EMBEDDING_API_MAX_INPUTS = 2_048
+EMBEDDING_API_MAX_TOKENS = 300_000
+
+# Maximum wait before retrying a failed request, in seconds (even if asked to wait longer)
+MAX_RETRY_DELAY = 30.0
+
+_embedding_limiter = AdaptiveConcurrencyLimiter(
+    initial_limit=app_config.EMBEDDING_INITIAL_CONCURRENCY,
+    max_limit=app_config.EMBEDDING_MAX_CONCURRENCY,
+)
+
+
+def init_openai_client() -> None:
+    """Create the OpenAI API client, and its pool of HTTP connections.
+
+    Timeouts are set per call (see `OPENAI_EMBEDDING_TIMEOUT` and `OPENAI_CHAT_TIMEOUT`),
+    the connect timeout applies to all calls.
+    """
+    global openai_client, _batch_openai_client
+
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=app_config.OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=app_config.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=app_config.OPENAI_KEEPALIVE_EXPIRY,
+        )
+    )
+    openai_client = AsyncOpenAI(
+        base_url=app_config.OPENAI_BASE_URL,
+        max_retries=app_config.OPENAI_MAX_RETRIES,
+        timeout=httpx.Timeout(
+            app_config.OPENAI_CHAT_TIMEOUT, connect=app_config.OPENAI_CONNECT_TIMEOUT
+        ),
+        http_client=http_client,
+    )
+    _batch_openai_client = openai_client.with_options(max_retries=0)
+
+
+async def close_openai_client() -> None:
+    """Close the connections of the OpenAI API client."""
+    global openai_client, _batch_openai_client
+
+    if openai_client is not None:
+        await openai_client.close()
+        openai_client = _batch_openai_client = None
+
+
+def _timeout(seconds: float) -> httpx.Timeout:
+    """Return the timeout of an API call, keeping the connect timeout of the client."""
+    return httpx.Timeout(seconds, connect=app_config.OPENAI_CONNECT_TIMEOUT)
+
+
+def _embedding_options(model: str) -> dict:
+    """Return the options of embedding requests, shortening vectors to `EMBEDDING_DIM` if possible.
+
+    Only the text-embedding-3 models support the `dimensions` parameter, which returns
+    the (normalized) first `dimensions` components of the full embedding.
+    """
+    if model.startswith("text-embedding-3"):
+        return {"dimensions": app_config.EMBEDDING_DIM}
+    return {}
 
 
 async def embed_text(text: str, model: str = app_config.OPENAI_EMBEDDING_MODEL):
     """Return the embedding vector for the given text."""
-    response = await openai_client.embeddings.create(input=text, model=model)
+    response = await openai_client.embeddings.create(
+        input=text,
+        model=model,
+        timeout=_timeout(app_config.OPENAI_EMBEDDING_TIMEOUT),
+        **_embedding_options(model),
+    )
+    record_openai_usage(model, response.usage)
     return response.data[0].embedding
 
 
+def _estimate_n_tokens(text: str) -> int:
+    """Return an upper bound on the number of tokens of a text.
+
+    BPE tokens always span at least one byte, so the UTF-8 length is a safe bound.
+    """
+    return len(text.encode("utf-8"))
+
+
+def _make_batches(texts: List[str]) -> List[List[int]]:
+    """Split the texts into batches of indices respecting the embedding request limits."""
+    max_inputs = min(app_config.EMBEDDING_BATCH_MAX_INPUTS, EMBEDDING_API_MAX_INPUTS)
+    max_tokens = min(app_config.EMBEDDING_BATCH_MAX_TOKENS, EMBEDDING_API_MAX_TOKENS)
+
+    batches, batch, batch_n_tokens = [], [], 0
+    for i, text in enumerate(texts):
+        n_tokens = _estimate_n_tokens(text)
+        if batch and (len(batch) >= max_inputs or batch_n_tokens + n_tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_n_tokens = [], 0
+        batch.append(i)
+        batch_n_tokens += n_tokens
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """Return how many seconds to wait before retrying a failed request."""
+    if isinstance(error, APIStatusError):
+        retry_after = error.response.headers.get("retry-after")
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = math.nan
+        if not math.isnan(delay):
+            return min(max(delay, 0.0), MAX_RETRY_DELAY)
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(MAX_RETRY_DELAY, 0.5 * 2**attempt))
+
+
+async def _embed_batch(texts: List[str], model: str) -> List[List[float]]:
+    """Embed a batch of texts in a single request, retrying on rate limits and server errors."""
+    for attempt in range(app_config.EMBEDDING_MAX_RETRIES + 1):
+        async with _embedding_limiter.slot():
+            try:
+                response = await _batch_openai_client.embeddings.create(
+                    input=texts,
+                    model=model,
+                    timeout=_timeout(app_config.OPENAI_EMBEDDING_TIMEOUT),
+                    **_embedding_options(model),
+                )
+            except (RateLimitError, InternalServerError, APIConnectionError) as e:
+                _embedding_limiter.on_overload()
+                error = e
+            else:
+                _embedding_limiter.on_success()
+                record_openai_usage(model, response.usage)
+                return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+
+        if attempt == app_config.EMBEDDING_MAX_RETRIES:
+            raise error
+        delay = _retry_delay(error, attempt)
+        logger.warning(
+            f"Embedding batch of {len(texts)} texts failed ({error.__class__.__name__}), "
+            f"retrying in {delay:.1f}s [concurrency limit={_embedding_limiter.limit}]"
+        )
+        await asyncio.sleep(delay)
+
+
+async def embed_texts(
+    texts: List[str], model: str = app_config.OPENAI_EMBEDDING_MODEL
+) -> List[List[float]]:
+    """Return the embedding vectors for the given texts, in the same order.
+
+    Texts are packed into as few embedding requests as the API limits allow, and the
+    requests are sent concurrently under an adaptive concurrency limit shared by the
+    whole process. On rate limits (429) and server errors (5xx) the limit is lowered
+    and only the failed batches are retried.
+    """
+    batches = _make_batches(texts)
+    tasks = [
+        asyncio.create_task(_embed_batch([texts[i] for i in batch], model)) for batch in batches
+    ]
+    try:
+        batch_embeddings = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    embeddings = [None] * len(texts)
+    for batch, batch_embedding in zip(batches, batch_embeddings):
+        for i, embedding in zip(batch, batch_embedding):
+            embeddings[i] = embedding
+
+    return embeddings
+
+
 async def get_answer_from_llm(
     system_prompt: str,
     user_prompt: str,
@@ -28,9 +215,46 @@ async def get_answer_from_llm(
             {"role": "user", "content": user_prompt},
         ],
         "temperature": 0.0,
+        "timeout": _timeout(app_config.OPENAI_CHAT_TIMEOUT),
     }
     if llm_response_model:
         kwargs["response_format"] = llm_response_model
 
     response = await openai_client.beta.chat.completions.parse(**kwargs)
+    record_openai_usage(model, response.usage)
     return response.choices[0].message.content
+
+
+async def stream_answer_from_llm(
+    system_prompt: str,
+    user_prompt: str,
+    model: str = app_config.OPENAI_TEXT_GENERATION_MODEL,
+    llm_response_model: Type[BaseModel] | None = None,
+) -> AsyncIterator[str]:
+    """Generate an answer from LLM, yielding its content piece by piece as it is generated.
+
+    Streaming counterpart of `get_answer_from_llm`: the concatenation of the yielded
+    pieces is the content that `get_answer_from_llm` would return (with a response model,
+    a JSON document whose partial content can be parsed as it arrives).
+    """
+    kwargs = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+        "temperature": 0.0,
+        "timeout": _timeout(app_config.OPENAI_CHAT_TIMEOUT),
+    }
+    if llm_response_model:
+        kwargs["response_format"] = llm_response_model
+
+    # Ask for the token usage, sent in a last chunk without content
+    kwargs["stream_options"] = {"include_usage": True}
+
+    async with openai_client.beta.chat.completions.stream(**kwargs) as stream:
+        async for event in stream:
+            if event.type == "content.delta":
+                yield event.delta
+            elif event.type == "chunk" and event.chunk.usage is not None:
+                record_openai_usage(model, event.chunk.usage)
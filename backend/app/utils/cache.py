@@ -0,0 +1,153 @@
+"""In-process caches."""
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional
+
+import numpy as np
+
+
+class LRUCache:
+    """Least-recently-used cache with a maximum number of entries, and hit/miss counters.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of entries; the least recently used ones are evicted first.
+        A value of 0 disables the cache.
+    ttl : Optional[float]
+        Number of seconds after which an entry expires (counted from when it was put).
+        Entries never expire if None.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (value, expiry time)
+        self._data = OrderedDict()
+
+    def __len__(self) -> int:
+        """Return the number of entries in the cache."""
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the value for key if in cache (marking it as recently used), else default."""
+        try:
+            value, expires_at = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires_at is not None and time.monotonic() >= expires_at:
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Insert or update an entry, evicting the least recently used ones if needed."""
+        if self.maxsize <= 0:
+            return
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of lookups that were hits (0 if there was no lookup)."""
+        n_lookups = self.hits + self.misses
+        return self.hits / n_lookups if n_lookups else 0.0
+
+    def clear(self) -> None:
+        """Remove all entries from the cache."""
+        self._data.clear()
+
+
+class SemanticCache:
+    """Cache of values keyed by embedding vectors, matched by cosine similarity.
+
+    A lookup returns the value of the most similar cached embedding, if its cosine
+    similarity with the looked up one is at least `threshold`, and if it was put with the
+    same scope (e.g. the search parameters the value depends on) and version.
+
+    All entries belong to the same version (e.g. of the data the values were computed
+    from): entries are dropped as soon as a newer version is seen, and values of older
+    versions are never put. The oldest entries are evicted first.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of entries. A value of 0 disables the cache.
+    dim : int
+        Dimension of the embedding vectors.
+    threshold : float
+        Minimum cosine similarity of a cached embedding to be considered a match.
+    """
+
+    def __init__(self, maxsize: int, dim: int, threshold: float):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        # Normalized embeddings, as a ring buffer whose next slot to write is _next
+        self._embeddings = np.zeros((maxsize, dim), dtype=np.float32)
+        self._scopes: List[Hashable] = [None] * maxsize
+        self._values: List[Any] = [None] * maxsize
+        self._size = 0
+        self._next = 0
+
+    def __len__(self) -> int:
+        """Return the number of entries in the cache."""
+        return self._size
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of lookups that were hits (0 if there was no lookup)."""
+        n_lookups = self.hits + self.misses
+        return self.hits / n_lookups if n_lookups else 0.0
+
+    def _sync_version(self, version: int) -> bool:
+        """Drop all entries if version is newer than theirs; return whether it is current."""
+        if self._version is None or version > self._version:
+            self.clear()
+            self._version = version
+        return version == self._version
+
+    def get(self, embedding: np.ndarray, scope: Hashable, version: int) -> Any:
+        """Return the value of the best matching entry, or None."""
+        if self.maxsize <= 0 or not self._sync_version(version) or self._size == 0:
+            self.misses += 1
+            return None
+
+        embedding = embedding / np.linalg.norm(embedding)
+        similarities = self._embeddings[: self._size] @ embedding
+        for i in np.argsort(-similarities):
+            if similarities[i] < self.threshold:
+                break
+            if self._scopes[i] == scope:
+                self.hits += 1
+                return self._values[i]
+        self.misses += 1
+        return None
+
+    def put(self, embedding: np.ndarray, scope: Hashable, version: int, value: Any) -> None:
+        """Insert an entry, evicting the oldest one if the cache is full."""
+        if self.maxsize <= 0 or not self._sync_version(version):
+            return
+        self._embeddings[self._next] = embedding / np.linalg.norm(embedding)
+        self._scopes[self._next] = scope
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.maxsize
+        self._size = min(self._size + 1, self.maxsize)
+
+    def clear(self) -> None:
+        """Remove all entries from the cache."""
+        self._scopes = [None] * self.maxsize
+        self._values = [None] * self.maxsize
+        self._size = 0
+        self._next = 0
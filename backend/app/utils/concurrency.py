@@ -0,0 +1,126 @@
+"""Utilities for bounding the concurrency of asynchronous calls."""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+
+class AdaptiveConcurrencyLimiter:
+    """Concurrency limiter following an AIMD (additive-increase/multiplicative-decrease) policy.
+
+    The limit on in-flight calls grows by one after every `increase_every` successful
+    calls, and is halved whenever the downstream service signals it is overloaded
+    (e.g. HTTP 429 or 5xx). Overload signals received within `decrease_cooldown`
+    seconds from the last decrease are ignored, so that a burst of failures caused by
+    the same congestion event only halves the limit once.
+
+    Parameters
+    ----------
+    initial_limit : int
+        Initial number of calls allowed to be in flight at the same time.
+    max_limit : int
+        Maximum number of calls allowed to be in flight at the same time.
+    min_limit : int
+        Minimum number of calls allowed to be in flight at the same time.
+    increase_every : int
+        Number of successful calls after which the limit is increased by one.
+    decrease_cooldown : float
+        Minimum number of seconds between two consecutive decreases of the limit.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int,
+        max_limit: int,
+        min_limit: int = 1,
+        increase_every: int = 10,
+        decrease_cooldown: float = 1.0,
+    ):
+        if not 1 <= min_limit <= initial_limit <= max_limit:
+            raise ValueError("Limits must satisfy 1 <= min_limit <= initial_limit <= max_limit.")
+        self._limit = initial_limit
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._increase_every = increase_every
+        self._decrease_cooldown = decrease_cooldown
+        self._in_flight = 0
+        self._n_successes = 0
+        self._last_decrease = float("-inf")
+        self._condition = asyncio.Condition()
+
+    @property
+    def limit(self) -> int:
+        """Current maximum number of calls allowed to be in flight."""
+        return self._limit
+
+    @property
+    def in_flight(self) -> int:
+        """Current number of calls in flight."""
+        return self._in_flight
+
+    @asynccontextmanager
+    async def slot(self):
+        """Wait until a call can be started, and hold the slot until the call is done."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self._limit)
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def on_success(self) -> None:
+        """Record a successful call, possibly increasing the limit."""
+        self._n_successes += 1
+        if self._n_successes >= self._increase_every and self._limit < self._max_limit:
+            self._limit += 1
+            self._n_successes = 0
+
+    def on_overload(self) -> None:
+        """Record an overload signal from downstream, possibly decreasing the limit."""
+        now = time.monotonic()
+        self._n_successes = 0
+        if now - self._last_decrease >= self._decrease_cooldown:
+            self._limit = max(self._min_limit, self._limit // 2)
+            self._last_decrease = now
+
+
+class ByteBudget:
+    """Budget of bytes shared by concurrent tasks, e.g. the size of documents being processed.
+
+    Tasks reserve the bytes they need and wait (in no particular order) until enough of
+    the budget is available. A task needing more than the whole budget waits until no
+    other task holds any part of it, and then runs alone.
+
+    Parameters
+    ----------
+    capacity : int
+        Total number of bytes that can be reserved at the same time.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError(f"Invalid capacity {capacity}. Must be at least 1.")
+        self.capacity = capacity
+        self._reserved = 0
+        self._condition = asyncio.Condition()
+
+    @property
+    def reserved(self) -> int:
+        """Number of bytes currently reserved."""
+        return self._reserved
+
+    @asynccontextmanager
+    async def reserve(self, n_bytes: int):
+        """Wait until n_bytes are available, and hold them until the end of the block."""
+        n_bytes = min(n_bytes, self.capacity)
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._reserved + n_bytes <= self.capacity)
+            self._reserved += n_bytes
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._reserved -= n_bytes
+                self._condition.notify_all()
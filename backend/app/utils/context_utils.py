@@ -0,0 +1,231 @@
+"""Utilities for assembling the retrieved chunks into the contexts of the answer prompt."""
+from functools import lru_cache
+from logging import getLogger
+from typing import List, Optional
+
+import numpy as np
+import tiktoken
+from app.core.config import app_config
+from app.db.retrieval import RetrievedChunk, chunk_similarities
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = getLogger(__name__)
+
+
+def format_context(chunk: RetrievedChunk) -> str:
+    """Return the text of a retrieved chunk, as given to the LLM."""
+    return (
+        f"Doc Name: {chunk.doc_name}, ChunkID: {chunk.chunk_id}, "
+        f"Headers: {chunk.section_headers}, Pages: {chunk.pages}\n"
+        f"{chunk.serialized_chunk}"
+    )
+
+
+def mmr_select(
+    relevances: np.ndarray, similarities: np.ndarray, k: int, mmr_lambda: float
+) -> List[int]:
+    """Select k candidates by maximal marginal relevance (MMR).
+
+    Candidates are selected one at a time, maximizing
+    `mmr_lambda * relevance - (1 - mmr_lambda) * max(similarity to the selected ones)`,
+    so that near-duplicates of the selected candidates are selected last (if at all).
+
+    Parameters
+    ----------
+    relevances : np.ndarray
+        Relevance of each of the n candidates (e.g. their cosine similarity to the query).
+    similarities : np.ndarray
+        The (n, n) matrix of the pairwise similarities between candidates.
+    k : int
+        Number of candidates to select.
+    mmr_lambda : float
+        Trade-off between relevance (1.0: candidates are selected by relevance only) and
+        diversity (0.0).
+
+    Returns
+    -------
+    List[int]
+        The indices of the selected candidates, in order of selection.
+    """
+    n_candidates = len(relevances)
+    selected = []
+    # Similarity of each candidate to the closest selected candidate
+    max_similarities = np.zeros(n_candidates)
+    available = np.ones(n_candidates, dtype=bool)
+    for _ in range(min(k, n_candidates)):
+        if selected:
+            scores = mmr_lambda * relevances - (1 - mmr_lambda) * max_similarities
+        else:
+            scores = relevances.copy()
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        max_similarities = np.maximum(max_similarities, similarities[best])
+
+    return selected
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> Optional[tiktoken.Encoding]:
+    """Return the tokenizer of an OpenAI model, None if it cannot be loaded.
+
+    Tokenizer files are downloaded on first use, unless already in `TIKTOKEN_CACHE_DIR`
+    (where the Docker image bakes them), which fails without network access.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            logger.warning(f"No tokenizer known for model {model}, using o200k_base.")
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        logger.warning(
+            f"Cannot load the tokenizer of model {model}, token counts are overestimated "
+            "(by the UTF-8 length of the texts).",
+            exc_info=True,
+        )
+        return None
+
+
+def pack_contexts(
+    chunks: List[RetrievedChunk], token_budget: int, model: Optional[str] = None
+) -> List[RetrievedChunk]:
+    """Select the chunks whose contexts fit in a token budget, greedily in order.
+
+    A chunk too large for the remaining budget is skipped, and the next ones are tried.
+    """
+    encoding = get_encoding(model or app_config.OPENAI_TEXT_GENERATION_MODEL)
+    texts = [format_context(chunk) for chunk in chunks]
+    if encoding is None:
+        # BPE tokens always span at least one byte: the budget is never exceeded
+        token_counts = [len(text.encode("utf-8")) for text in texts]
+    else:
+        token_counts = [len(tokens) for tokens in encoding.encode_ordinary_batch(texts)]
+
+    packed = []
+    n_tokens = 0
+    for chunk, chunk_tokens in zip(chunks, token_counts):
+        if n_tokens + chunk_tokens <= token_budget:
+            packed.append(chunk)
+            n_tokens += chunk_tokens
+    logger.info(f"Packed {len(packed)}/{len(chunks)} contexts in {n_tokens}/{token_budget} tokens.")
+    return packed
+
+
+def get_relevances(candidates: List[RetrievedChunk]) -> np.ndarray:
+    """Return the relevance of each candidate to the query, between 0 and 1 (for MMR).
+
+    Candidates of hybrid retrieval are scored by their fused rank (RRF score, scaled so
+    that the best candidate scores 1), not by their cosine similarity: lexical matches
+    (e.g. part numbers or error codes) may be dissimilar to the query embedding.
+    """
+    if all(chunk.rrf_score is not None for chunk in candidates):
+        rrf_scores = np.array([chunk.rrf_score for chunk in candidates])
+        return rrf_scores / rrf_scores.max()
+    return np.array([chunk.cosine_similarity for chunk in candidates])
+
+
+def get_fetch_size(top_k: int, mmr_lambda: float, mmr_fetch_factor: int) -> int:
+    """Return the number of candidates to retrieve for top_k contexts (see `assemble_contexts`).
+
+    With MMR, candidates are capped to MMR_MAX_CANDIDATES (but never fewer than top_k):
+    their pairwise similarities are computed in the database, in O(n^2).
+    """
+    if mmr_lambda >= 1.0:
+        return top_k
+    return min(top_k * mmr_fetch_factor, max(top_k, app_config.MMR_MAX_CANDIDATES))
+
+
+def select_contexts(
+    candidates: List[RetrievedChunk],
+    similarities: Optional[np.ndarray],
+    top_k: int,
+    mmr_lambda: float,
+    token_budget: Optional[int],
+) -> List[RetrievedChunk]:
+    """Select the contexts among the candidates, given their pairwise similarities.
+
+    Candidates are diversified by MMR if their similarities are given (see `assemble_contexts`).
+    """
+    contexts = candidates[:top_k]
+    if similarities is not None:
+        relevances = get_relevances(candidates)
+        contexts = [candidates[i] for i in mmr_select(relevances, similarities, top_k, mmr_lambda)]
+        n_reordered = sum(
+            context is not chunk for context, chunk in zip(contexts, candidates[:top_k])
+        )
+        logger.info(
+            f"Selected {len(contexts)}/{len(candidates)} candidates by MMR "
+            f"(lambda={mmr_lambda}, {n_reordered} differing from relevance order)."
+        )
+
+    if token_budget is not None:
+        contexts = pack_contexts(contexts, token_budget)
+
+    return contexts
+
+
+async def assemble_contexts_batch(
+    db: AsyncSession,
+    all_candidates: List[List[RetrievedChunk]],
+    top_k: int,
+    mmr_lambda: float,
+    token_budget: Optional[int],
+) -> List[List[RetrievedChunk]]:
+    """Select the contexts of the answer prompts of several queries (see `assemble_contexts`).
+
+    Pairwise similarities between the candidates of all the queries are computed in a
+    single database round trip, and not at all without MMR.
+    """
+    diversified = [
+        i for i, candidates in enumerate(all_candidates) if mmr_lambda < 1.0 and len(candidates) > 1
+    ]
+    all_similarities: List[Optional[np.ndarray]] = [None] * len(all_candidates)
+    if diversified:
+        matrices = await chunk_similarities(
+            db, [[chunk.chunk_id for chunk in all_candidates[i]] for i in diversified]
+        )
+        for i, similarities in zip(diversified, matrices):
+            all_similarities[i] = similarities
+
+    return [
+        select_contexts(candidates, similarities, top_k, mmr_lambda, token_budget)
+        for candidates, similarities in zip(all_candidates, all_similarities)
+    ]
+
+
+async def assemble_contexts(
+    db: AsyncSession,
+    candidates: List[RetrievedChunk],
+    top_k: int,
+    mmr_lambda: float,
+    token_budget: Optional[int],
+) -> List[RetrievedChunk]:
+    """Select the contexts of the answer prompt among the retrieved candidates.
+
+    Breakdown:
+    1) Diversify: select top_k candidates by maximal marginal relevance, unless mmr_lambda
+       is 1.0 (candidates are then the top_k most relevant chunks already)
+    2) Pack: keep the selected candidates fitting in the token budget (if any)
+
+    Parameters
+    ----------
+    db : AsyncSession
+        Database session (pairwise similarities between candidates are computed in it).
+    candidates : List[RetrievedChunk]
+        The retrieved chunks, most relevant first (see `get_fetch_size`).
+    top_k : int
+        Maximum number of contexts.
+    mmr_lambda : float
+        Trade-off between relevance and diversity (see `mmr_select`).
+    token_budget : Optional[int]
+        Maximum number of tokens of the contexts, None for no limit.
+
+    Returns
+    -------
+    List[RetrievedChunk]
+        The contexts, in order of selection.
+    """
+    [contexts] = await assemble_contexts_batch(db, [candidates], top_k, mmr_lambda, token_budget)
+    return contexts
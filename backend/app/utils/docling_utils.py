@@ -1,24 +1,58 @@
 """Utilities for parsing and chunking documents using docling library."""
-import io
-from logging import Logger
+import asyncio
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from dataclasses import dataclass
+from logging import Logger, getLogger
 from pathlib import Path
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
+import pypdfium2
+from app.core.config import app_config
 from docling.backend.docling_parse_v2_backend import DoclingParseV2DocumentBackend
-from docling.chunking import BaseChunker
-from docling.datamodel.base_models import DocumentStream
-from docling.datamodel.pipeline_options import PdfPipelineOptions
+from docling.chunking import HybridChunker
+from docling.datamodel.pipeline_options import AcceleratorOptions, PdfPipelineOptions
 from docling.document_converter import DocumentConverter, InputFormat, PdfFormatOption
+from docling_core.types.doc import DoclingDocument
 
+logger = getLogger(__name__)
 
-def parse_and_chunk_pdf(
-    pdf_filename: str, pdf_bytes: bytes, chunker: BaseChunker, logger: Logger
-) -> list:
-    """Parse PDF using docling, chunk it, return chunk objects."""
-    logger.info(f"Parsing document {repr(pdf_filename)} ...")
+# Collections of a DoclingDocument whose items are referenced as "#/<collection>/<index>"
+_DOCUMENT_COLLECTIONS = ("groups", "texts", "pictures", "tables", "key_value_items", "form_items")
+
+
+@dataclass
+class ParsedChunk:
+    """Serialized chunk of a document, together with the metadata stored in the database."""
+
+    serialized_chunk: str
+    section_headers: List[str]
+    pages: List[int]
+
+
+def create_converter(num_threads: Optional[int] = None) -> DocumentConverter:
+    """Create a PDF document converter, with its models loaded and ready to use."""
     docling_models_path = Path.home() / ".cache" / "docling" / "models"
     pipeline_options = PdfPipelineOptions(artifacts_path=docling_models_path)
     pipeline_options.do_ocr = True
     pipeline_options.do_table_structure = True
+    if num_threads is not None:
+        pipeline_options.accelerator_options = AcceleratorOptions(num_threads=num_threads)
 
     converter = DocumentConverter(
         format_options={
@@ -27,11 +61,384 @@ def parse_and_chunk_pdf(
             )
         }
     )
+    # Load the layout, OCR and table-structure models now, rather than on first conversion
+    converter.initialize_pipeline(InputFormat.PDF)
+
+    return converter
+
+
+class DoclingPool:
+    """Thread-safe pool of pre-initialised document converters and chunkers.
+
+    Creating a converter loads several AI models, and creating a chunker loads its
+    tokenizer, so they are created once and re-used across documents. Each
+    (converter, chunker) pair is used by at most one thread at a time; pairs are
+    created lazily up to `size`, or all at once with `warm_up()`.
+
+    Parameters
+    ----------
+    size : int
+        Maximum number of (converter, chunker) pairs, i.e. of documents that can be
+        parsed at the same time.
+    num_threads : Optional[int]
+        Number of threads used by the models of each converter (docling's default if None).
+    """
+
+    def __init__(self, size: int, num_threads: Optional[int] = None):
+        if size < 1:
+            raise ValueError(f"Invalid pool size {size}. Must be at least 1.")
+        self.size = size
+        self.num_threads = num_threads
+        self._idle = queue.Queue()
+        self._n_created = 0
+        self._lock = threading.Lock()
+
+    def _reserve_creation(self) -> bool:
+        """Return whether a new pair can be created, reserving its place in the pool."""
+        with self._lock:
+            if self._n_created >= self.size:
+                return False
+            self._n_created += 1
+            return True
+
+    def _release_creation(self) -> None:
+        """Release the place reserved for a pair whose creation failed."""
+        with self._lock:
+            self._n_created -= 1
+
+    def _create_item(self) -> Tuple[DocumentConverter, HybridChunker]:
+        """Create a new (converter, chunker) pair, in a place reserved in the pool."""
+        try:
+            return create_converter(num_threads=self.num_threads), HybridChunker()
+        except BaseException:
+            self._release_creation()
+            raise
+
+    def warm_up(self) -> None:
+        """Create all the (converter, chunker) pairs that haven't been created yet."""
+        while self._reserve_creation():
+            self._idle.put(self._create_item())
+
+    @contextmanager
+    def acquire(self) -> Iterator[Tuple[DocumentConverter, HybridChunker]]:
+        """Borrow a (converter, chunker) pair, blocking until one is available."""
+        try:
+            item = self._idle.get_nowait()
+        except queue.Empty:
+            item = self._create_item() if self._reserve_creation() else None
+            if item is None:
+                item = self._idle.get()
+        try:
+            yield item
+        finally:
+            self._idle.put(item)
+
+
+docling_pool = DoclingPool(size=app_config.DOCLING_POOL_SIZE)
+
+
+def _chunk_document(document: DoclingDocument, chunker: HybridChunker) -> Iterator[ParsedChunk]:
+    """Chunk a parsed document, yielding serialized chunks with their metadata."""
+    for chunk in chunker.chunk(document):
+        yield ParsedChunk(
+            serialized_chunk=chunker.serialize(chunk=chunk),
+            section_headers=list(chunk.meta.headings or []),
+            pages=sorted({prov.page_no for item in chunk.meta.doc_items for prov in item.prov}),
+        )
+
+
+def iter_pdf_chunks(
+    pdf_filename: str,
+    pdf_path: str,
+    logger: Logger,
+    on_chunking: Optional[Callable[[], None]] = None,
+) -> Iterator[ParsedChunk]:
+    """Parse PDF using docling, chunk it, and yield serialized chunks with their metadata.
+
+    Chunks are yielded as soon as they are chunked, so that they can be processed while
+    the rest of the document is being chunked.
+    The PDF is read from the file at `pdf_path` (which must have a ".pdf" extension),
+    so that it never needs to be loaded in memory at once.
+    If given, `on_chunking()` is called when parsing is done and chunking starts.
+    """
+    with docling_pool.acquire() as (converter, chunker):
+        logger.info(f"Parsing document {repr(pdf_filename)} ...")
+        document = converter.convert(Path(pdf_path)).document
+        logger.info(f"Successfully parsed document {repr(pdf_filename)}.")
+        if on_chunking is not None:
+            on_chunking()
+        logger.info(f"Chunking document {repr(pdf_filename)} ...")
+        n_chunks = 0
+        for chunk in _chunk_document(document, chunker):
+            n_chunks += 1
+            yield chunk
+    logger.info(f"Successfully chunked document {repr(pdf_filename)} into {n_chunks} chunks.")
+
+
+def _iter_batches(chunks: Iterable[ParsedChunk], batch_size: int) -> Iterator[List[ParsedChunk]]:
+    """Group chunks into lists of (at most) batch_size chunks (closing chunks when closed)."""
+    iterator = iter(chunks)
+    try:
+        while batch := list(itertools.islice(iterator, batch_size)):
+            yield batch
+    finally:
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+
+def plan_page_ranges(n_pages: int, shard_pages: int) -> List[Tuple[int, int]]:
+    """Split pages 1..n_pages into consecutive (first, last) ranges of at most shard_pages pages."""
+    return [
+        (first, min(first + shard_pages - 1, n_pages))
+        for first in range(1, n_pages + 1, shard_pages)
+    ]
+
+
+def _shift_refs(node, offsets: Dict[str, int]):
+    """Return a copy of a (JSON-like) document node, with its item references shifted."""
+    if isinstance(node, list):
+        return [_shift_refs(value, offsets) for value in node]
+    if not isinstance(node, dict):
+        return node
+
+    shifted = {}
+    for key, value in node.items():
+        if key in ("$ref", "self_ref") and isinstance(value, str):
+            # References look like "#/texts/12", or "#/body" for the root items
+            parts = value.split("/")
+            if len(parts) == 3 and parts[1] in offsets:
+                value = f"#/{parts[1]}/{int(parts[2]) + offsets[parts[1]]}"
+            shifted[key] = value
+        else:
+            shifted[key] = _shift_refs(value, offsets)
+
+    return shifted
+
+
+def merge_documents(documents: List[dict]) -> DoclingDocument:
+    """Merge documents converted from consecutive page ranges of the same PDF.
+
+    Parameters
+    ----------
+    documents : List[dict]
+        The documents exported with `DoclingDocument.export_to_dict()`, sorted by page range.
+        Page numbers are already absolute, as docling numbers pages from the start of the
+        file also when converting only a page range.
+
+    Returns
+    -------
+    DoclingDocument
+        The merged document, whose items are in the same reading order as the shards.
+    """
+    merged = documents[0]
+    for document in documents[1:]:
+        offsets = {name: len(merged.get(name, [])) for name in _DOCUMENT_COLLECTIONS}
+        document = _shift_refs(document, offsets)
+        for name in _DOCUMENT_COLLECTIONS:
+            merged.setdefault(name, []).extend(document.get(name, []))
+        for root in ("body", "furniture"):
+            if root in merged and root in document:
+                merged[root].setdefault("children", []).extend(document[root].get("children", []))
+        merged.setdefault("pages", {}).update(document.get("pages", {}))
+
+    return DoclingDocument.model_validate(merged)
+
+
+# Each worker process of the process pool owns the (converter, chunker) pairs of its own
+# `docling_pool` (it only ever uses one, as a process runs one task at a time)
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_process_pool_size() -> int:
+    """Return the number of worker processes used for parsing (0 if disabled).
+
+    Each worker process loads its own copy of the layout, table-structure and OCR models,
+    which takes more than 1 GB of memory: the size (`DOCLING_PROCESS_POOL_SIZE`) is fixed
+    rather than derived from the number of cores, and should be raised only on hosts with
+    the memory for it (e.g. measured with the RSS of the workers after `warm_up_parsers`).
+    """
+    return app_config.DOCLING_PROCESS_POOL_SIZE
+
+
+def _init_worker(num_threads: int) -> None:
+    """Initialize a worker process of the process pool."""
+    # Imported here, as worker processes are spawned and need their own logging setup
+    from app.core.log_config import set_logging_options
+
+    set_logging_options(level=app_config.LOGGING_LEVEL, log_format=app_config.LOGGING_FORMAT)
+    docling_pool.num_threads = num_threads
+
+
+def _warm_up_worker() -> None:
+    """Load the models of a worker process."""
+    with docling_pool.acquire():
+        pass
+
+
+def _convert_pages(pdf_filename: str, pdf_path: str, page_range: Tuple[int, int]) -> dict:
+    """Convert a range of pages of a PDF (in a worker process), return the exported document."""
+    with docling_pool.acquire() as (converter, _):
+        logger.info(f"Parsing pages {page_range} of document {repr(pdf_filename)} ...")
+        document = converter.convert(Path(pdf_path), page_range=page_range).document
+    return document.export_to_dict()
+
+
+def _merge_and_chunk(pdf_filename: str, documents: List[dict]) -> List[ParsedChunk]:
+    """Merge the documents of all page ranges of a PDF and chunk it (in a worker process).
+
+    All the chunks are returned at once, as results of worker processes can't be streamed.
+    """
+    document = merge_documents(documents)
+    with docling_pool.acquire() as (_, chunker):
+        logger.info(f"Chunking document {repr(pdf_filename)} ...")
+        return list(_chunk_document(document, chunker))
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Return the process pool used for parsing, creating it if needed."""
+    global _process_pool
+    if _process_pool is None:
+        n_workers = _get_process_pool_size()
+        # Share the available cores among workers, instead of each model using all of them
+        num_threads = max(1, len(os.sched_getaffinity(0)) // n_workers)
+        _process_pool = ProcessPoolExecutor(
+            max_workers=n_workers,
+            # Never fork the server process, which runs an event loop and several threads
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(num_threads,),
+        )
+    return _process_pool
+
+
+async def warm_up_parsers() -> None:
+    """Load the parsing models, in the worker processes or in the current process."""
+    if _get_process_pool_size() == 0:
+        await asyncio.to_thread(docling_pool.warm_up)
+        return
+
+    # A new worker process is spawned for each task submitted while no worker is idle
+    loop = asyncio.get_running_loop()
+    process_pool = get_process_pool()
+    await asyncio.gather(
+        *(
+            loop.run_in_executor(process_pool, _warm_up_worker)
+            for _ in range(_get_process_pool_size())
+        )
+    )
+
+
+def shutdown_parsers() -> None:
+    """Shut down the worker processes used for parsing, if any."""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(cancel_futures=True)
+        _process_pool = None
+
+
+async def _iter_in_thread(iterator: Iterator, max_buffered: int = 2) -> AsyncIterator:
+    """Iterate over a (blocking) iterator in a thread, without blocking the event loop.
+
+    The thread runs at most `max_buffered` items ahead of the consumer. If the consumer
+    stops early, the thread stops at the next item, and closes the iterator (if it is a
+    generator), so that the resources it holds are released.
+    """
+    loop = asyncio.get_running_loop()
+    buffer = asyncio.Queue(maxsize=max_buffered)
+    stopped = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterator:
+                if stopped.is_set():
+                    return
+                asyncio.run_coroutine_threadsafe(buffer.put((item, None)), loop).result()
+            asyncio.run_coroutine_threadsafe(buffer.put((done, None)), loop).result()
+        except Exception as e:
+            asyncio.run_coroutine_threadsafe(buffer.put((done, e)), loop).result()
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    producer = loop.run_in_executor(None, produce)
+    try:
+        while True:
+            item, error = await buffer.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        stopped.set()
+        # Unblock the thread if it is waiting for room in the buffer
+        while not producer.done():
+            while not buffer.empty():
+                buffer.get_nowait()
+            await asyncio.wait([producer], timeout=0.1)
+
+
+async def iter_pdf_chunks_async(
+    pdf_filename: str,
+    pdf_path: str,
+    logger: Logger,
+    on_chunking: Optional[Callable[[], None]] = None,
+    batch_size: int = 64,
+) -> AsyncIterator[List[ParsedChunk]]:
+    """Parse and chunk a PDF file without blocking the event loop, yielding batches of chunks.
+
+    With a process pool (see `DOCLING_PROCESS_POOL_SIZE`), the PDF is split into ranges of
+    `DOCLING_SHARD_PAGES` pages which are parsed in parallel by the worker processes, and
+    then merged back into a single document before chunking, so that chunks and headings
+    can span range boundaries; chunks are then only yielded once the whole document is
+    chunked (in a single worker process). Without a process pool, parsing runs in a thread,
+    and chunks are yielded as they are chunked (see `iter_pdf_chunks`).
+
+    If given, `on_chunking()` is called (in the event loop) when parsing is done and
+    chunking starts.
+    """
+    loop = asyncio.get_running_loop()
+    if _get_process_pool_size() == 0:
+        chunks = iter_pdf_chunks(
+            pdf_filename,
+            pdf_path,
+            logger,
+            on_chunking=on_chunking and (lambda: loop.call_soon_threadsafe(on_chunking)),
+        )
+        async for batch in _iter_in_thread(_iter_batches(chunks, batch_size)):
+            yield batch
+        return
+
+    # Worker processes only receive the path of the file, which they read themselves
+    pdf = pypdfium2.PdfDocument(pdf_path)
+    n_pages = len(pdf)
+    pdf.close()
+    if n_pages == 0:
+        raise ValueError(f"Document {repr(pdf_filename)} has no pages.")
+    page_ranges = plan_page_ranges(n_pages, app_config.DOCLING_SHARD_PAGES)
+    logger.info(
+        f"Parsing document {repr(pdf_filename)} ({n_pages} pages) "
+        f"in {len(page_ranges)} page ranges..."
+    )
 
-    document_stream = DocumentStream(name=pdf_filename, stream=io.BytesIO(pdf_bytes))
-    document = converter.convert(document_stream).document
-    logger.info(f"Successfully parsed document {repr(pdf_filename)}.")
-    logger.info(f"Chunking document {repr(pdf_filename)} ...")
-    chunks = list(chunker.chunk(document))
+    process_pool = get_process_pool()
+    try:
+        documents = await asyncio.gather(
+            *(
+                loop.run_in_executor(process_pool, _convert_pages, pdf_filename, pdf_path, r)
+                for r in page_ranges
+            )
+        )
+        logger.info(f"Successfully parsed document {repr(pdf_filename)}.")
+        if on_chunking is not None:
+            on_chunking()
+        chunks = await loop.run_in_executor(process_pool, _merge_and_chunk, pdf_filename, documents)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for using too much memory): start afresh next time
+        shutdown_parsers()
+        raise
     logger.info(f"Successfully chunked document {repr(pdf_filename)} into {len(chunks)} chunks.")
-    return chunks
+
+    for batch in _iter_batches(chunks, batch_size):
+        yield batch
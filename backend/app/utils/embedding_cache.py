@@ -0,0 +1,134 @@
+"""Content-addressed embedding cache, persisted in Postgres with an in-process LRU in front."""
+import hashlib
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Dict, List, Tuple
+
+import numpy as np
+from app.core.config import app_config
+from app.db.models import EmbeddingCache
+from app.db.session import AsyncSessionLocal
+from app.utils.ai_utils import embed_text, embed_texts
+from app.utils.cache import LRUCache
+from sqlalchemy import Text, any_, bindparam, select
+from sqlalchemy.dialects import postgresql
+
+logger = getLogger(__name__)
+
+# Embeddings are kept as float32 arrays, which take ~4x less memory than lists of floats
+_lru_cache = LRUCache(maxsize=app_config.EMBEDDING_CACHE_LRU_SIZE)
+
+
+@dataclass
+class EmbeddingCacheStats:
+    """Number of texts served from the cache (hits) and sent to the embedding API (misses)."""
+
+    hits: int = 0
+    misses: int = 0
+
+
+def embedding_cache_key(text: str, model: str) -> str:
+    """Return the cache key of the embedding of a text computed with a given model."""
+    content = f"{model}\x00{app_config.EMBEDDING_DIM}\x00{text}"
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+async def _load_from_db(keys: List[str]) -> Dict[str, np.ndarray]:
+    """Return the cached embeddings found in the database for the given keys."""
+    async with AsyncSessionLocal() as db:
+        # Use "= ANY(array)" rather than "IN (...)", which needs one bind parameter per key
+        keys_param = bindparam("keys", keys, type_=postgresql.ARRAY(Text))
+        select_query = select(EmbeddingCache.content_hash, EmbeddingCache.embedding).where(
+            EmbeddingCache.content_hash == any_(keys_param)
+        )
+        result = await db.execute(select_query)
+        return dict(result.all())
+
+
+async def _save_to_db(rows: List[dict]) -> None:
+    """Persist new embeddings in the database, ignoring the ones cached in the meantime."""
+    async with AsyncSessionLocal() as db:
+        insert_query = postgresql.insert(EmbeddingCache).on_conflict_do_nothing(
+            index_elements=[EmbeddingCache.content_hash]
+        )
+        await db.execute(insert_query, rows)
+        await db.commit()
+
+
+async def get_embeddings(
+    texts: List[str], model: str = app_config.OPENAI_EMBEDDING_MODEL
+) -> Tuple[List[np.ndarray], EmbeddingCacheStats]:
+    """Return the embedding vectors for the given texts, only embedding the ones not cached.
+
+    Lookups go first to the in-process LRU cache, then to the `embedding_cache` table,
+    and only the remaining texts are sent (in batches) to the embedding API. The new
+    embeddings are then stored in both cache levels.
+
+    Returns
+    -------
+    Tuple[List[np.ndarray], EmbeddingCacheStats]
+        The embeddings, in the same order as the texts, and the cache hit/miss counts.
+    """
+    keys = [embedding_cache_key(text, model) for text in texts]
+    embeddings = [_lru_cache.get(key) for key in keys]
+
+    # 1. Look up LRU misses in the database
+    missing_keys = list({key for key, embedding in zip(keys, embeddings) if embedding is None})
+    if missing_keys:
+        from_db = await _load_from_db(missing_keys)
+        for key, embedding in from_db.items():
+            _lru_cache.put(key, embedding)
+        embeddings = [
+            from_db.get(key) if embedding is None else embedding
+            for key, embedding in zip(keys, embeddings)
+        ]
+
+    # 2. Embed the remaining texts (each distinct text only once)
+    n_misses = sum(embedding is None for embedding in embeddings)
+    to_embed = {
+        key: text for key, text, embedding in zip(keys, texts, embeddings) if embedding is None
+    }
+    if to_embed:
+        new_embeddings = await embed_texts(list(to_embed.values()), model=model)
+        new_embeddings = {
+            key: np.asarray(embedding, dtype=np.float32)
+            for key, embedding in zip(to_embed, new_embeddings)
+        }
+        for key, embedding in new_embeddings.items():
+            _lru_cache.put(key, embedding)
+        await _save_to_db(
+            [
+                {"content_hash": key, "model": model, "embedding": embedding}
+                for key, embedding in new_embeddings.items()
+            ]
+        )
+        embeddings = [
+            new_embeddings[key] if embedding is None else embedding
+            for key, embedding in zip(keys, embeddings)
+        ]
+
+    stats = EmbeddingCacheStats(hits=len(texts) - n_misses, misses=n_misses)
+    logger.info(f"Embedding cache: {stats.hits} hits, {stats.misses} misses.")
+
+    return embeddings, stats
+
+
+async def get_embedding(text: str, model: str = app_config.OPENAI_EMBEDDING_MODEL) -> np.ndarray:
+    """Return the embedding vector for a single text, consulting the embedding cache.
+
+    Unlike `get_embeddings`, cache misses are sent directly to the embedding API instead of
+    going through the batching pipeline, to keep latency low on the query path.
+    """
+    key = embedding_cache_key(text, model)
+    embedding, source = _lru_cache.get(key), "memory"
+    if embedding is None:
+        embedding, source = (await _load_from_db([key])).get(key), "database"
+    if embedding is None:
+        embedding, source = np.asarray(await embed_text(text, model=model), dtype=np.float32), "API"
+        await _save_to_db([{"content_hash": key, "model": model, "embedding": embedding}])
+    _lru_cache.put(key, embedding)
+    logger.info(
+        f"Embedding served from {source} (in-memory cache hit rate: {_lru_cache.hit_rate:.1%})."
+    )
+
+    return embedding
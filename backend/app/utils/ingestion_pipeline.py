@@ -0,0 +1,430 @@
+"""Pipeline ingesting documents in overlapping parse, embed and write stages."""
+import asyncio
+import os
+import time
+from collections import defaultdict
+from contextlib import aclosing
+from dataclasses import dataclass, field
+from logging import getLogger
+from typing import Dict, List, Optional
+
+from app.core.config import app_config
+from app.core.metrics import endpoint_contextvar, observe_stage
+from app.core.middleware import job_id_contextvar
+from app.db.chunk_writer import insert_chunks
+from app.db.models import Chunk, Document
+from app.db.session import AsyncSessionLocal, bump_corpus_version
+from app.utils.embedding_cache import get_embeddings
+from app.utils.ingestion_utils import (
+    compute_chunk_hash,
+    diff_chunks,
+    ingestion_byte_budget,
+    lock_documents,
+)
+from app.utils.jobs import Job, JobStage
+from sqlalchemy import Integer, any_, bindparam, delete, func, select
+from sqlalchemy.dialects import postgresql
+
+logger = getLogger(__name__)
+
+PIPELINE_STAGES = ("parse", "embed", "write")
+
+
+@dataclass
+class StageStats:
+    """Number of chunks processed by a pipeline stage, and the time it was busy for."""
+
+    n_chunks: int = 0
+    busy_seconds: float = 0.0
+
+    def add(self, n_chunks: int, seconds: float) -> None:
+        """Record n_chunks processed in the given number of seconds."""
+        self.n_chunks += n_chunks
+        self.busy_seconds += seconds
+
+    @property
+    def throughput(self) -> float:
+        """Chunks processed per busy second."""
+        return self.n_chunks / self.busy_seconds if self.busy_seconds > 0 else 0.0
+
+
+@dataclass
+class DocumentIngestion:
+    """State of a document going through the ingestion pipeline."""
+
+    job: Job
+    pdf_path: str
+    incremental: bool
+    content_hash: Optional[str]
+    done: asyncio.Future
+    # Rows of all chunks of the new version of the document, in order; the new ones get
+    # an "embedding" key once embedded
+    rows: List[dict] = field(default_factory=list)
+    n_batches_sent: int = 0
+    n_batches_embedded: int = 0
+    is_parsed: bool = False
+    is_finished: bool = False
+    error: Optional[Exception] = None
+    embedding_cache_hits: int = 0
+    embedding_cache_misses: int = 0
+    stats: Dict[str, StageStats] = field(
+        default_factory=lambda: {stage: StageStats() for stage in PIPELINE_STAGES}
+    )
+
+    @property
+    def is_ready(self) -> bool:
+        """Whether all chunks of the document are parsed and embedded."""
+        return self.is_parsed and self.n_batches_embedded == self.n_batches_sent
+
+
+class IngestionPipeline:
+    """Pipeline of parse, embed and write stages, connected by bounded queues.
+
+    Each stage runs in its own worker tasks, so that the stages of different documents
+    overlap: while a document is being parsed, the chunks of another are being embedded
+    and a third one is being written. Chunks flow from the parse stage to the embed stage
+    in batches, and are written once all chunks of their document are embedded, in a
+    single transaction per document. Batches are sent as they are chunked only when parsing
+    runs in a thread (`DOCLING_PROCESS_POOL_SIZE=0`): with the process pool, they are sent
+    once the whole document is chunked (see `iter_pdf_chunks_async`).
+
+    Parameters
+    ----------
+    n_parse_workers : int
+        Number of documents parsed at the same time.
+    n_embed_workers : int
+        Number of chunk batches embedded at the same time.
+    batch_size : int
+        Number of chunks in each batch sent from the parse stage to the embed stage.
+    queue_size : int
+        Maximum number of items waiting between two stages: a stage waits for room in
+        its output queue when the next stage is slower.
+    """
+
+    def __init__(
+        self, n_parse_workers: int, n_embed_workers: int, batch_size: int, queue_size: int
+    ):
+        self.n_parse_workers = n_parse_workers
+        self.n_embed_workers = n_embed_workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self._workers = []
+        self._n_in_flight = 0
+        self._stats: Dict[str, StageStats] = {}
+        self._started_at = 0.0
+
+    def start(self) -> None:
+        """Start the worker tasks of the stages (must be called from within the event loop)."""
+        self._parse_queue = asyncio.Queue(maxsize=self.queue_size)
+        self._embed_queue = asyncio.Queue(maxsize=self.queue_size)
+        # Documents to check for readiness, after a batch is embedded or parsing is done
+        self._write_queue = asyncio.Queue(maxsize=self.queue_size)
+        self._workers = (
+            [asyncio.create_task(self._parse_worker()) for _ in range(self.n_parse_workers)]
+            + [asyncio.create_task(self._embed_worker()) for _ in range(self.n_embed_workers)]
+            + [asyncio.create_task(self._write_worker())]
+        )
+
+    async def stop(self) -> None:
+        """Stop the worker tasks of the stages, abandoning the documents in the pipeline."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def ingest(
+        self, job: Job, pdf_path: str, incremental: bool, content_hash: Optional[str]
+    ) -> None:
+        """Ingest a PDF document through the pipeline, and wait until it is written.
+
+        Raises the error of the first stage failing for this document, if any.
+        """
+        if self._n_in_flight == 0:
+            self._stats = {stage: StageStats() for stage in PIPELINE_STAGES}
+            self._started_at = time.perf_counter()
+        self._n_in_flight += 1
+        document = DocumentIngestion(
+            job=job,
+            pdf_path=pdf_path,
+            incremental=incremental,
+            content_hash=content_hash,
+            done=asyncio.get_running_loop().create_future(),
+        )
+        try:
+            await self._parse_queue.put(document)
+            await document.done
+        finally:
+            job.stage_throughput = {
+                stage: round(stats.throughput, 1) for stage, stats in document.stats.items()
+            }
+            self._n_in_flight -= 1
+            if self._n_in_flight == 0:
+                self._log_stats()
+
+    def _record(self, document: DocumentIngestion, stage: str, n_chunks: int, start: float):
+        """Record the chunks processed by a stage since start, for the document and overall."""
+        seconds = time.perf_counter() - start
+        document.stats[stage].add(n_chunks, seconds)
+        self._stats[stage].add(n_chunks, seconds)
+        if stage != "parse":
+            observe_stage("ingest", stage, seconds)
+
+    def _log_stats(self) -> None:
+        """Log the throughput of each stage since the pipeline was last idle."""
+        elapsed = time.perf_counter() - self._started_at
+        logger.info(
+            f"Ingestion pipeline idle after {elapsed:.1f}s. Stage throughput: "
+            + ", ".join(
+                f"{stage} {stats.n_chunks} chunks in {stats.busy_seconds:.1f}s busy "
+                f"({stats.throughput:.1f} chunks/s)"
+                for stage, stats in self._stats.items()
+            )
+        )
+
+    async def _parse_worker(self) -> None:
+        """Parse and chunk documents, sending the new chunks to the embed stage in batches."""
+        while True:
+            document = await self._parse_queue.get()
+            # Tie the logs of this stage to the job of the document
+            with_job_logs(document.job)
+            try:
+                await self._parse(document)
+            except Exception as e:
+                logger.exception(f"Error parsing document {document.job.doc_name}.")
+                document.error = e
+            finally:
+                document.is_parsed = True
+                await self._write_queue.put(document)
+
+    async def _parse(self, document: DocumentIngestion) -> None:
+        """Parse and chunk a document (see `_parse_worker`)."""
+        # Imported here, as docling is slow to import and only needed to parse documents
+        from app.utils.docling_utils import iter_pdf_chunks_async
+
+        job = document.job
+        # Chunks whose content is already stored are not embedded again (if incremental)
+        unmatched_hashes = defaultdict(int)
+        if document.incremental:
+            async with AsyncSessionLocal() as db:
+                select_query = select(Chunk.content_hash).filter(Chunk.doc_name == job.doc_name)
+                for content_hash in (await db.execute(select_query)).scalars():
+                    unmatched_hashes[content_hash] += 1
+
+        try:
+            # Wait until there is room for this document in the parsing memory
+            async with ingestion_byte_budget.reserve(os.path.getsize(document.pdf_path)):
+                logger.info("Parsing and chunking the document...")
+                job.set_stage(JobStage.PARSING)
+                start = parsing_started = time.perf_counter()
+                chunking_started = None
+
+                def on_chunking() -> None:
+                    nonlocal chunking_started
+                    chunking_started = time.perf_counter()
+                    job.set_stage(JobStage.CHUNKING)
+
+                # Close the generator even on errors, so that it stops before the file is removed
+                async with aclosing(
+                    iter_pdf_chunks_async(
+                        pdf_filename=job.doc_name,
+                        pdf_path=document.pdf_path,
+                        logger=logger,
+                        on_chunking=on_chunking,
+                        batch_size=self.batch_size,
+                    )
+                ) as batches:
+                    async for parsed_chunks in batches:
+                        rows_to_embed = []
+                        for parsed_chunk in parsed_chunks:
+                            row = {
+                                "doc_name": job.doc_name,
+                                "section_headers": parsed_chunk.section_headers,
+                                "pages": parsed_chunk.pages,
+                                "serialized_chunk": parsed_chunk.serialized_chunk,
+                                "content_hash": compute_chunk_hash(
+                                    parsed_chunk.serialized_chunk,
+                                    parsed_chunk.section_headers,
+                                    parsed_chunk.pages,
+                                ),
+                            }
+                            document.rows.append(row)
+                            if unmatched_hashes[row["content_hash"]] > 0:
+                                unmatched_hashes[row["content_hash"]] -= 1
+                            else:
+                                rows_to_embed.append(row)
+                        self._record(document, "parse", len(parsed_chunks), start)
+                        if rows_to_embed:
+                            document.n_batches_sent += 1
+                            await self._embed_queue.put((document, rows_to_embed))
+                        start = time.perf_counter()
+                # Parsing and chunking are timed separately for the metrics (but as a single
+                # pipeline stage, as both run in the same worker)
+                chunking_started = chunking_started or time.perf_counter()
+                observe_stage("ingest", "parse", chunking_started - parsing_started)
+                observe_stage("ingest", "chunk", time.perf_counter() - chunking_started)
+        finally:
+            os.remove(document.pdf_path)
+        logger.info(f"Successfully parsed and chunked the document ({len(document.rows)} chunks).")
+        job.n_chunks = len(document.rows)
+        job.set_stage(JobStage.EMBEDDING)
+
+    async def _embed_worker(self) -> None:
+        """Embed batches of chunks, re-using the cached embeddings of known chunks."""
+        while True:
+            document, rows = await self._embed_queue.get()
+            with_job_logs(document.job)
+            try:
+                # Batches of a document which already failed are not embedded
+                if document.error is None:
+                    start = time.perf_counter()
+                    embeddings, cache_stats = await get_embeddings(
+                        [row["serialized_chunk"] for row in rows]
+                    )
+                    for row, embedding in zip(rows, embeddings):
+                        row["embedding"] = embedding
+                    document.embedding_cache_hits += cache_stats.hits
+                    document.embedding_cache_misses += cache_stats.misses
+                    self._record(document, "embed", len(rows), start)
+            except Exception as e:
+                logger.exception(f"Error embedding chunks of document {document.job.doc_name}.")
+                document.error = document.error or e
+            finally:
+                document.n_batches_embedded += 1
+                await self._write_queue.put(document)
+
+    async def _write_worker(self) -> None:
+        """Write the documents whose chunks are all embedded, one after the other."""
+        while True:
+            document = await self._write_queue.get()
+            if document.is_finished or not document.is_ready:
+                continue
+            document.is_finished = True
+            with_job_logs(document.job)
+            # The ingestion was cancelled (e.g. its job, at shutdown): nothing to write
+            if document.done.done():
+                logger.info(f"Skipping cancelled ingestion of {document.job.doc_name}.")
+                continue
+            if document.error is not None:
+                document.done.set_exception(document.error)
+                continue
+            try:
+                await self._write(document)
+                if not document.done.done():
+                    document.done.set_result(None)
+            except Exception as e:
+                logger.exception(f"Error writing document {document.job.doc_name}.")
+                if not document.done.done():
+                    document.done.set_exception(e)
+
+    async def _write(self, document: DocumentIngestion) -> None:
+        """Replace the stored chunks of a document by its new ones, in a single transaction.
+
+        Chunks are diffed again against the stored ones, under the lock of the document:
+        they may have changed since the document was parsed (e.g. ingested concurrently),
+        in which case the new chunks which were not embedded yet are embedded now.
+        """
+        job = document.job
+        job.set_stage(JobStage.WRITING)
+        start = time.perf_counter()
+        logger.info("Start transaction: Updating rows of Chunk table...")
+        async with AsyncSessionLocal() as db:
+            try:
+                # Serialize concurrent ingestions of the same doc_name
+                await lock_documents(db, [job.doc_name])
+
+                # 1. Find out which rows need to be deleted and inserted
+                select_query = select(Chunk.chunk_id, Chunk.content_hash).filter(
+                    Chunk.doc_name == job.doc_name
+                )
+                existing_chunks = (await db.execute(select_query)).all()
+                if document.incremental:
+                    rows_to_insert, ids_to_delete = diff_chunks(existing_chunks, document.rows)
+                else:
+                    rows_to_insert = document.rows
+                    ids_to_delete = [chunk_id for chunk_id, _ in existing_chunks]
+                logger.info(
+                    f"Chunks to insert: {len(rows_to_insert)}, to delete: {len(ids_to_delete)}, "
+                    f"unchanged: {len(document.rows) - len(rows_to_insert)}."
+                )
+                rows_to_embed = [row for row in rows_to_insert if "embedding" not in row]
+                if rows_to_embed:
+                    logger.info(f"Embedding {len(rows_to_embed)} chunks changed since parsing.")
+                    embeddings, _ = await get_embeddings(
+                        [row["serialized_chunk"] for row in rows_to_embed]
+                    )
+                    for row, embedding in zip(rows_to_embed, embeddings):
+                        row["embedding"] = embedding
+
+                # 2. Delete the removed rows
+                if ids_to_delete:
+                    ids_param = bindparam("ids", ids_to_delete, type_=postgresql.ARRAY(Integer))
+                    delete_query = delete(Chunk).filter(Chunk.chunk_id == any_(ids_param))
+                    await db.execute(delete_query)
+
+                # 3. Write the new rows to the database in bulk
+                await insert_chunks(db, rows_to_insert)
+
+                # 4. Record the version of the document the chunks come from
+                if document.content_hash is not None:
+                    insert_document = postgresql.insert(Document).values(
+                        doc_name=job.doc_name, content_hash=document.content_hash
+                    )
+                    await db.execute(
+                        insert_document.on_conflict_do_update(
+                            index_elements=[Document.doc_name],
+                            set_={"content_hash": document.content_hash, "ingested_at": func.now()},
+                        )
+                    )
+
+                await db.commit()
+            except Exception as e:
+                logger.error(f"Error updating rows of Chunk table: {str(e)}")
+                await db.rollback()
+                raise
+
+            # Invalidate the answers cached for the previous version of the corpus
+            if rows_to_insert or ids_to_delete:
+                await bump_corpus_version(db)
+
+        self._record(document, "write", len(rows_to_insert), start)
+        logger.info(
+            f"Successfully inserted {len(rows_to_insert)} new rows into and deleted "
+            f"{len(ids_to_delete)} rows from Chunk table."
+        )
+        job.n_inserted = len(rows_to_insert)
+        job.n_deleted = len(ids_to_delete)
+        job.n_unchanged = len(document.rows) - len(rows_to_insert)
+        job.embedding_cache_hits = document.embedding_cache_hits
+        job.embedding_cache_misses = document.embedding_cache_misses
+
+
+def with_job_logs(job: Job) -> None:
+    """Tie the following logs (and metrics) of the current task to a job."""
+    job_id_contextvar.set(job.job_id)
+    endpoint_contextvar.set("ingestion")
+
+
+ingestion_pipeline = IngestionPipeline(
+    n_parse_workers=app_config.INGEST_PARSE_WORKERS,
+    n_embed_workers=app_config.INGEST_EMBED_WORKERS,
+    batch_size=app_config.INGEST_PIPELINE_BATCH_SIZE,
+    queue_size=app_config.INGEST_PIPELINE_QUEUE_SIZE,
+)
+
+
+async def ingest_pdf(
+    job: Job, pdf_path: str, incremental: bool = True, content_hash: Optional[str] = None
+) -> None:
+    """Ingest a PDF document in the database, reporting progress on the job.
+
+    The PDF is read from the (spooled) file at `pdf_path`, which is deleted once parsed.
+    Its `content_hash` (if given) is recorded in the documents table along with its chunks.
+
+    Breakdown (see `IngestionPipeline`):
+    1) Parse/Chunk document, and diff chunks against the stored ones of the same doc_name
+    2) Embed each new chunk, in batches (as soon as they are chunked, when parsing in a
+       thread)
+    3) Delete removed chunks and insert new ones (or replace all if not incremental), and
+       record the hash of the document (if given)
+    """
+    await ingestion_pipeline.ingest(job, pdf_path, incremental, content_hash)
@@ -0,0 +1,158 @@
+"""Utilities for ingesting documents (parsing, chunking, embedding, writing) in the database."""
+import hashlib
+import json
+import os
+import tempfile
+from collections import defaultdict
+from logging import getLogger
+from typing import BinaryIO, List, Optional, Tuple
+
+from app.core.config import app_config
+from app.db.models import Chunk, Document
+from app.db.session import AsyncSessionLocal, bump_corpus_version
+from app.utils.concurrency import ByteBudget
+from app.utils.jobs import JobQueue
+from sqlalchemy import Text, any_, bindparam, delete, func, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = getLogger(__name__)
+
+ingestion_queue = JobQueue(
+    n_workers=app_config.INGEST_MAX_WORKERS,
+    max_queued_jobs=app_config.INGEST_QUEUE_MAX_SIZE,
+    max_finished_jobs=app_config.INGEST_JOBS_RETENTION,
+)
+
+# Bytes of documents being parsed at the same time (parsing memory grows with the file size)
+ingestion_byte_budget = ByteBudget(capacity=app_config.INGEST_MAX_INFLIGHT_BYTES)
+
+# Size of the blocks in which uploads are copied to disk
+SPOOL_BLOCK_SIZE = 1024**2
+
+
+class UploadTooLargeError(ValueError):
+    """Raised when an uploaded file exceeds the maximum upload size."""
+
+
+def spool_upload(stream: BinaryIO, max_bytes: int) -> Tuple[str, int, str]:
+    """Copy an uploaded file to a temporary file on disk, block by block, and hash it.
+
+    Parameters
+    ----------
+    stream : BinaryIO
+        The uploaded file, read from its current position.
+    max_bytes : int
+        Maximum size of the file, in bytes.
+
+    Returns
+    -------
+    Tuple[str, int, str]
+        The path of the temporary ".pdf" file (to be deleted by the caller), its size, and
+        its SHA-256 hash (hex digest, see `Document.content_hash`).
+
+    Raises
+    ------
+    UploadTooLargeError
+        If the file is larger than max_bytes (the temporary file is then deleted).
+    """
+    n_bytes = 0
+    file_hash = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(
+        suffix=".pdf", dir=app_config.UPLOAD_SPOOL_DIR, delete=False
+    ) as spool_file:
+        try:
+            while block := stream.read(SPOOL_BLOCK_SIZE):
+                n_bytes += len(block)
+                if n_bytes > max_bytes:
+                    raise UploadTooLargeError(f"File is larger than {max_bytes} bytes.")
+                spool_file.write(block)
+                file_hash.update(block)
+        except BaseException:
+            spool_file.close()
+            os.remove(spool_file.name)
+            raise
+
+    return spool_file.name, n_bytes, file_hash.hexdigest()
+
+
+def compute_chunk_hash(serialized_chunk: str, section_headers: List[str], pages: List[int]) -> str:
+    """Return the hash identifying the content (text and metadata) of a chunk row."""
+    content = json.dumps([serialized_chunk, section_headers, pages], ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def diff_chunks(
+    existing_chunks: List[Tuple[int, Optional[str]]], new_rows: List[dict]
+) -> Tuple[List[dict], List[int]]:
+    """Compare the stored chunks of a document with the new ones.
+
+    Chunks are matched by content hash, as a multiset: if the same content appears
+    twice in the new document but once in the stored one, one row is kept and one
+    is inserted. Stored rows without a content hash never match.
+
+    Parameters
+    ----------
+    existing_chunks : List[Tuple[int, Optional[str]]]
+        The (chunk_id, content_hash) pairs of the stored chunks of the document.
+    new_rows : List[dict]
+        The new chunk rows of the document, each with a "content_hash" key.
+
+    Returns
+    -------
+    Tuple[List[dict], List[int]]
+        The new rows to insert, and the chunk_ids of the stored rows to delete.
+    """
+    unmatched_ids = defaultdict(list)
+    for chunk_id, content_hash in existing_chunks:
+        unmatched_ids[content_hash].append(chunk_id)
+
+    rows_to_insert = []
+    for row in new_rows:
+        if unmatched_ids.get(row["content_hash"]):
+            unmatched_ids[row["content_hash"]].pop()
+        else:
+            rows_to_insert.append(row)
+    ids_to_delete = [chunk_id for chunk_ids in unmatched_ids.values() for chunk_id in chunk_ids]
+
+    return rows_to_insert, ids_to_delete
+
+
+async def lock_documents(db: AsyncSession, doc_names: List[str]) -> None:
+    """Lock documents until the end of the transaction (other documents are not locked).
+
+    Writes to the chunks of a document take its lock, so that they are serialized.
+    """
+    # Locks are taken in a consistent order, so that concurrent transactions don't deadlock
+    for doc_name in sorted(set(doc_names)):
+        await db.execute(select(func.pg_advisory_xact_lock(func.hashtext(doc_name))))
+
+
+async def delete_documents(doc_names: List[str]) -> int:
+    """Delete documents and their chunks from the database.
+
+    Returns
+    -------
+    int
+        The number of deleted chunks.
+    """
+    if not doc_names:
+        return 0
+
+    async with AsyncSessionLocal() as db:
+        try:
+            await lock_documents(db, doc_names)
+            doc_names_param = bindparam("doc_names", doc_names, type_=postgresql.ARRAY(Text))
+            result = await db.execute(delete(Chunk).filter(Chunk.doc_name == any_(doc_names_param)))
+            await db.execute(delete(Document).filter(Document.doc_name == any_(doc_names_param)))
+            await db.commit()
+        except Exception as e:
+            logger.error(f"Error deleting documents {doc_names}: {str(e)}")
+            await db.rollback()
+            raise
+
+        # Invalidate the answers cached for the previous version of the corpus
+        await bump_corpus_version(db)
+
+    logger.info(f"Deleted {len(doc_names)} documents ({result.rowcount} chunks).")
+    return result.rowcount
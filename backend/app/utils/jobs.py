@@ -0,0 +1,149 @@
+"""In-process queue of background jobs, run by a bounded number of workers."""
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from enum import Enum
+from logging import getLogger
+from typing import Awaitable, Callable, Dict, Optional
+
+from app.core.middleware import job_id_contextvar
+from pydantic import BaseModel, Field, PrivateAttr
+
+logger = getLogger(__name__)
+
+
+class JobStage(str, Enum):
+    """Stage of a background job."""
+
+    QUEUED = "queued"
+    PARSING = "parsing"
+    CHUNKING = "chunking"
+    EMBEDDING = "embedding"
+    WRITING = "writing"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class Job(BaseModel):
+    """Model of the status and progress of a background ingestion job."""
+
+    job_id: str
+    doc_name: str
+    stage: JobStage = JobStage.QUEUED
+    n_chunks: Optional[int] = None
+    n_inserted: Optional[int] = None
+    n_deleted: Optional[int] = None
+    n_unchanged: Optional[int] = None
+    embedding_cache_hits: Optional[int] = None
+    embedding_cache_misses: Optional[int] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    # Seconds spent in each stage (queued, parsing, chunking, ...)
+    stage_durations: Dict[str, float] = {}
+    # Chunks processed per second by each ingestion pipeline stage (parse, embed, write)
+    stage_throughput: Dict[str, float] = {}
+    error: Optional[str] = None
+
+    _stage_started: float = PrivateAttr(default_factory=time.perf_counter)
+
+    @property
+    def is_finished(self) -> bool:
+        """Whether the job is done or failed."""
+        return self.stage in (JobStage.DONE, JobStage.FAILED)
+
+    def set_stage(self, stage: JobStage) -> None:
+        """Move the job to a new stage, recording how long the previous one took."""
+        now = time.perf_counter()
+        self.stage_durations[self.stage.value] = round(now - self._stage_started, 3)
+        self._stage_started = now
+        self.stage = stage
+        if self.started_at is None:
+            self.started_at = datetime.now(timezone.utc)
+        if self.is_finished:
+            self.finished_at = datetime.now(timezone.utc)
+
+
+class JobQueue:
+    """Bounded queue of background jobs, run by a fixed number of worker tasks.
+
+    Jobs are kept in memory, so their status is only visible from the process that
+    runs them. Finished jobs are kept for inspection, up to `max_finished_jobs`.
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of jobs run at the same time.
+    max_queued_jobs : int
+        Maximum number of jobs waiting to be run; `submit()` fails beyond that.
+    max_finished_jobs : int
+        Number of finished jobs whose status is kept, the oldest ones are forgotten first.
+    """
+
+    def __init__(self, n_workers: int, max_queued_jobs: int, max_finished_jobs: int):
+        self.n_workers = n_workers
+        self.max_queued_jobs = max_queued_jobs
+        self.max_finished_jobs = max_finished_jobs
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers = []
+
+    def start(self) -> None:
+        """Start the worker tasks (must be called from within the event loop)."""
+        self._queue = asyncio.Queue(maxsize=self.max_queued_jobs)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.n_workers)]
+
+    async def stop(self) -> None:
+        """Stop the worker tasks, cancelling the running jobs."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Return the job with the given id, if known."""
+        return self._jobs.get(job_id)
+
+    def free_slots(self) -> int:
+        """Return the number of jobs that can be submitted before the queue is full."""
+        if self._queue.maxsize <= 0:
+            return sys.maxsize
+        return self._queue.maxsize - self._queue.qsize()
+
+    def submit(self, job: Job, run: Callable[[Job], Awaitable[None]]) -> None:
+        """Queue a job, which will be run as `await run(job)`.
+
+        Raises
+        ------
+        asyncio.QueueFull
+            If too many jobs are already waiting to be run.
+        """
+        self._queue.put_nowait((job, run))
+        self._jobs[job.job_id] = job
+        self._forget_finished_jobs()
+
+    def _forget_finished_jobs(self) -> None:
+        """Forget the oldest finished jobs beyond the retention limit."""
+        finished_ids = [job_id for job_id, job in self._jobs.items() if job.is_finished]
+        for job_id in finished_ids[: max(0, len(finished_ids) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+    async def _work(self) -> None:
+        """Run queued jobs one after the other."""
+        while True:
+            job, run = await self._queue.get()
+            # Tie the logs of the job to the request that submitted it
+            job_id_contextvar.set(job.job_id)
+            try:
+                await run(job)
+                job.set_stage(JobStage.DONE)
+                logger.info(f"Job {job.job_id} done in {job.stage_durations}.")
+            except Exception as e:
+                logger.exception(f"Job {job.job_id} failed in stage {job.stage.value}.")
+                job.error = str(e)
+                job.set_stage(JobStage.FAILED)
+            finally:
+                self._queue.task_done()
+                job_id_contextvar.set(None)
@@ -0,0 +1 @@
+"""Benchmarks of the backend, against local stand-ins of its external services."""
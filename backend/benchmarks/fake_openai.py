@@ -0,0 +1,199 @@
+"""Local stand-in for the OpenAI API (embeddings and chat completions), for benchmarks.
+
+Embeddings are deterministic unit vectors derived from the hash of each input, so that
+repeated runs retrieve the same chunks. Chat completions return a fixed answer, as
+structured JSON when a response format is requested, and can be streamed. Latency and
+rate limiting (429 responses) are simulated to exercise the retry paths of the backend.
+
+Usage:
+    python -m benchmarks.fake_openai --port 8100 --latency-ms 50 --rate-limit 0.01
+    OPENAI_BASE_URL=http://localhost:8100/v1 uvicorn app.main:app
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+import uuid
+from typing import List, Optional, Union
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+
+class FakeOpenAIOptions(BaseModel):
+    """Options of the fake OpenAI server."""
+
+    # Latency of each request, plus a per-token latency (prompt tokens for embeddings,
+    # completion tokens for chat completions)
+    latency_ms: float = 50.0
+    latency_ms_per_token: float = 0.0
+    # Probability of answering a request with a 429 rate limit error
+    rate_limit: float = 0.0
+    retry_after: float = 0.1
+    # Dimensions of the embeddings, if not given in the request
+    dimensions: int = 1_536
+    # Number of words of the generated answers
+    answer_words: int = 60
+
+
+class EmbeddingRequest(BaseModel):
+    """Model for the request to the embeddings endpoint."""
+
+    input: Union[str, List[str]]
+    model: str
+    dimensions: Optional[int] = None
+
+
+class ChatCompletionRequest(BaseModel):
+    """Model for the request to the chat completions endpoint."""
+
+    model: str
+    messages: List[dict]
+    response_format: Optional[dict] = None
+    stream: bool = False
+    stream_options: Optional[dict] = None
+
+
+def count_tokens(text: str) -> int:
+    """Return an approximate number of tokens of a text (about 4 characters per token)."""
+    return max(1, len(text) // 4)
+
+
+def fake_embedding(text: str, dimensions: int) -> List[float]:
+    """Return a deterministic unit vector for a text."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions, dtype=np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def fake_answer(request: ChatCompletionRequest, n_words: int) -> str:
+    """Return the content of the answer to a chat completion request."""
+    words = " ".join(f"word{i}" for i in range(n_words))
+    if request.response_format is None:
+        return f"benchmark query {words}"
+    # Structured output: the fields of the JSON schema of the response format, filled in
+    schema = request.response_format.get("json_schema", {}).get("schema", {})
+    answer = {}
+    for name, field in schema.get("properties", {}).items():
+        answer[name] = ["benchmark.pdf"] if field.get("type") == "array" else words
+    return json.dumps(answer)
+
+
+def create_app(options: FakeOpenAIOptions) -> FastAPI:
+    """Create the app of the fake OpenAI server."""
+    app = FastAPI()
+
+    async def simulate(n_tokens: int) -> Optional[JSONResponse]:
+        """Wait for the simulated latency, and return a 429 response if rate limited."""
+        if random.random() < options.rate_limit:
+            return JSONResponse(
+                status_code=429,
+                content={"error": {"message": "Rate limit reached.", "type": "requests"}},
+                headers={"retry-after": str(options.retry_after)},
+            )
+        await asyncio.sleep((options.latency_ms + options.latency_ms_per_token * n_tokens) / 1_000)
+        return None
+
+    @app.post("/v1/embeddings")
+    async def embeddings(req: EmbeddingRequest):
+        """Embed the inputs."""
+        inputs = [req.input] if isinstance(req.input, str) else req.input
+        n_tokens = sum(count_tokens(text) for text in inputs)
+        error = await simulate(n_tokens)
+        if error is not None:
+            return error
+        dimensions = req.dimensions or options.dimensions
+        return {
+            "object": "list",
+            "model": req.model,
+            "data": [
+                {"object": "embedding", "index": i, "embedding": fake_embedding(text, dimensions)}
+                for i, text in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": n_tokens, "total_tokens": n_tokens},
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(req: ChatCompletionRequest):
+        """Answer the conversation."""
+        content = fake_answer(req, options.answer_words)
+        prompt_tokens = sum(count_tokens(str(message.get("content"))) for message in req.messages)
+        completion_tokens = count_tokens(content)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        completion = {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "created": int(time.time()),
+            "model": req.model,
+        }
+        if not req.stream:
+            error = await simulate(completion_tokens)
+            if error is not None:
+                return error
+            return {
+                **completion,
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": usage,
+            }
+
+        # Streamed: the first token after the base latency, then the others at the
+        # per-token latency
+        error = await simulate(0)
+        if error is not None:
+            return error
+
+        def chunk(choices: list, chunk_usage: Optional[dict] = None) -> str:
+            data = {**completion, "object": "chat.completion.chunk", "choices": choices}
+            if chunk_usage is not None:
+                data["usage"] = chunk_usage
+            return f"data: {json.dumps(data)}\n\n"
+
+        async def events():
+            pieces = [content[i : i + 4] for i in range(0, len(content), 4)]
+            for i, piece in enumerate(pieces):
+                delta = {"content": piece} if i else {"role": "assistant", "content": piece}
+                yield chunk([{"index": 0, "delta": delta, "finish_reason": None}])
+                await asyncio.sleep(options.latency_ms_per_token / 1_000)
+            yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if (req.stream_options or {}).get("include_usage"):
+                yield chunk([], usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def main() -> None:
+    """Run the fake OpenAI server."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    for name, field in FakeOpenAIOptions.model_fields.items():
+        parser.add_argument(
+            f"--{name.replace('_', '-')}", type=field.annotation, default=field.default
+        )
+    args = parser.parse_args()
+    options = FakeOpenAIOptions(
+        **{name: getattr(args, name) for name in FakeOpenAIOptions.model_fields}
+    )
+    uvicorn.run(create_app(options), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Load driver of the backend, reporting throughput and latency percentiles per endpoint.
+
+Scenarios:
+- ingest: upload the PDF documents of a corpus directory (see `make_corpus`), and wait
+  for their ingestion jobs; latency is from upload to the end of the job
+- query: send the questions of the corpus to a query endpoint, with a fixed number of
+  concurrent clients; for /v1/query_stream, the time to the first token of the answer is
+  reported too
+
+Usage:
+    python -m benchmarks.load ingest --corpus-dir /tmp/corpus --concurrency 4
+    python -m benchmarks.load query --corpus-dir /tmp/corpus --concurrency 16 --n-requests 500
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+import httpx
+import numpy as np
+
+# Seconds between two polls of the status of an ingestion job
+JOB_POLL_INTERVAL = 0.2
+# Lines starting the server-sent events of the first piece of a streamed answer
+TOKEN_EVENT_LINES = ("event: token", "event: answer")
+
+
+class LatencyRecorder:
+    """Latencies and errors of the requests to each endpoint."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def record(self, endpoint: str, seconds: float, ok: bool) -> None:
+        """Record the latency of a request (only successful requests count in percentiles)."""
+        if ok:
+            self.latencies[endpoint].append(seconds)
+        else:
+            self.errors[endpoint] += 1
+
+    def report(self, elapsed: float) -> dict:
+        """Return the throughput and latency percentiles (in ms) of each endpoint."""
+        report = {}
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            latencies = np.asarray(self.latencies[endpoint]) * 1_000
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else [0] * 3
+            report[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors[endpoint],
+                "throughput_rps": round(len(latencies) / elapsed, 2),
+                "p50_ms": round(float(p50), 1),
+                "p95_ms": round(float(p95), 1),
+                "p99_ms": round(float(p99), 1),
+            }
+        return report
+
+
+def print_report(report: dict, elapsed: float) -> None:
+    """Print the report as a table."""
+    print(f"\nElapsed: {elapsed:.1f}s")
+    header = f"{'endpoint':<32}{'requests':>10}{'errors':>8}{'req/s':>9}"
+    print(header + "".join(f"{p:>10}" for p in ["p50 ms", "p95 ms", "p99 ms"]))
+    for endpoint, stats in report.items():
+        print(
+            f"{endpoint:<32}{stats['requests']:>10}{stats['errors']:>8}"
+            f"{stats['throughput_rps']:>9}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+            f"{stats['p99_ms']:>10}"
+        )
+
+
+async def ingest_document(
+    client: httpx.AsyncClient, pdf_path: str, recorder: LatencyRecorder, timeout: float
+) -> None:
+    """Upload a document, and wait (at most timeout seconds) until its ingestion job is finished.
+
+    The job counts as an error if it fails, if it isn't finished in time, or if its status
+    can't be read.
+    """
+    start = time.perf_counter()
+    try:
+        with open(pdf_path, "rb") as f:
+            files = {"file": (os.path.basename(pdf_path), f, "application/pdf")}
+            response = await client.post("/v1/ingest_document", files=files)
+        ok = response.is_success
+    except httpx.HTTPError:
+        ok = False
+    recorder.record("/v1/ingest_document", time.perf_counter() - start, ok)
+    if not ok:
+        return
+
+    stage = None
+    try:
+        job_id = response.json()["job_id"]
+        while time.perf_counter() - start < timeout:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            job_response = await client.get(f"/v1/jobs/{job_id}")
+            # e.g. 404 once the job is evicted from the retained jobs
+            job_response.raise_for_status()
+            stage = job_response.json()["stage"]
+            if stage in ("done", "failed"):
+                break
+    except (httpx.HTTPError, ValueError, KeyError):
+        stage = None
+    recorder.record("ingestion job", time.perf_counter() - start, stage == "done")
+
+
+async def query(
+    client: httpx.AsyncClient, endpoint: str, question: str, recorder: LatencyRecorder
+) -> None:
+    """Send a question to a query endpoint, and read the whole response.
+
+    For the streaming endpoint, the time to the first piece of the answer (the first
+    "token" event, or the "answer" event of a cached answer) is also recorded.
+    """
+    start = time.perf_counter()
+    try:
+        if endpoint == "/v1/query_stream":
+            async with client.stream("POST", endpoint, json={"query": question}) as response:
+                first_token_seconds = None
+                async for line in response.aiter_lines():
+                    if first_token_seconds is None and line in TOKEN_EVENT_LINES:
+                        first_token_seconds = time.perf_counter() - start
+                ok = response.is_success
+            recorder.record(
+                f"{endpoint} (first token)",
+                first_token_seconds or 0.0,
+                ok and first_token_seconds is not None,
+            )
+        else:
+            response = await client.post(endpoint, json={"query": question})
+            ok = response.is_success
+    except httpx.HTTPError:
+        ok = False
+    recorder.record(endpoint, time.perf_counter() - start, ok)
+
+
+async def run(args: argparse.Namespace) -> None:
+    """Run the scenario with a fixed number of concurrent clients."""
+    if args.scenario == "ingest":
+        pdf_paths = sorted(glob.glob(os.path.join(args.corpus_dir, "*.pdf")))
+        tasks = [
+            lambda client, recorder, path=path: ingest_document(
+                client, path, recorder, args.timeout
+            )
+            for path in pdf_paths
+        ]
+    else:
+        with open(os.path.join(args.corpus_dir, "questions.json")) as f:
+            questions = json.load(f)
+        tasks = [
+            lambda client, recorder, i=i: query(
+                client, args.endpoint, questions[i % len(questions)], recorder
+            )
+            for i in range(args.n_requests)
+        ]
+
+    recorder = LatencyRecorder()
+    queue = asyncio.Queue()
+    for task in tasks:
+        queue.put_nowait(task)
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        while not queue.empty():
+            await queue.get_nowait()(client, recorder)
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+    report = recorder.report(elapsed)
+    print_report(report, elapsed)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"scenario": args.scenario, "elapsed": elapsed, "endpoints": report}, f)
+
+
+def main() -> None:
+    """Parse the arguments, and run the scenario."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("scenario", choices=["ingest", "query"])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--corpus-dir", required=True)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--n-requests", type=int, default=200, help="(query scenario)")
+    parser.add_argument(
+        "--endpoint",
+        default="/v1/query",
+        choices=["/v1/query", "/v1/query_stream"],
+        help="(query scenario)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=600.0,
+        help="Timeout (s) of a request and of an ingestion job.",
+    )
+    parser.add_argument("--output", help="Path of a JSON file to write the report to.")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Generator of synthetic PDF documents and questions, for benchmarks.
+
+Documents are text-only PDFs with numbered sections of pseudo-random sentences, written
+directly (no PDF library needed). The same seed always gives the same corpus.
+
+Usage:
+    python -m benchmarks.make_corpus --out-dir /tmp/corpus --n-docs 20 --n-pages 10
+"""
+import argparse
+import json
+import os
+import random
+import zlib
+from typing import List, Tuple
+
+# Vocabulary of the generated text, with some recurring technical terms to query for
+WORDS = (
+    "system data model user query index vector database document section page table "
+    "value result process service request response latency throughput memory storage "
+    "network cache batch stream worker queue thread error retry limit budget config "
+    "the a of to and in for with on by is are was be can should must may will"
+).split()
+TERMS = ["pgvector", "HNSW", "embedding", "chunking", "docling", "retrieval", "tokenizer"]
+
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792
+MARGIN, LINE_HEIGHT, LINES_PER_PAGE, CHARS_PER_LINE = 72, 14, 46, 90
+
+
+def make_sentence(rng: random.Random) -> str:
+    """Return a pseudo-random sentence."""
+    words = [rng.choice(WORDS) for _ in range(rng.randint(8, 20))]
+    words[rng.randrange(len(words))] = rng.choice(TERMS)
+    return " ".join(words).capitalize() + "."
+
+
+def make_lines(rng: random.Random, n_pages: int) -> List[Tuple[str, int]]:
+    """Return the (text, font size) lines of a document of n_pages pages."""
+    lines = []
+    section = 0
+    while len(lines) < n_pages * LINES_PER_PAGE:
+        section += 1
+        lines.append((f"{section}. Section about {rng.choice(TERMS)}", 14))
+        for _ in range(rng.randint(2, 5)):
+            paragraph = " ".join(make_sentence(rng) for _ in range(rng.randint(3, 8)))
+            while paragraph:
+                cut = (
+                    paragraph.rfind(" ", 0, CHARS_PER_LINE)
+                    if len(paragraph) > CHARS_PER_LINE
+                    else -1
+                )
+                cut = len(paragraph) if cut < 0 else cut
+                lines.append((paragraph[:cut], 10))
+                paragraph = paragraph[cut:].strip()
+            lines.append(("", 10))
+    return lines[: n_pages * LINES_PER_PAGE]
+
+
+def escape_pdf_text(text: str) -> str:
+    """Escape a string for a PDF literal string."""
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path: str, title: str, lines: List[Tuple[str, int]]) -> None:
+    """Write a text-only PDF, laid out with LINES_PER_PAGE lines per page."""
+    pages = [lines[i : i + LINES_PER_PAGE] for i in range(0, len(lines), LINES_PER_PAGE)]
+    # Objects: 1 catalog, 2 pages, 3 font, 4 info, then a (page, content) pair per page
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        (
+            "<< /Type /Pages /Kids ["
+            + " ".join(f"{5 + 2 * i} 0 R" for i in range(len(pages)))
+            + f"] /Count {len(pages)} >>"
+        ).encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        f"<< /Title ({escape_pdf_text(title)}) >>".encode(),
+    ]
+    for i, page_lines in enumerate(pages):
+        content = ["BT", f"{MARGIN} {PAGE_HEIGHT - MARGIN} Td"]
+        for text, size in page_lines:
+            content.append(f"/F1 {size} Tf ({escape_pdf_text(text)}) Tj 0 -{LINE_HEIGHT} Td")
+        content.append("ET")
+        stream = zlib.compress("\n".join(content).encode("latin-1"))
+        objects.append(
+            (
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+                f"/Resources << /Font << /F1 3 0 R >> >> /Contents {6 + 2 * i} 0 R >>"
+            ).encode()
+        )
+        objects.append(
+            f"<< /Length {len(stream)} /Filter /FlateDecode >>\nstream\n".encode()
+            + stream
+            + b"\nendstream"
+        )
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref_offset = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    pdf += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    pdf += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R /Info 4 0 R >>\n"
+        f"startxref\n{xref_offset}\n%%EOF\n"
+    ).encode()
+    with open(path, "wb") as f:
+        f.write(pdf)
+
+
+def make_questions(rng: random.Random, n_questions: int) -> List[str]:
+    """Return pseudo-random questions about the terms of the corpus."""
+    templates = [
+        "How does the {term} {word} handle the {other}?",
+        "What is the {word} limit of {term}?",
+        "Which {word} should be used with {term} and {other}?",
+    ]
+    return [
+        rng.choice(templates).format(
+            term=rng.choice(TERMS), word=rng.choice(WORDS[:40]), other=rng.choice(WORDS[:40])
+        )
+        for _ in range(n_questions)
+    ]
+
+
+def main() -> None:
+    """Generate the corpus: PDF documents, and a questions.json file of questions."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--out-dir", required=True)
+    parser.add_argument("--n-docs", type=int, default=20)
+    parser.add_argument("--n-pages", type=int, default=10)
+    parser.add_argument("--n-questions", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    os.makedirs(args.out_dir, exist_ok=True)
+    for i in range(args.n_docs):
+        doc_name = f"benchmark-{i:04d}.pdf"
+        write_pdf(os.path.join(args.out_dir, doc_name), doc_name, make_lines(rng, args.n_pages))
+    with open(os.path.join(args.out_dir, "questions.json"), "w") as f:
+        json.dump(make_questions(rng, args.n_questions), f, indent=2)
+    print(f"Wrote {args.n_docs} documents of {args.n_pages} pages to {args.out_dir}.")
+
+
+if __name__ == "__main__":
+    main()
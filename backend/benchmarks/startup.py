@@ -0,0 +1,81 @@
+"""Benchmark of the import time and memory of the backend, in each serving mode.
+
+Each run imports the app in a fresh interpreter, along with the modules its startup
+loads in the given mode (docling for ingestion), without connecting to the database or
+loading the parsing models. The medians over the runs are reported.
+
+Usage:
+    python -m benchmarks.startup --modes query all --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Run in a fresh interpreter: import times and memory of one mode, as JSON
+CHILD_CODE = """
+import json, resource, sys, time
+
+start = time.perf_counter()
+import app.main
+import_seconds = time.perf_counter() - start
+from app.core.config import app_config
+if app_config.SERVES_INGESTION:
+    import app.utils.docling_utils
+startup_seconds = time.perf_counter() - start
+
+with open("/proc/self/statm") as f:
+    rss_bytes = int(f.read().split()[1]) * resource.getpagesize()
+print(json.dumps({
+    "import_s": import_seconds,
+    "startup_imports_s": startup_seconds,
+    "rss_mb": rss_bytes / 1024**2,
+    "modules": len(sys.modules),
+}))
+"""
+
+# Settings required by the app config, only used to connect (which the benchmark doesn't)
+REQUIRED_ENV = {
+    "POSTGRES_DB": "benchmark",
+    "POSTGRES_USER": "benchmark",
+    "POSTGRES_PASSWORD": "benchmark",
+    "OPENAI_API_KEY": "benchmark",
+}
+
+
+def measure(mode: str) -> dict:
+    """Import the app in a fresh interpreter in the given serving mode, and measure it."""
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**REQUIRED_ENV, **os.environ, "SERVING_MODE": mode, "LOGGING_LEVEL": "0"}
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD_CODE],
+        cwd=backend_dir,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    """Measure each serving mode, and print the medians."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--modes", nargs="+", default=["query", "ingest", "all"])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'mode':<8}{'import s':>10}{'startup s':>11}{'RSS MB':>9}{'modules':>9}")
+    for mode in args.modes:
+        runs = [measure(mode) for _ in range(args.runs)]
+        medians = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        print(
+            f"{mode:<8}{medians['import_s']:>10.2f}{medians['startup_imports_s']:>11.2f}"
+            f"{medians['rss_mb']:>9.0f}{medians['modules']:>9.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,77 @@
 """Streamlit frontend for AskTheDocs app."""
+import hashlib
+import json
+import time
+
 import requests
 import streamlit as st
 
+JOB_POLLING_INTERVAL = 1.0
+# Maximum time to wait for the ingestion of the uploaded documents, in seconds
+JOB_POLLING_TIMEOUT = 1_800.0
+
+
+def wait_for_jobs(job_ids):
+    """Poll the backend until all the given ingestion jobs are finished.
+
+    Returns True if all jobs are done, False if any of them failed or if they are not all
+    finished after JOB_POLLING_TIMEOUT seconds.
+    """
+    all_done = True
+    pending = {job_id: None for job_id in job_ids}  # job ID -> document name (once known)
+    deadline = time.monotonic() + JOB_POLLING_TIMEOUT
+    while pending:
+        for job_id in list(pending):
+            job_url = f"http://fastapi-backend:8000/v1/jobs/{job_id}"
+            try:
+                job = requests.get(job_url).json()
+            except requests.exceptions.RequestException as e:
+                st.error(f"Error checking ingestion job {job_id}: {e}")
+                return False
+            if job.get("stage") == "done":
+                del pending[job_id]
+            elif job.get("stage") == "failed" or "stage" not in job:
+                st.error(f"Error ingesting {job.get('doc_name')}: {job.get('error', job)}")
+                all_done = False
+                del pending[job_id]
+            else:
+                pending[job_id] = job.get("doc_name")
+        if pending and time.monotonic() > deadline:
+            st.error(
+                f"Ingestion not finished after {JOB_POLLING_TIMEOUT:.0f}s, still pending: "
+                + ", ".join(doc_name or job_id for job_id, doc_name in pending.items())
+            )
+            return False
+        if pending:
+            time.sleep(JOB_POLLING_INTERVAL)
+    return all_done
+
+
+def iter_sse_events(response):
+    """Yield the (event, data) pairs of a streamed server-sent events response."""
+    event, data_lines = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if line:
+            field, _, value = line.partition(":")
+            if field == "event":
+                event = value.strip()
+            elif field == "data":
+                data_lines.append(value.strip())
+        elif data_lines:
+            # An empty line ends the event
+            yield event, json.loads("\n".join(data_lines))
+            event, data_lines = "message", []
+
+
+def format_bot_answer(answer_text, answer_sources):
+    """Format the answer of the backend as a chat message."""
+    return (
+        "✅ ANSWER\n\n"
+        + f"{answer_text}\n\n"
+        + "ℹ️ SOURCES\n\n"
+        + "\n".join(f"ℹ️ {source}" for source in answer_sources)
+    )
+
 
 def main():
     """Run streamlit app main entrypoint."""
@@ -23,26 +93,41 @@ def main():
     # If the file list changed, we do the ingestion flow:
     if current_file_names != st.session_state.uploaded_file_names:
         with st.spinner("Updating documents database... Please wait ⏳"):
-            # 1. Clean up database
-            delete_url = "http://fastapi-backend:8000/v1/delete_all_chunks"
+            # 1. Sync the documents database with the uploaded files: documents are
+            #    identified by the hash of their file, so only new or changed ones are
+            #    ingested (as background jobs), and removed ones are deleted
+            sync_url = "http://fastapi-backend:8000/v1/sync_documents"
+            files_by_name = {
+                file_obj.name: file_obj.getvalue() for file_obj in uploaded_files or []
+            }
+            manifest = json.dumps(
+                [
+                    {"doc_name": name, "content_hash": hashlib.sha256(content).hexdigest()}
+                    for name, content in files_by_name.items()
+                ]
+            )
+            job_ids = []
             try:
-                delete_response = requests.delete(delete_url)
-                delete_response.raise_for_status()  # Raise an error for non-2xx codes
+                sync_response = requests.post(sync_url, data={"manifest": manifest})
+                sync_response.raise_for_status()  # Raise an error for non-2xx codes
+                missing = sync_response.json()["missing"]
+                if missing:
+                    # 2. Upload the files of the new or changed documents
+                    files = [
+                        ("files", (name, files_by_name[name], "application/pdf"))
+                        for name in missing
+                    ]
+                    sync_response = requests.post(
+                        sync_url, data={"manifest": manifest}, files=files
+                    )
+                    sync_response.raise_for_status()
+                    job_ids = [job["job_id"] for job in sync_response.json()["jobs"]]
             except requests.exceptions.RequestException as e:
-                st.error(f"Error deleting all chunks: {e}")
+                st.error(f"Error syncing documents: {e}")
 
-            # 2. Ingest documents in database
-            ingest_url = "http://fastapi-backend:8000/v1/ingest_document"
-            try:
-                for file_obj in uploaded_files:
-                    # Note: file_obj is a Streamlit UploadedFile, not a local path
-                    # but we can still pass its `read()` content to requests.
-                    files = {"file": (file_obj.name, file_obj.getvalue(), "application/pdf")}
-                    response = requests.post(ingest_url, files=files)
-                    response.raise_for_status()
-                    st.success(f"Successfully uploaded {len(uploaded_files)} files to database ✅")
-            except requests.exceptions.RequestException as e:
-                st.error(f"Error ingesting {file_obj.name}: {e}")
+            # 3. Wait for ingestion jobs to finish
+            if job_ids and wait_for_jobs(job_ids):
+                st.success(f"Successfully uploaded {len(job_ids)} files to database ✅")
 
         # Update session_state
         st.session_state.uploaded_file_names = current_file_names
@@ -77,33 +162,42 @@ def main():
         st.chat_message("user").text(prompt)
         st.session_state.messages.append({"role": "user", "content": prompt})
 
-        # Send the query to the backend
-        query_url = "http://fastapi-backend:8000/v1/query"
+        # Send the query to the backend, and display the answer as it is streamed back
+        query_url = "http://fastapi-backend:8000/v1/query_stream"
         payload = {"query": prompt, "top_k": 3}
 
-        try:
-            query_response = requests.post(query_url, json=payload)
-            query_response.raise_for_status()
-
-            response_json = query_response.json()
-            # Extract relevant fields
-            answer_text = response_json.get("answer_text", "No answer text found.")
-            answer_sources = response_json.get("answer_sources", [])
-            bot_answer = (
-                "✅ ANSWER\n\n"
-                + f"{answer_text}\n\n"
-                + "ℹ️ SOURCES\n\n"
-                + "\n".join(f"ℹ️ {source}" for source in answer_sources)
-            )
+        with st.chat_message("assistant"):
+            placeholder = st.empty()
+            placeholder.text("Searching the documents... ⏳")
+            try:
+                with requests.post(query_url, json=payload, stream=True) as query_response:
+                    query_response.raise_for_status()
+
+                    streamed_text = ""
+                    bot_answer = "No answer text found."
+                    for event, data in iter_sse_events(query_response):
+                        if event == "sources":
+                            doc_names = sorted({source["doc_name"] for source in data["sources"]})
+                            placeholder.text(f"Reading {', '.join(doc_names)}... ⏳")
+                        elif event == "token":
+                            streamed_text += data["text"]
+                            placeholder.text(f"✅ ANSWER\n\n{streamed_text}")
+                        elif event == "answer":
+                            bot_answer = format_bot_answer(
+                                data.get("answer_text", "No answer text found."),
+                                data.get("answer_sources", []),
+                            )
+                        elif event == "error":
+                            bot_answer = f"Error calling the API: {data.get('detail')}"
 
-        except requests.exceptions.RequestException as e:
-            bot_answer = (
-                f"Error calling the API: {e} --- Sent query: {prompt} ---- URL used: {query_url}"
-            )
+            except requests.exceptions.RequestException as e:
+                bot_answer = (
+                    f"Error calling the API: {e} --- Sent query: {prompt} "
+                    f"---- URL used: {query_url}"
+                )
 
-        # Display the assistant's response
-        with st.chat_message("assistant"):
-            st.text(bot_answer)
+            # Display the assistant's complete response
+            placeholder.text(bot_answer)
 
         st.session_state.messages.append({"role": "assistant", "content": bot_answer})
 